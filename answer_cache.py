@@ -0,0 +1,292 @@
+"""Cache of answers to customer questions, shared by every session on the worker.
+
+The same questions come up on call after call ("how does Cloud SQL compare to
+RDS?"). When a final transcript asks a question that was answered before, the
+cached ANSWER is sent right away and the live Gemini call refines or retracts it.
+
+Answers are shared across calls, so only questions that make sense without the
+call around them are cached: ones that name a product or service and do not
+point back into the conversation ("how much would that cost us?"). Answers are
+keyed by the normalized question Gemini says it answered; the question found in
+the transcript becomes an alias of that entry when it names the same products.
+With ANSWER_CACHE_EMBEDDINGS, questions worded differently are also matched by
+the cosine similarity of their embeddings, searched in a local in-memory index. Entries expire after
+ANSWER_CACHE_TTL_SECONDS, and the least recently used are evicted beyond
+ANSWER_CACHE_MAX_ENTRIES.
+"""
+import re
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from config import (
+    logger,
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_EMBEDDINGS,
+    ANSWER_CACHE_EMBEDDING_MODEL,
+    ANSWER_CACHE_SIMILARITY_THRESHOLD,
+)
+from metrics import ANSWER_CACHE_REQUESTS, ANSWER_CACHE_SIZE
+
+# Words that open a question even when the transcript has no question mark.
+QUESTION_WORDS = {
+    "how", "what", "why", "when", "where", "which", "who", "can", "could", "does", "do", "is", "are",
+    "should", "will", "would",
+}
+# Dropped when normalizing, so "um, so how does the pricing work" and "how does pricing work" match.
+FILLER_WORDS = {"um", "uh", "er", "so", "well", "okay", "ok", "actually", "basically", "just", "really", "the", "a", "an", "please"}
+# Shorter questions ("what?", "is it?") only make sense in context and are never cached.
+MIN_QUESTION_WORDS = 3
+# Words that refer back into the call ("is that right for us?"); questions with them are never cached.
+DEICTIC_WORDS = {
+    "this", "that", "these", "those", "it", "its", "they", "them", "their", "we", "us", "our", "ours",
+    "you", "your", "yours", "he", "him", "his", "she", "her", "here",
+}
+
+_SENTENCE_END = re.compile(r"(?<=[.?!])\s+")
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+# Capitalized words and words with digits, e.g. "BigQuery", "Cloud SQL", "S3", "n2".
+_NAME = re.compile(r"\b(?:[A-Z][A-Za-z0-9]*|[A-Za-z]+[0-9][A-Za-z0-9]*)\b")
+
+
+def normalize_question(text: str):
+    words = _NON_WORD.sub(" ", text.lower()).split()
+    return " ".join(word for word in words if word not in FILLER_WORDS)
+
+def product_names(text: str):
+    """The lowercased words of `text` that look like product or service names.
+
+    >>> sorted(product_names("How does Cloud SQL compare to RDS?"))
+    ['cloud', 'rds', 'sql']
+    >>> sorted(product_names("What about n2 machines?"))
+    ['n2']
+    """
+    names = {name.lower() for name in _NAME.findall(text)}
+    return names - QUESTION_WORDS - FILLER_WORDS - DEICTIC_WORDS - {"i"}
+
+def is_context_free(question: str):
+    """Whether `question` means the same on any call: it names a product and does not refer back into the call.
+
+    >>> is_context_free("How does Cloud SQL compare to RDS?")
+    True
+    >>> [is_context_free(q) for q in ("How much would that cost us?", "Is that right for us?", "What do you think?")]
+    [False, False, False]
+    >>> is_context_free("How does pricing work?")
+    False
+    """
+    return not DEICTIC_WORDS.intersection(normalize_question(question).split()) and bool(product_names(question))
+
+def asks_about(asked: str, answered: str):
+    """Whether an answer to `answered` also answers `asked`: every product `asked` names is in `answered`.
+
+    >>> asks_about("How does Cloud SQL compare to RDS?", "Cloud SQL vs RDS")
+    True
+    >>> asks_about("How does Cloud SQL compare to RDS?", "BigQuery pricing")
+    False
+    """
+    return product_names(asked) <= set(normalize_question(answered).split())
+
+def extract_questions(transcript: str):
+    """The sentences of `transcript` that look like questions worth caching.
+
+    >>> extract_questions("We run on AWS today. How does Cloud SQL compare to RDS? Does that make sense?")
+    ['How does Cloud SQL compare to RDS?']
+    """
+    questions = []
+    for sentence in _SENTENCE_END.split(transcript.strip()):
+        words = normalize_question(sentence).split()
+        if len(words) < MIN_QUESTION_WORDS or not is_context_free(sentence):
+            continue
+        if sentence.rstrip().endswith("?") or words[0] in QUESTION_WORDS:
+            questions.append(sentence.strip())
+    return questions
+
+
+class EmbeddingIndex:
+    """Brute-force cosine-similarity search over unit vectors, one row per key.
+
+    A cache of at most a few thousand questions is searched with one matrix-vector
+    product, which is faster than any approximate index at this size.
+    """
+
+    def __init__(self):
+        self._keys = []
+        self._rows = {}
+        self._matrix = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key: str, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        row = self._rows.get(key)
+        if row is not None:
+            self._matrix[row] = vector
+            return
+        self._rows[key] = len(self._keys)
+        self._keys.append(key)
+        self._matrix = vector[None, :] if self._matrix is None else np.vstack([self._matrix, vector])
+
+    def remove(self, key: str):
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        # Move the last row into the hole so rows stay contiguous.
+        last = len(self._keys) - 1
+        if row != last:
+            moved = self._keys[last]
+            self._keys[row] = moved
+            self._matrix[row] = self._matrix[last]
+            self._rows[moved] = row
+        self._keys.pop()
+        self._matrix = self._matrix[:last] if last else None
+
+    def search(self, vector):
+        """Returns (key, similarity) of the closest vector, or (None, 0.0) if the index is empty."""
+        if self._matrix is None:
+            return None, 0.0
+        vector = np.asarray(vector, dtype=np.float32)
+        scores = self._matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+        best = int(np.argmax(scores))
+        return self._keys[best], float(scores[best])
+
+
+async def gemini_embedding(client, text: str):
+    """Embeds `text` with the genai client of the session asking."""
+    response = await client.aio.models.embed_content(model=ANSWER_CACHE_EMBEDDING_MODEL, contents=text)
+    return response.embeddings[0].values
+
+
+class AnswerCache:
+    """LRU cache of ANSWER payloads keyed by normalized question, with TTL expiry.
+
+    Entries are keyed by the question Gemini answered; `_aliases` maps questions
+    as customers asked them to those keys. `embed(client, text)` is an optional
+    coroutine returning an embedding; when set, a question with no exact match
+    is matched to the most similar cached question at or above `threshold`.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL_SECONDS,
+                 embed=None, threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed
+        self.threshold = threshold
+        self.index = EmbeddingIndex() if embed else None
+        self._entries = OrderedDict()
+        self._aliases = OrderedDict()
+        # Counters
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.embedding_failures = 0
+
+    def _get(self, key: str):
+        key = self._aliases.get(key, key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, payload = entry
+        if time.time() - stored_at > self.ttl:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return payload
+
+    def _remove(self, key: str):
+        del self._entries[key]
+        if self.index is not None:
+            self.index.remove(key)
+
+    async def find(self, client, question: str):
+        """Returns (payload, embedding) for `question`; payload is None on a miss.
+
+        The embedding, if one was computed, is handed back to `put` so the
+        question is not embedded twice.
+        """
+        key = normalize_question(question)
+        payload = self._get(key)
+        if payload is not None:
+            self.hits += 1
+            ANSWER_CACHE_REQUESTS.labels("hit").inc()
+            return payload, None
+
+        embedding = None
+        if self.embed is not None:
+            try:
+                embedding = await self.embed(client, key)
+            except Exception as e:
+                self.embedding_failures += 1
+                logger.warning(f"Error embedding question for the answer cache: {e}")
+            if embedding is not None:
+                match, similarity = self.index.search(embedding)
+                if match is not None and similarity >= self.threshold:
+                    payload = self._get(match)
+                    if payload is not None:
+                        self.similar_hits += 1
+                        ANSWER_CACHE_REQUESTS.labels("similar").inc()
+                        return payload, embedding
+
+        self.misses += 1
+        ANSWER_CACHE_REQUESTS.labels("miss").inc()
+        return None, embedding
+
+    def put(self, question: str, payload: dict, embedding=None, asked: str = None):
+        """Caches `payload` under `question`, with `asked` (if given) as another way to find it."""
+        key = normalize_question(question)
+        self._entries[key] = (time.time(), payload)
+        self._entries.move_to_end(key)
+        if self.index is not None and embedding is not None:
+            self.index.add(key, embedding)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+        if asked is not None and normalize_question(asked) != key:
+            self._aliases[normalize_question(asked)] = key
+            self._aliases.move_to_end(normalize_question(asked))
+            # Aliases of evicted entries simply miss; bound them like the entries.
+            while len(self._aliases) > self.max_entries:
+                self._aliases.popitem(last=False)
+
+    async def store(self, client, payload: dict, asked: str = None, asked_embedding=None):
+        """Caches a live ANSWER under the question it says it answered, if that question is context-free.
+
+        `asked` is the question found in the transcript, with its embedding if
+        `find` computed one; it is an alias of the entry only if `asks_about`
+        says the answer is to it. Returns whether the answer was cached.
+        """
+        question = payload.get("question") or ""
+        if not is_context_free(question):
+            return False
+        if asked is not None and not asks_about(asked, question):
+            asked = None
+        embedding = None
+        if self.index is not None:
+            if asked is not None and normalize_question(asked) == normalize_question(question):
+                embedding = asked_embedding
+            if embedding is None:
+                try:
+                    embedding = await self.embed(client, normalize_question(question))
+                except Exception as e:
+                    self.embedding_failures += 1
+                    logger.warning(f"Error embedding question for the answer cache: {e}")
+        self.put(question, payload, embedding, asked)
+        return True
+
+    def stats(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.similar_hits) / lookups if lookups else 0.0,
+            "embedding_failures": self.embedding_failures,
+        }
+
+
+answer_cache = AnswerCache(embed=gemini_embedding if ANSWER_CACHE_EMBEDDINGS else None) if ANSWER_CACHE_ENABLED else None
+ANSWER_CACHE_SIZE.function = lambda: answer_cache.stats()["size"] if answer_cache else 0
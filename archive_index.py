@@ -0,0 +1,323 @@
+"""Local search index over the conversations archived in Cloud Storage.
+
+Every conversation document (`conversation-*.json` / `.jsonl`) is indexed into
+an SQLite database: one row per conversation with its user, start time and GCP
+services, and an FTS5 full-text row over its transcript and insights. Lookups by
+user, date range, keyword and GCP service are answered from the index alone,
+without listing or reading the bucket.
+
+The index is kept current incrementally. Compaction indexes the document it
+just composed (see `gcs_utils`), and `gcs_utils.ingest_archive_blocking` picks
+up anything the index has not seen at the same generation, e.g. after a restart
+or from another instance. The workers of a server share one index, and only the
+one holding the ingestion claim (`claim_ingestion`) runs the ingestion. Like the
+session store, all SQLite access runs on the storage executor.
+
+Usage:
+    python archive_index.py ingest
+    python archive_index.py search --user alice@google.com --keyword bigquery --gcp-service "Cloud SQL"
+"""
+import argparse
+import base64
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from config import ARCHIVE_INDEX_PATH, ARCHIVE_PAGE_SIZE, ARCHIVE_MAX_PAGE_SIZE
+from executors import storage_executor
+
+_FILENAME_TIMESTAMP = re.compile(r"conversation-(\d{8}-\d{6})-")
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS conversations (
+        id INTEGER PRIMARY KEY,
+        uri TEXT NOT NULL UNIQUE,
+        user TEXT,
+        session_id TEXT,
+        started_at TEXT,
+        generation INTEGER,
+        transcripts INTEGER NOT NULL,
+        insights INTEGER NOT NULL,
+        gcp_services TEXT NOT NULL,
+        indexed_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS conversations_started ON conversations (started_at, id)",
+    "CREATE INDEX IF NOT EXISTS conversations_user ON conversations (user, started_at, id)",
+    "CREATE TABLE IF NOT EXISTS conversation_services (service TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (service, id))",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_text USING fts5(transcript, insights)",
+    # When the last complete ingestion of each bucket started.
+    "CREATE TABLE IF NOT EXISTS ingestions (bucket TEXT PRIMARY KEY, started_at REAL NOT NULL)",
+)
+
+
+def started_at_of(name: str, conversation: dict):
+    """The conversation's start as an ISO timestamp, from its header or, for flat uploads, its object name."""
+    if conversation.get("started_at"):
+        return datetime.fromisoformat(conversation["started_at"]).isoformat(timespec="seconds")
+    match = _FILENAME_TIMESTAMP.search(name)
+    if match:
+        return datetime.strptime(match.group(1), "%Y%m%d-%H%M%S").isoformat(timespec="seconds")
+    return None
+
+def _insight_texts(conversation: dict):
+    """Searchable text of each insight, and the GCP services the facts mapped to."""
+    texts, services = [], []
+    for message in conversation.get("insights", []):
+        payload = message.get("payload") or {}
+        if message.get("response_type") == "FACT":
+            texts.append(payload.get("fact", ""))
+            if payload.get("gcp_service"):
+                texts.append(payload["gcp_service"])
+                if payload["gcp_service"] not in services:
+                    services.append(payload["gcp_service"])
+        elif message.get("response_type") == "TIP":
+            texts.extend([payload.get("short", ""), payload.get("long", "")])
+        elif message.get("response_type") == "ANSWER":
+            texts.extend([payload.get("question", ""), payload.get("short", ""), payload.get("long", "")])
+    return texts, services
+
+def keyword_query(keyword: str):
+    """An FTS5 query matching every word of `keyword`, with FTS syntax in the input taken literally."""
+    terms = keyword.split()
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def encode_page_token(started_at: str, row_id: int):
+    return base64.urlsafe_b64encode(json.dumps([started_at, row_id]).encode("utf-8")).decode("ascii")
+
+def decode_page_token(token: str):
+    try:
+        started_at, row_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return str(started_at), int(row_id)
+    except Exception:
+        raise ValueError("Invalid page token")
+
+
+class ArchiveIndex:
+    """SQLite/FTS5 index of archived conversations, newest first."""
+
+    def __init__(self, path: str = ARCHIVE_INDEX_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._created = False
+        self._ingestion_claim = None
+
+    def _connect(self):
+        # One connection per executor thread; sqlite3 connections must stay on their thread.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self._create()
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=10)
+            connection.row_factory = sqlite3.Row
+        return connection
+
+    def _create(self):
+        # On first use rather than at import, so tools that never touch the archive create no database.
+        with self._lock:
+            if self._created:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with sqlite3.connect(self.path, timeout=10) as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                for statement in SCHEMA:
+                    connection.execute(statement)
+            connection.close()
+            self._created = True
+
+    def add_blocking(self, uri: str, conversation: dict, generation: int = None):
+        """Indexes (or re-indexes) one conversation document. Blocking: call from a worker thread."""
+        name = uri.rsplit("/", 1)[-1]
+        insights, services = _insight_texts(conversation)
+        transcript = conversation.get("transcript", [])
+        with self._connect() as connection:
+            row = connection.execute("SELECT id FROM conversations WHERE uri = ?", (uri,)).fetchone()
+            values = (
+                conversation.get("user"),
+                conversation.get("session_id"),
+                started_at_of(name, conversation),
+                generation,
+                len(transcript),
+                len(conversation.get("insights", [])),
+                json.dumps(services),
+                time.time(),
+            )
+            if row is None:
+                row_id = connection.execute(
+                    "INSERT INTO conversations (user, session_id, started_at, generation, transcripts, insights, "
+                    "gcp_services, indexed_at, uri) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    values + (uri,),
+                ).lastrowid
+            else:
+                row_id = row["id"]
+                connection.execute(
+                    "UPDATE conversations SET user = ?, session_id = ?, started_at = ?, generation = ?, transcripts = ?, "
+                    "insights = ?, gcp_services = ?, indexed_at = ? WHERE id = ?",
+                    values + (row_id,),
+                )
+                connection.execute("DELETE FROM conversation_text WHERE rowid = ?", (row_id,))
+                connection.execute("DELETE FROM conversation_services WHERE id = ?", (row_id,))
+            connection.execute(
+                "INSERT INTO conversation_text (rowid, transcript, insights) VALUES (?, ?, ?)",
+                (row_id, "\n".join(transcript), "\n".join(text for text in insights if text)),
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO conversation_services (service, id) VALUES (?, ?)",
+                [(service.lower(), row_id) for service in services],
+            )
+
+    def claim_ingestion(self):
+        """Makes this process the only one ingesting into this index, if no other process is. Blocking.
+
+        The claim is an exclusive lock on `<path>.ingest.lock`, held until the
+        process exits, so another worker takes over when this one goes away.
+        Returns whether this process holds it.
+        """
+        if self._ingestion_claim is not None:
+            return True
+        self._create()
+        lock = open(f"{self.path}.ingest.lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return False
+        self._ingestion_claim = lock
+        return True
+
+    def last_ingestion_blocking(self, bucket: str):
+        """When the last complete ingestion of `bucket` started (a Unix time), or None."""
+        row = self._connect().execute("SELECT started_at FROM ingestions WHERE bucket = ?", (bucket,)).fetchone()
+        return row["started_at"] if row else None
+
+    def record_ingestion_blocking(self, bucket: str, started_at: float):
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO ingestions (bucket, started_at) VALUES (?, ?) "
+                "ON CONFLICT(bucket) DO UPDATE SET started_at = excluded.started_at",
+                (bucket, started_at),
+            )
+
+    def generations_blocking(self, uris):
+        """The indexed generation of each of `uris` that is in the index."""
+        connection = self._connect()
+        generations = {}
+        uris = list(uris)
+        # Stay under SQLite's default limit on bound parameters.
+        for i in range(0, len(uris), 500):
+            batch = uris[i:i + 500]
+            rows = connection.execute(
+                f"SELECT uri, generation FROM conversations WHERE uri IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            generations.update((row["uri"], row["generation"]) for row in rows)
+        return generations
+
+    def _search(self, user: str = None, started_from: str = None, started_before: str = None, keyword: str = None,
+                gcp_service: str = None, page_size: int = ARCHIVE_PAGE_SIZE, page_token: str = None):
+        clauses, params = [], []
+        columns = "c.id, c.uri, c.user, c.session_id, c.started_at, c.transcripts, c.insights, c.gcp_services"
+        tables = "conversations c"
+        if keyword and keyword.strip():
+            columns += ", snippet(conversation_text, -1, '[', ']', '…', 12) AS snippet"
+            tables += " JOIN conversation_text ON conversation_text.rowid = c.id"
+            clauses.append("conversation_text MATCH ?")
+            params.append(keyword_query(keyword))
+        if user:
+            clauses.append("c.user = ?")
+            params.append(user)
+        if started_from:
+            clauses.append("c.started_at >= ?")
+            params.append(started_from)
+        if started_before:
+            clauses.append("c.started_at < ?")
+            params.append(started_before)
+        if gcp_service:
+            clauses.append("c.id IN (SELECT id FROM conversation_services WHERE service = ?)")
+            params.append(gcp_service.lower())
+        if page_token:
+            started_at, row_id = decode_page_token(page_token)
+            clauses.append("(coalesce(c.started_at, ''), c.id) < (?, ?)")
+            params.extend([started_at, row_id])
+
+        page_size = max(1, min(page_size, ARCHIVE_MAX_PAGE_SIZE))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._connect().execute(
+            f"SELECT {columns} FROM {tables} {where} ORDER BY coalesce(c.started_at, '') DESC, c.id DESC LIMIT ?",
+            params + [page_size + 1],
+        ).fetchall()
+
+        conversations = []
+        for row in rows[:page_size]:
+            conversation = {
+                "uri": row["uri"],
+                "user": row["user"],
+                "session_id": row["session_id"],
+                "started_at": row["started_at"],
+                "transcripts": row["transcripts"],
+                "insights": row["insights"],
+                "gcp_services": json.loads(row["gcp_services"]),
+            }
+            if "snippet" in row.keys():
+                conversation["snippet"] = row["snippet"]
+            conversations.append(conversation)
+        next_page_token = None
+        if len(rows) > page_size:
+            last = rows[page_size - 1]
+            next_page_token = encode_page_token(last["started_at"] or "", last["id"])
+        return {"conversations": conversations, "next_page_token": next_page_token}
+
+    def _stats(self):
+        row = self._connect().execute("SELECT count(*) AS conversations, max(indexed_at) AS last_indexed_at FROM conversations").fetchone()
+        return dict(row)
+
+    async def add(self, uri: str, conversation: dict, generation: int = None):
+        await storage_executor.run(self.add_blocking, uri, conversation, generation)
+
+    async def search(self, **filters):
+        """Conversations matching every given filter, newest first, one page at a time.
+
+        Filters: `user`, `started_from` (inclusive) and `started_before` (exclusive)
+        ISO timestamps, `keyword` (every word must occur in the transcript or
+        insights), `gcp_service`, `page_size` and `page_token` (from the previous page).
+        """
+        return await storage_executor.run(self._search, **filters)
+
+    async def stats(self):
+        return await storage_executor.run(self._stats)
+
+
+archive_index = ArchiveIndex()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    ingest = subcommands.add_parser("ingest", help="index conversations in the bucket that are new or changed")
+    ingest.add_argument("--bucket", default=os.environ.get("GCS_BUCKET_NAME"))
+    ingest.add_argument("--full", action="store_true", help="list the whole bucket, not just recent sessions")
+    search = subcommands.add_parser("search", help="search the index")
+    search.add_argument("--user")
+    search.add_argument("--from", dest="started_from", help="ISO date or timestamp, inclusive")
+    search.add_argument("--before", dest="started_before", help="ISO date or timestamp, exclusive")
+    search.add_argument("--keyword")
+    search.add_argument("--gcp-service")
+    search.add_argument("--page-size", type=int, default=ARCHIVE_PAGE_SIZE)
+    search.add_argument("--page-token")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        from gcs_utils import ingest_archive_blocking
+        if not args.bucket:
+            parser.error("--bucket or GCS_BUCKET_NAME is required")
+        print(json.dumps(ingest_archive_blocking(args.bucket, archive_index, full=args.full), indent=2))
+    else:
+        filters = {key: value for key, value in vars(args).items() if key != "command" and value is not None}
+        print(json.dumps(archive_index._search(**filters), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
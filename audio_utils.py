@@ -0,0 +1,293 @@
+import asyncio
+import time
+from collections import deque
+
+import numpy as np
+
+from config import (
+    SPEECH_API_SAMPLE_RATE,
+    VAD_THRESHOLD_DBFS,
+    VAD_HANGOVER_SECONDS,
+    VAD_PREROLL_SECONDS,
+    VAD_KEEPALIVE_SECONDS,
+    AUDIO_PACKET_MAX_BYTES,
+    AUDIO_BUFFER_MAX_BYTES,
+    AUDIO_OVERFLOW_POLICY,
+)
+from metrics import AUDIO_BUFFER_DROPPED_BYTES
+
+# Analysis window for the energy detector: 10 ms at 16 kHz.
+VAD_WINDOW_SAMPLES = SPEECH_API_SAMPLE_RATE // 100
+INT16_FULL_SCALE = 32768.0
+BYTES_PER_SECOND = SPEECH_API_SAMPLE_RATE * 2
+# With the "pause" policy the client is resumed once the buffer drains below this fraction.
+RESUME_RATIO = 0.5
+# With the "pause" policy, chunks still in flight are accepted up to this multiple of the budget.
+PAUSE_HARD_LIMIT_RATIO = 2
+OVERFLOW_POLICIES = ("drop_oldest", "drop_silence", "pause")
+
+
+class VoiceActivityDetector:
+    """Energy-based VAD that drops silent PCM chunks before they reach Speech-to-Text.
+
+    Each LINEAR16 chunk is split into 10 ms windows and its per-window RMS level
+    is computed in one vectorised pass. A chunk counts as speech if any window
+    exceeds `threshold_dbfs`. After speech, chunks keep flowing for `hangover`
+    seconds so trailing syllables are not clipped, and the last `preroll`
+    seconds of silence are released just before a new onset so word starts
+    survive too. During long silences one chunk is still forwarded every
+    `keepalive` seconds so the recognition stream does not time out.
+    """
+
+    def __init__(self, threshold_dbfs: float = VAD_THRESHOLD_DBFS, hangover: float = VAD_HANGOVER_SECONDS,
+                 preroll: float = VAD_PREROLL_SECONDS, keepalive: float = VAD_KEEPALIVE_SECONDS,
+                 sample_rate: int = SPEECH_API_SAMPLE_RATE):
+        self.threshold = INT16_FULL_SCALE * 10 ** (threshold_dbfs / 20)
+        self.hangover_samples = int(hangover * sample_rate)
+        self.preroll_samples = int(preroll * sample_rate)
+        self.keepalive_samples = int(keepalive * sample_rate)
+        self._since_speech = self.hangover_samples + 1
+        # Whether the chunks returned by the last `process` call contain speech.
+        self.speaking = False
+        self._since_sent = 0
+        self._preroll = []
+        self._preroll_samples = 0
+        # Counters
+        self.frames_kept = 0
+        self.frames_dropped = 0
+        self.bytes_kept = 0
+        self.bytes_dropped = 0
+
+    def is_speech(self, data: bytes) -> bool:
+        samples = np.frombuffer(data, dtype=np.int16)
+        usable = len(samples) - len(samples) % VAD_WINDOW_SAMPLES
+        if usable:
+            windows = samples[:usable].astype(np.float32).reshape(-1, VAD_WINDOW_SAMPLES)
+            rms = np.sqrt(np.mean(windows * windows, axis=1))
+            if rms.max() > self.threshold:
+                return True
+        tail = samples[usable:].astype(np.float32)
+        return bool(len(tail)) and float(np.sqrt(np.mean(tail * tail))) > self.threshold
+
+    def process(self, data: bytes):
+        """Returns the list of chunks to forward for `data` (possibly empty)."""
+        n_samples = len(data) // 2
+        self.speaking = self.is_speech(data)
+        if self.speaking:
+            self._since_speech = 0
+            out = self._preroll + [data]
+            self._preroll = []
+            self._preroll_samples = 0
+        else:
+            self._since_speech += n_samples
+            if self._since_speech <= self.hangover_samples:
+                out = [data]
+            elif self._since_sent + n_samples >= self.keepalive_samples:
+                out = [data]
+                self._drop_preroll()
+            else:
+                out = []
+                self._buffer_preroll(data, n_samples)
+
+        if out:
+            self._since_sent = 0
+            self.frames_kept += len(out)
+            self.bytes_kept += sum(len(chunk) for chunk in out)
+        else:
+            self._since_sent += n_samples
+        return out
+
+    def _buffer_preroll(self, data: bytes, n_samples: int):
+        self._preroll.append(data)
+        self._preroll_samples += n_samples
+        while self._preroll and self._preroll_samples - len(self._preroll[0]) // 2 >= self.preroll_samples:
+            dropped = self._preroll.pop(0)
+            self._preroll_samples -= len(dropped) // 2
+            self.frames_dropped += 1
+            self.bytes_dropped += len(dropped)
+
+    def _drop_preroll(self):
+        self.frames_dropped += len(self._preroll)
+        self.bytes_dropped += sum(len(chunk) for chunk in self._preroll)
+        self._preroll = []
+        self._preroll_samples = 0
+
+    def stats(self):
+        total = self.frames_kept + self.frames_dropped
+        return {
+            "frames_kept": self.frames_kept,
+            "frames_dropped": self.frames_dropped,
+            "bytes_kept": self.bytes_kept,
+            "bytes_dropped": self.bytes_dropped,
+            "drop_ratio": self.frames_dropped / total if total else 0.0,
+        }
+
+
+class AudioPacketizer:
+    """Coalesces whatever PCM chunks are already queued into one packet.
+
+    Packets are assembled in a preallocated buffer of `max_bytes`, so combining
+    chunks does not reallocate. It never waits for more audio: if only one chunk
+    is queued it is returned as is.
+    """
+
+    def __init__(self, max_bytes: int = AUDIO_PACKET_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._buffer = bytearray(max_bytes)
+        self._view = memoryview(self._buffer)
+        self._carry = None
+        self._has_carry = False
+        # Counters
+        self.chunks = 0
+        self.packets = 0
+
+    async def next_packet(self, queue):
+        """Returns the next packet from `queue`, or None once the end-of-stream sentinel is reached."""
+        if self._has_carry:
+            first, self._carry, self._has_carry = self._carry, None, False
+        else:
+            first = await queue.get()
+        if first is None:
+            return None
+
+        self.chunks += 1
+        self.packets += 1
+        size = len(first)
+        if size >= self.max_bytes or queue.empty():
+            return first
+
+        self._view[:size] = first
+        while not queue.empty():
+            chunk = queue.get_nowait()
+            if chunk is None or size + len(chunk) > self.max_bytes:
+                # Keep it for the next packet (the sentinel included).
+                self._carry, self._has_carry = chunk, True
+                break
+            self._view[size:size + len(chunk)] = chunk
+            size += len(chunk)
+            self.chunks += 1
+        return bytes(self._view[:size])
+
+    def stats(self):
+        return {
+            "chunks": self.chunks,
+            "packets": self.packets,
+            "avg_chunks_per_packet": self.chunks / self.packets if self.packets else 0.0,
+        }
+
+
+class AudioBuffer:
+    """Bounded, byte-budgeted FIFO of PCM chunks between `audio_receiver` and the speech pipeline.
+
+    Exposes the subset of the `asyncio.Queue` interface the pipeline uses
+    (`put_nowait`, `get`, `get_nowait`, `empty`); `close` replaces the old
+    `None` sentinel. When more than `max_bytes` are queued the overflow policy
+    applies:
+
+    - "drop_oldest": discard the oldest chunks.
+    - "drop_silence": discard the oldest chunks the VAD marked as silent, then the oldest chunks.
+    - "pause": call `on_pause(True)` so the client stops sending, and `on_pause(False)` once
+      the buffer has drained; drop the oldest chunks only past a hard limit.
+    """
+
+    def __init__(self, max_bytes: int = AUDIO_BUFFER_MAX_BYTES, policy: str = AUDIO_OVERFLOW_POLICY, on_pause=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown audio overflow policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_pause = on_pause
+        self.paused = False
+        self._chunks = deque()
+        self._bytes = 0
+        self._closed = False
+        self._readable = asyncio.Event()
+        # Counters
+        self.dropped_chunks = 0
+        self.dropped_bytes = 0
+        self.peak_bytes = 0
+        self.pauses = 0
+
+    def put_nowait(self, data: bytes, silent: bool = False):
+        if self._closed:
+            return
+        self._chunks.append((data, silent, time.monotonic()))
+        self._bytes += len(data)
+        if self._bytes > self.max_bytes:
+            self._overflow()
+        self.peak_bytes = max(self.peak_bytes, self._bytes)
+        self._readable.set()
+
+    def close(self):
+        """Marks the end of the audio; readers get None once the buffer is drained."""
+        self._closed = True
+        self._readable.set()
+
+    def empty(self):
+        return not self._chunks and not self._closed
+
+    def get_nowait(self):
+        if self._chunks:
+            data, _, _ = self._chunks.popleft()
+            self._bytes -= len(data)
+            if self.paused and self._bytes <= self.max_bytes * RESUME_RATIO:
+                self._set_paused(False)
+            return data
+        if self._closed:
+            return None
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        while not self._chunks and not self._closed:
+            self._readable.clear()
+            await self._readable.wait()
+        return self.get_nowait()
+
+    def _overflow(self):
+        if self.policy == "pause":
+            if not self.paused:
+                self._set_paused(True)
+            limit = self.max_bytes * PAUSE_HARD_LIMIT_RATIO
+        else:
+            limit = self.max_bytes
+            if self.policy == "drop_silence" and self._bytes > limit:
+                kept = deque()
+                for chunk in self._chunks:
+                    if chunk[1] and self._bytes > limit:
+                        self._drop(chunk)
+                    else:
+                        kept.append(chunk)
+                self._chunks = kept
+        while self._bytes > limit and len(self._chunks) > 1:
+            self._drop(self._chunks.popleft())
+
+    def _drop(self, chunk):
+        self._bytes -= len(chunk[0])
+        self.dropped_chunks += 1
+        self.dropped_bytes += len(chunk[0])
+        AUDIO_BUFFER_DROPPED_BYTES.inc(len(chunk[0]))
+
+    def _set_paused(self, paused: bool):
+        self.paused = paused
+        if paused:
+            self.pauses += 1
+        if self.on_pause:
+            self.on_pause(paused)
+
+    def lag_seconds(self):
+        """Seconds of audio queued but not yet sent to Speech-to-Text."""
+        return self._bytes / BYTES_PER_SECOND
+
+    def stats(self):
+        oldest_age = time.monotonic() - self._chunks[0][2] if self._chunks else 0.0
+        return {
+            "policy": self.policy,
+            "depth_chunks": len(self._chunks),
+            "depth_bytes": self._bytes,
+            "peak_bytes": self.peak_bytes,
+            "lag_seconds": self.lag_seconds(),
+            "oldest_chunk_age_seconds": oldest_age,
+            "dropped_chunks": self.dropped_chunks,
+            "dropped_bytes": self.dropped_bytes,
+            "paused": self.paused,
+            "pauses": self.pauses,
+        }
@@ -1,11 +1,95 @@
-import firebase_admin
-from firebase_admin import auth, credentials
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
 from fastapi import HTTPException, status
 
-# TODO: Set the GOOGLE_APPLICATION_CREDENTIALS environment variable
-# to the path of your Firebase service account key file.
-cred = credentials.ApplicationDefault()
-firebase_admin.initialize_app(cred)
+from config import TOKEN_CACHE_MAX_SIZE
+from executors import auth_executor
+from metrics import TOKEN_CACHE_REQUESTS, TOKEN_CACHE_SIZE, TOKEN_VERIFY_SECONDS
+
+_firebase_lock = threading.Lock()
+
+def init_firebase():
+    """Initializes the Firebase Admin SDK on first use rather than at import. Blocking."""
+    import firebase_admin
+    from firebase_admin import credentials
+
+    with _firebase_lock:
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            # TODO: Set the GOOGLE_APPLICATION_CREDENTIALS environment variable
+            # to the path of your Firebase service account key file.
+            firebase_admin.initialize_app(credentials.ApplicationDefault())
+
+def verify_id_token_blocking(token: str):
+    init_firebase()
+    from firebase_admin import auth
+    return auth.verify_id_token(token)
+
+
+class TokenCache:
+    """Bounded LRU cache of verified Firebase ID tokens.
+
+    Entries expire at the token's `exp` claim. Misses are verified in the auth
+    executor, and concurrent misses for the same token share one verification.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    async def get(self, token: str):
+        decoded_token = self._entries.get(token)
+        if decoded_token is not None:
+            if decoded_token.get("exp", 0) > time.time():
+                self._entries.move_to_end(token)
+                self.hits += 1
+                TOKEN_CACHE_REQUESTS.labels("hit").inc()
+                return decoded_token
+            del self._entries[token]
+
+        self.misses += 1
+        TOKEN_CACHE_REQUESTS.labels("miss").inc()
+        task = self._pending.get(token)
+        if task is None:
+            task = asyncio.ensure_future(self._verify(token))
+            self._pending[token] = task
+            task.add_done_callback(lambda t: self._verification_done(token, t))
+        # Shield the shared verification so one cancelled waiter does not fail the others.
+        return await asyncio.shield(task)
+
+    async def _verify(self, token: str):
+        with TOKEN_VERIFY_SECONDS.time():
+            decoded_token = await auth_executor.run(verify_id_token_blocking, token)
+        self._entries[token] = decoded_token
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return decoded_token
+
+    def _verification_done(self, token: str, task: asyncio.Future):
+        self._pending.pop(token, None)
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter was cancelled.
+            task.exception()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "pending": len(self._pending),
+        }
+
+
+token_cache = TokenCache()
+TOKEN_CACHE_SIZE.function = lambda: token_cache.stats()["size"]
 
 async def verify_token(token: str):
     if not token:
@@ -14,7 +98,7 @@ async def verify_token(token: str):
             detail="Not authenticated",
         )
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await token_cache.get(token)
         email = decoded_token.get("email")
         if not email or not email.endswith("@google.com"):
             raise HTTPException(
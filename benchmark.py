@@ -0,0 +1,407 @@
+"""Load test for `/ws/transcribe` against local stand-ins for every external service.
+
+The FastAPI `app` from `main.py` runs in a child process under a single uvicorn
+worker, with Speech-to-Text, Gemini, Firebase and Cloud Storage replaced by the
+fakes in `fake_backends`, each with a configurable latency. The parent opens N
+simulated browser sessions that stream PCM (a recording, or synthesized speech-like
+audio) at real time or faster and measures, per final transcript, the time until
+the first FACT/TIP/ANSWER arrives. The server reports its event-loop lag, memory
+and CPU. Each run is appended to a JSON Lines results file so runs can be compared
+over time.
+
+Usage:
+    python benchmark.py run --sessions 50 --duration 60 --name baseline
+    python benchmark.py run --sessions 200 --speed 4 --pcm call.wav --gemini-latency 1.5
+    python benchmark.py history
+"""
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import time
+import urllib.request
+import wave
+from datetime import datetime
+
+import numpy as np
+
+# Every backend is faked, so no real credentials are needed.
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+
+from config import SPEECH_API_SAMPLE_RATE
+from evaluate import distribution
+
+RESULTS_PATH = os.path.join("benchmarks", "results.jsonl")
+BYTES_PER_SECOND = SPEECH_API_SAMPLE_RATE * 2
+INSIGHT_TYPES = ("FACT", "TIP", "ANSWER")
+# The benchmark user's token; FakeFirebaseAuth accepts any token.
+BENCHMARK_TOKEN = "benchmark"
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a `interval`-second sleep."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - started - self.interval)
+
+    def snapshot(self, reset: bool = False):
+        result = distribution(self.samples)
+        if reset:
+            self.samples = []
+        return result
+
+
+def _rss_bytes():
+    """Current resident set size; falls back to the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def serve(port: int, options: dict):
+    """Child process: patches in the fakes, then runs `main.app` under uvicorn."""
+    os.environ.setdefault("GCS_BUCKET_NAME", "benchmark")
+
+    import firebase_admin.auth
+    import google.auth
+    import google.genai
+    from google.cloud import speech
+    from fake_backends import FakeFirebaseAuth, FakeGenaiClient, FakeSpeechAsyncClient, FakeStorageClient
+
+    speech.SpeechAsyncClient = functools.partial(
+        FakeSpeechAsyncClient, latency=options["speech_latency"], utterance_seconds=options["utterance_seconds"]
+    )
+    google.genai.Client = functools.partial(
+        FakeGenaiClient, latency=options["gemini_latency"], jitter=options["gemini_jitter"]
+    )
+    # The fake clients need no credentials; skip Application Default Credentials discovery.
+    google.auth.default = lambda *args, **kwargs: (None, None)
+    fake_auth = FakeFirebaseAuth(latency=options["auth_latency"])
+    firebase_admin.auth.verify_id_token = fake_auth.verify_id_token
+
+    import gcs_utils
+    import uvicorn
+    from answer_cache import answer_cache
+    from executors import executor_stats
+    from main import app
+    from websocket_handlers import active_sessions
+
+    gcs_utils._client = FakeStorageClient(latency=options["gcs_latency"])
+    monitor = LoopLagMonitor()
+
+    @app.get("/benchmark/stats")
+    async def benchmark_stats(reset: bool = False):
+        return {
+            "wall_seconds": time.monotonic(),
+            "cpu_seconds": time.process_time(),
+            "rss_bytes": _rss_bytes(),
+            "sessions": len(active_sessions),
+            "loop_lag": monitor.snapshot(reset),
+            "upload_worker": gcs_utils.upload_worker.stats(),
+            "executors": executor_stats(),
+            "answer_cache": answer_cache.stats() if answer_cache else None,
+        }
+
+    # Ahead of the catch-all static mount.
+    app.router.routes.insert(0, app.router.routes.pop())
+
+    async def run():
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+        monitor.start()
+        await server.serve()
+
+    asyncio.run(run())
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _get_json(url):
+    request = urllib.request.Request(url, headers={"Cookie": f"token={BENCHMARK_TOKEN}"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)
+
+async def server_stats(base_url, reset: bool = False):
+    return await asyncio.to_thread(_get_json, f"{base_url}/benchmark/stats?reset={str(reset).lower()}")
+
+async def wait_until_ready(base_url, process, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await server_stats(base_url)
+        except OSError:
+            if not process.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("Benchmark server did not start.")
+            await asyncio.sleep(0.2)
+
+
+def load_pcm(path: str):
+    """Reads 16 kHz mono LINEAR16 audio from a .wav file or a headerless .raw/.pcm file."""
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as f:
+            if f.getframerate() != SPEECH_API_SAMPLE_RATE or f.getnchannels() != 1 or f.getsampwidth() != 2:
+                raise ValueError(f"{path} must be {SPEECH_API_SAMPLE_RATE} Hz mono 16-bit PCM")
+            return f.readframes(f.getnframes())
+    with open(path, "rb") as f:
+        return f.read()
+
+def synthesize_pcm(seconds: float, seed: int = 0):
+    """Speech-like audio: 2.5 s noisy voiced bursts separated by 0.5 s of near silence."""
+    rng = np.random.default_rng(seed)
+    n = int(seconds * SPEECH_API_SAMPLE_RATE)
+    t = np.arange(n) / SPEECH_API_SAMPLE_RATE
+    voiced = (t % 3.0) < 2.5
+    envelope = 0.5 + 0.5 * np.abs(np.sin(2 * np.pi * 3 * t))
+    signal = np.where(voiced, 0.1 * envelope * np.sin(2 * np.pi * 180 * t) + 0.02 * rng.standard_normal(n),
+                      0.0005 * rng.standard_normal(n))
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16).tobytes()
+
+
+class SessionResult:
+    def __init__(self):
+        self.latencies = []
+        self.transcripts = 0
+        self.interims = 0
+        self.insights = 0
+        self.unanswered = 0
+        self.pauses = 0
+        self.connect_seconds = None
+        self.error = None
+
+
+async def run_session(index: int, ws_url: str, pcm: bytes, duration: float, speed: float,
+                      frame_ms: int, drain: float):
+    """One simulated browser: streams `duration` seconds of audio, then waits `drain` seconds for results."""
+    import websockets
+
+    result = SessionResult()
+    frame_bytes = BYTES_PER_SECOND * frame_ms // 1000
+    frames = int(duration * 1000 / frame_ms)
+    interval = frame_ms / 1000 / speed
+    # Finals still waiting for their first insight, by arrival time.
+    waiting = []
+    paused = asyncio.Event()
+    paused.set()
+
+    async def receive(ws):
+        async for text in ws:
+            message = json.loads(text)
+            response_type = message.get("response_type")
+            now = time.perf_counter()
+            if response_type == "TRANSCRIPT":
+                result.transcripts += 1
+                waiting.append(now)
+            elif response_type == "INTERIM":
+                result.interims += 1
+            elif response_type in INSIGHT_TYPES:
+                result.insights += 1
+                result.latencies.extend(now - t for t in waiting)
+                waiting.clear()
+            elif response_type == "STATUS":
+                # Gemini answered the batch without a tool call.
+                result.unanswered += len(waiting)
+                waiting.clear()
+            elif response_type == "PAUSE":
+                result.pauses += 1
+                paused.clear()
+            elif response_type == "RESUME":
+                paused.set()
+
+    started = time.perf_counter()
+    try:
+        async with websockets.connect(f"{ws_url}?token={BENCHMARK_TOKEN}-{index}", max_size=None) as ws:
+            result.connect_seconds = time.perf_counter() - started
+            receiver = asyncio.create_task(receive(ws))
+            loop = asyncio.get_running_loop()
+            t0 = loop.time()
+            for i in range(frames):
+                offset = (i * frame_bytes) % max(len(pcm) - frame_bytes, 1)
+                await paused.wait()
+                await ws.send(pcm[offset:offset + frame_bytes])
+                # Sleep to an absolute schedule so send overhead does not slow the stream down.
+                delay = t0 + (i + 1) * interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await asyncio.sleep(drain)
+            receiver.cancel()
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.unanswered += len(waiting)
+    return result
+
+async def run_benchmark(args):
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    options = {
+        "speech_latency": args.speech_latency,
+        "gemini_latency": args.gemini_latency,
+        "gemini_jitter": args.gemini_jitter,
+        "auth_latency": args.auth_latency,
+        "gcs_latency": args.gcs_latency,
+        "utterance_seconds": args.utterance_seconds,
+    }
+    pcm = load_pcm(args.pcm) if args.pcm else synthesize_pcm(max(args.duration, 30))
+
+    process = multiprocessing.get_context("spawn").Process(target=serve, args=(port, options), daemon=True)
+    process.start()
+    try:
+        await wait_until_ready(base_url, process)
+        # Let imports and the first requests settle before taking the baseline.
+        await asyncio.sleep(1)
+        baseline = await server_stats(base_url, reset=True)
+
+        peak = {"rss_bytes": baseline["rss_bytes"], "sessions": 0}
+
+        async def sample():
+            while True:
+                await asyncio.sleep(args.sample_interval)
+                stats = await server_stats(base_url)
+                if stats["sessions"] >= peak["sessions"]:
+                    peak.update(rss_bytes=max(peak["rss_bytes"], stats["rss_bytes"]), sessions=stats["sessions"])
+
+        async def delayed_session(i):
+            await asyncio.sleep(i * args.ramp / max(args.sessions, 1))
+            return await run_session(i, f"ws://127.0.0.1:{port}/ws/transcribe", pcm, args.duration,
+                                     args.speed, args.frame_ms, args.drain)
+
+        sampler = asyncio.create_task(sample())
+        started = time.perf_counter()
+        results = await asyncio.gather(*(delayed_session(i) for i in range(args.sessions)))
+        wall = time.perf_counter() - started
+        sampler.cancel()
+        final = await server_stats(base_url)
+    finally:
+        process.terminate()
+        process.join(10)
+
+    latencies = [latency for r in results for latency in r.latencies]
+    server_wall = final["wall_seconds"] - baseline["wall_seconds"]
+    errors = [r.error for r in results if r.error]
+    return {
+        "name": args.name,
+        "created_at": datetime.now().isoformat(),
+        "commit": _git_commit(),
+        "config": {
+            "sessions": args.sessions,
+            "duration": args.duration,
+            "speed": args.speed,
+            "frame_ms": args.frame_ms,
+            "ramp": args.ramp,
+            "pcm": args.pcm or "synthesized",
+            **options,
+        },
+        "summary": {
+            "wall_seconds": wall,
+            "sessions_failed": len(errors),
+            "errors": sorted(set(errors))[:10],
+            "peak_sessions": peak["sessions"],
+            "transcripts": sum(r.transcripts for r in results),
+            "interims": sum(r.interims for r in results),
+            "insights": sum(r.insights for r in results),
+            "unanswered_transcripts": sum(r.unanswered for r in results),
+            "pauses": sum(r.pauses for r in results),
+            "final_to_first_insight": distribution(latencies),
+            "connect_seconds": distribution([r.connect_seconds for r in results if r.connect_seconds is not None]),
+            "loop_lag": final["loop_lag"],
+            "rss_baseline_bytes": baseline["rss_bytes"],
+            "rss_peak_bytes": peak["rss_bytes"],
+            "memory_per_session_bytes": (peak["rss_bytes"] - baseline["rss_bytes"]) / peak["sessions"]
+                                        if peak["sessions"] else None,
+            "cpu_seconds": final["cpu_seconds"] - baseline["cpu_seconds"],
+            "cpu_utilization": (final["cpu_seconds"] - baseline["cpu_seconds"]) / server_wall if server_wall else 0.0,
+            "upload_worker": final["upload_worker"],
+            "executors": final["executors"],
+        },
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def format_history(runs):
+    lines = [f"{'created_at':<20}{'name':<16}{'commit':<10}{'sessions':>9}{'speed':>7}"
+             f"{'p50 s':>8}{'p99 s':>8}{'lag p99':>9}{'MB/sess':>9}{'cpu':>7}{'failed':>8}"]
+    for run in runs:
+        config, summary = run["config"], run["summary"]
+        per_session = summary["memory_per_session_bytes"]
+        lines.append(
+            f"{run['created_at'][:19]:<20}{(run['name'] or '')[:15]:<16}{(run['commit'] or '-'):<10}"
+            f"{config['sessions']:>9}{config['speed']:>7g}"
+            f"{summary['final_to_first_insight']['p50']:>8.3f}{summary['final_to_first_insight']['p99']:>8.3f}"
+            f"{summary['loop_lag']['p99']:>9.4f}"
+            f"{(per_session / 2**20 if per_session is not None else 0):>9.2f}"
+            f"{summary['cpu_utilization']:>7.0%}{summary['sessions_failed']:>8}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test /ws/transcribe against fake backends.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="run a benchmark and append it to the results file")
+    run.add_argument("--name", default="", help="label for this run")
+    run.add_argument("--sessions", type=int, default=10, help="concurrent simulated browser sessions")
+    run.add_argument("--duration", type=float, default=30.0, help="seconds of audio each session streams")
+    run.add_argument("--speed", type=float, default=1.0, help="streaming rate as a multiple of real time")
+    run.add_argument("--ramp", type=float, default=5.0, help="seconds over which sessions are started")
+    run.add_argument("--drain", type=float, default=5.0, help="seconds to wait for results after the audio ends")
+    run.add_argument("--frame-ms", type=int, default=100, help="audio per WebSocket message, as the AudioWorklet sends")
+    run.add_argument("--pcm", help="16 kHz mono LINEAR16 .wav or .raw file (default: synthesized audio)")
+    run.add_argument("--utterance-seconds", type=float, default=3.0, help="audio per fake final transcript")
+    run.add_argument("--speech-latency", type=float, default=0.1)
+    run.add_argument("--gemini-latency", type=float, default=1.0)
+    run.add_argument("--gemini-jitter", type=float, default=0.5)
+    run.add_argument("--auth-latency", type=float, default=0.05)
+    run.add_argument("--gcs-latency", type=float, default=0.1)
+    run.add_argument("--sample-interval", type=float, default=1.0, help="seconds between server stats samples")
+    run.add_argument("--results", default=RESULTS_PATH, help="JSON Lines file the run is appended to")
+
+    history = subparsers.add_parser("history", help="show stored runs")
+    history.add_argument("--results", default=RESULTS_PATH)
+    history.add_argument("--last", type=int, default=20, help="number of most recent runs to show")
+
+    args = parser.parse_args()
+    if args.command == "history":
+        print(format_history(load_results(args.results)[-args.last:]))
+        return
+
+    report = asyncio.run(run_benchmark(args))
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(report) + "\n")
+    print(json.dumps(report["summary"], indent=2))
+    print(format_history(load_results(args.results)[-5:]))
+
+if __name__ == "__main__":
+    main()
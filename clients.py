@@ -0,0 +1,99 @@
+"""Process-wide API clients, created once and shared by every session.
+
+The Gemini client used to be built per WebSocket connection and the
+Speech-to-Text client per recognition stream, so every call paid again for
+credential discovery and a fresh connection. Both are now created on first
+use and reused: the sessions' Gemini requests share one connection pool, and
+their recognition streams are multiplexed over one gRPC channel. The Cloud
+Storage client (`gcs_utils.get_gcs_client`) and the Firebase app
+(`auth.init_firebase`) are created lazily in the same way.
+
+`warm_up` runs in the background once the server is up. It creates every client
+and opens its connections, so the first user does not wait for them, then logs
+the startup report (see startup.py).
+"""
+import asyncio
+import threading
+
+import google.genai as genai
+
+import startup
+from auth import init_firebase
+from config import logger, GEMINI_API_KEY, STARTUP_WARMUP_TIMEOUT_SECONDS
+from executors import auth_executor, storage_executor
+from gcs_utils import get_gcs_client
+from gemini_utils import GEMINI_MODEL
+
+_genai_client = None
+_genai_lock = threading.Lock()
+# (loop, task creating the client on that loop)
+_speech = None
+
+
+def get_genai_client():
+    """Returns the process-wide Gemini client, creating it on first use."""
+    global _genai_client
+    if _genai_client is None:
+        with _genai_lock:
+            if _genai_client is None:
+                if not GEMINI_API_KEY:
+                    raise ValueError("GEMINI_API_KEY not found in .env file")
+                _genai_client = genai.Client()
+    return _genai_client
+
+async def _create_speech_client():
+    import google.auth
+    from google.cloud import speech
+
+    # Credential discovery can block on the metadata server, so it runs off the loop.
+    credentials, _ = await storage_executor.run(google.auth.default)
+    return speech.SpeechAsyncClient(credentials=credentials)
+
+async def get_speech_client():
+    """Returns the Speech-to-Text client, creating it on first use.
+
+    The client's gRPC channel belongs to the loop it was created on, so a new
+    loop (e.g. a second `asyncio.run`) gets a new client. Concurrent first
+    callers share one creation, and a failed creation is retried by the next.
+    """
+    global _speech
+    loop = asyncio.get_running_loop()
+    if _speech is None or _speech[0] is not loop or (_speech[1].done() and (_speech[1].cancelled() or _speech[1].exception())):
+        _speech = (loop, loop.create_task(_create_speech_client()))
+    # Shielded, so a caller that is cancelled does not cancel the creation for the others.
+    return await asyncio.shield(_speech[1])
+
+
+async def _warm_gemini():
+    # Resolves the model and leaves a connection open in the client's pool.
+    await get_genai_client().aio.models.get(model=GEMINI_MODEL)
+
+async def _warm_speech():
+    client = await get_speech_client()
+    await client.transport.grpc_channel.channel_ready()
+
+async def _warm_storage():
+    await storage_executor.run(get_gcs_client)
+
+async def _warm_firebase():
+    await auth_executor.run(init_firebase)
+
+async def warm_up(timeout: float = STARTUP_WARMUP_TIMEOUT_SECONDS):
+    """Creates every client and opens its connections, concurrently, then logs the startup report.
+
+    Failures are logged, not raised; the first session that needs the client tries again.
+    """
+    async def step(name, warm):
+        try:
+            with startup.phase(f"warm-up {name}"):
+                await asyncio.wait_for(warm(), timeout)
+        except Exception as e:
+            logger.warning(f"Warm-up of the {name} client failed: {e!r}")
+
+    await asyncio.gather(
+        step("gemini", _warm_gemini),
+        step("speech", _warm_speech),
+        step("storage", _warm_storage),
+        step("firebase", _warm_firebase),
+    )
+    startup.log_report()
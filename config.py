@@ -4,12 +4,158 @@ from dotenv import load_dotenv
 
 # --- Environment and API Key Configuration ---
 load_dotenv()
+# Checked when the Gemini client is created (see clients.py), not at import, so tools that never call Gemini run without it.
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY not found in .env file")
 
 # --- Logging and Constants ---
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 SPEECH_API_SAMPLE_RATE = 16000
+# Speech-to-Text streams are capped at ~305 s; rotate to a fresh stream before that.
 STREAM_LIMIT_SECONDS = 290
+# Recent audio replayed into the next stream on rotation so boundary words are not lost.
+STREAM_OVERLAP_SECONDS = float(os.getenv("STREAM_OVERLAP_SECONDS", "1.5"))
+# A failed stream is reopened after a backoff that doubles from the first to the second value with every
+# consecutive failure; after STREAM_MAX_FAILURES failures in a row the channel stops transcribing.
+STREAM_RETRY_BASE_SECONDS = float(os.getenv("STREAM_RETRY_BASE_SECONDS", "0.5"))
+STREAM_RETRY_MAX_SECONDS = float(os.getenv("STREAM_RETRY_MAX_SECONDS", "8"))
+STREAM_MAX_FAILURES = int(os.getenv("STREAM_MAX_FAILURES", "5"))
+
+# --- Audio Pipeline ---
+# Upper bound for one StreamingRecognizeRequest when queued chunks are coalesced (200 ms).
+AUDIO_PACKET_MAX_BYTES = int(os.getenv("AUDIO_PACKET_MAX_BYTES", str(SPEECH_API_SAMPLE_RATE * 2 // 5)))
+# Per-session audio budget between the WebSocket and Speech-to-Text (10 s of audio).
+AUDIO_BUFFER_MAX_BYTES = int(os.getenv("AUDIO_BUFFER_MAX_BYTES", str(SPEECH_API_SAMPLE_RATE * 2 * 10)))
+# What to do when the budget is exceeded: "drop_oldest", "drop_silence" or "pause".
+AUDIO_OVERFLOW_POLICY = os.getenv("AUDIO_OVERFLOW_POLICY", "drop_oldest")
+# Log a warning when this much audio is queued ahead of Speech-to-Text.
+AUDIO_LAG_WARNING_SECONDS = float(os.getenv("AUDIO_LAG_WARNING_SECONDS", "3"))
+
+# --- Speakers ---
+# Label finals with Speech-to-Text speaker diarization ("Speaker 2", or "Customer 2" on the tab channel).
+# Never applied to the CE's microphone channel, which has one speaker.
+SPEECH_DIARIZATION = os.getenv("SPEECH_DIARIZATION", "false").lower() == "true"
+SPEECH_DIARIZATION_MAX_SPEAKERS = int(os.getenv("SPEECH_DIARIZATION_MAX_SPEAKERS", "6"))
+
+# --- Voice Activity Detection ---
+VAD_ENABLED = os.getenv("VAD_ENABLED", "true").lower() == "true"
+# Chunks whose loudest 10 ms window stays below this level are treated as silence.
+VAD_THRESHOLD_DBFS = float(os.getenv("VAD_THRESHOLD_DBFS", "-50"))
+VAD_HANGOVER_SECONDS = float(os.getenv("VAD_HANGOVER_SECONDS", "0.3"))
+VAD_PREROLL_SECONDS = float(os.getenv("VAD_PREROLL_SECONDS", "0.2"))
+# One silent chunk is still forwarded this often so the speech stream stays alive.
+VAD_KEEPALIVE_SECONDS = float(os.getenv("VAD_KEEPALIVE_SECONDS", "1.0"))
+
+# --- Static Assets ---
+# The only directory whose files are served over HTTP.
+STATIC_DIR = os.getenv("STATIC_DIR", "static")
+# Cache lifetime of versioned (`?v=<hash>`) asset URLs.
+STATIC_MAX_AGE_SECONDS = int(os.getenv("STATIC_MAX_AGE_SECONDS", str(365 * 24 * 3600)))
+
+# --- Authentication ---
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", "1024"))
+
+# --- Gemini ---
+# Default for sessions that do not pass `?stream=` on the WebSocket URL.
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "true").lower() == "true"
+# Final transcripts arriving within this window are merged into one Gemini request.
+GEMINI_BATCH_WINDOW_SECONDS = float(os.getenv("GEMINI_BATCH_WINDOW_SECONDS", "0.5"))
+GEMINI_BATCH_MAX_UTTERANCES = int(os.getenv("GEMINI_BATCH_MAX_UTTERANCES", "5"))
+# The CE's own finals never trigger a request; up to this many ride along with the next customer final as context.
+GEMINI_CONTEXT_ONLY_MAX_UTTERANCES = int(os.getenv("GEMINI_CONTEXT_ONLY_MAX_UTTERANCES", "20"))
+
+# --- Conversation Context ---
+# Approximate token budget for the history resent to Gemini on every call.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+# Number of most recent exchanges that are always kept verbatim.
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+# How earlier model turns are sent: "raw" replays them, "summary" sends the session's "already covered" list instead.
+CONTEXT_MODEL_TURNS = os.getenv("CONTEXT_MODEL_TURNS", "raw")
+# FACT/TIP messages this similar (character trigram Jaccard) to one the session already sent are not sent again,
+# unless their numbers differ ("500 TB" vs "50 TB", "Postgres 12" vs "Postgres 15").
+INSIGHT_DEDUP_ENABLED = os.getenv("INSIGHT_DEDUP_ENABLED", "true").lower() == "true"
+INSIGHT_DEDUP_FACT_SIMILARITY = float(os.getenv("INSIGHT_DEDUP_FACT_SIMILARITY", "0.7"))
+INSIGHT_DEDUP_TIP_SIMILARITY = float(os.getenv("INSIGHT_DEDUP_TIP_SIMILARITY", "0.6"))
+INSIGHT_INDEX_MAX_ITEMS = int(os.getenv("INSIGHT_INDEX_MAX_ITEMS", "200"))
+
+# --- Answer Cache ---
+# Answers to product questions asked before (by any session on this worker) are sent at once, then refined or
+# retracted by the live call. Questions that refer back into the call ("does that work for us?") are never cached.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Also match differently worded questions by embedding similarity; costs one embedding request per question.
+ANSWER_CACHE_EMBEDDINGS = os.getenv("ANSWER_CACHE_EMBEDDINGS", "false").lower() == "true"
+ANSWER_CACHE_EMBEDDING_MODEL = os.getenv("ANSWER_CACHE_EMBEDDING_MODEL", "text-embedding-004")
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.92"))
+
+# --- Cloud Storage ---
+# Checkpoint chunk and conversation document encoding: "json" (JSON Lines) or "gzip" (gzip-encoded JSON Lines).
+GCS_UPLOAD_FORMAT = os.getenv("GCS_UPLOAD_FORMAT", "json")
+GCS_UPLOAD_QUEUE_SIZE = int(os.getenv("GCS_UPLOAD_QUEUE_SIZE", "100"))
+GCS_UPLOAD_WORKERS = int(os.getenv("GCS_UPLOAD_WORKERS", "2"))
+GCS_UPLOAD_MAX_ATTEMPTS = int(os.getenv("GCS_UPLOAD_MAX_ATTEMPTS", "4"))
+# How long shutdown waits for queued uploads to finish.
+GCS_FLUSH_TIMEOUT_SECONDS = float(os.getenv("GCS_FLUSH_TIMEOUT_SECONDS", "20"))
+# Live sessions are checkpointed every N seconds or every N final transcripts, whichever comes first.
+CHECKPOINT_INTERVAL_SECONDS = float(os.getenv("CHECKPOINT_INTERVAL_SECONDS", "30"))
+CHECKPOINT_MAX_SEGMENTS = int(os.getenv("CHECKPOINT_MAX_SEGMENTS", "20"))
+
+# --- Conversation Archive ---
+# Local search index over the conversations in GCS_BUCKET_NAME.
+ARCHIVE_INDEX_PATH = os.getenv("ARCHIVE_INDEX_PATH", "archive.db")
+# How often the bucket is checked for conversations the index has not seen; 0 disables the periodic check.
+ARCHIVE_INGEST_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INGEST_INTERVAL_SECONDS", "900"))
+# Ingestion only lists documents of sessions started at most this long before the last complete run; older ones no
+# longer change, since a session can only be resumed (and append to its document) while its saved state lives.
+ARCHIVE_INGEST_LOOKBACK_SECONDS = float(os.getenv("ARCHIVE_INGEST_LOOKBACK_SECONDS", str(2 * 24 * 3600)))
+ARCHIVE_PAGE_SIZE = int(os.getenv("ARCHIVE_PAGE_SIZE", "20"))
+# Comma-separated emails that may search every user's conversations and see every live session in /sessions/stats;
+# everyone else only sees their own.
+ARCHIVE_ADMIN_EMAILS = {email.strip().lower() for email in os.getenv("ARCHIVE_ADMIN_EMAILS", "").split(",") if email.strip()}
+ARCHIVE_MAX_PAGE_SIZE = int(os.getenv("ARCHIVE_MAX_PAGE_SIZE", "100"))
+
+# --- Session State ---
+# Where live session state is kept so a session can resume on another worker: "memory", "file" or "sqlite".
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "sessions.db" if SESSION_STORE == "sqlite" else "sessions")
+SESSION_STATE_TTL_SECONDS = float(os.getenv("SESSION_STATE_TTL_SECONDS", str(24 * 3600)))
+SESSION_SAVE_INTERVAL_SECONDS = float(os.getenv("SESSION_SAVE_INTERVAL_SECONDS", "5"))
+# How long a session waits for the client to reconnect after its WebSocket drops.
+SESSION_RESUME_GRACE_SECONDS = float(os.getenv("SESSION_RESUME_GRACE_SECONDS", "120"))
+# Recent events kept per session and replayed to a client that reconnects.
+SESSION_REPLAY_MAX_EVENTS = int(os.getenv("SESSION_REPLAY_MAX_EVENTS", "500"))
+
+# --- WebSocket Delivery ---
+# Interim transcripts are coalesced to at most this many per second per session; 0 sends every one.
+INTERIM_MAX_RATE_HZ = float(os.getenv("INTERIM_MAX_RATE_HZ", "10"))
+# Messages waiting for a slow client; beyond this the connection is closed so the client reconnects and catches up.
+WS_SEND_QUEUE_MAX_MESSAGES = int(os.getenv("WS_SEND_QUEUE_MAX_MESSAGES", "1000"))
+
+# --- Metrics ---
+# Directory shared by the server's workers. When set, /metrics and /sessions/stats report every worker, not just
+# the one answering; each worker publishes its numbers there every METRICS_PUBLISH_INTERVAL_SECONDS.
+METRICS_SHARED_DIR = os.getenv("METRICS_SHARED_DIR", "")
+METRICS_PUBLISH_INTERVAL_SECONDS = float(os.getenv("METRICS_PUBLISH_INTERVAL_SECONDS", "5"))
+
+# --- Executors ---
+# Thread pools for blocking SDK calls: workers, and calls allowed to wait beyond them before new ones are rejected.
+AUTH_EXECUTOR_WORKERS = int(os.getenv("AUTH_EXECUTOR_WORKERS", "4"))
+AUTH_EXECUTOR_QUEUE = int(os.getenv("AUTH_EXECUTOR_QUEUE", "64"))
+STORAGE_EXECUTOR_WORKERS = int(os.getenv("STORAGE_EXECUTOR_WORKERS", "8"))
+STORAGE_EXECUTOR_QUEUE = int(os.getenv("STORAGE_EXECUTOR_QUEUE", "256"))
+LLM_EXECUTOR_WORKERS = int(os.getenv("LLM_EXECUTOR_WORKERS", "16"))
+LLM_EXECUTOR_QUEUE = int(os.getenv("LLM_EXECUTOR_QUEUE", "64"))
+# Debug only: log any callback that holds the event loop longer than the threshold.
+LOOP_BLOCK_DETECTOR = os.getenv("LOOP_BLOCK_DETECTOR", "false").lower() == "true"
+LOOP_BLOCK_THRESHOLD_SECONDS = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", "0.1"))
+
+# --- Startup ---
+# Create every API client and open its connections in the background as soon as the server starts.
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() == "true"
+# Per client; a slow warm-up is abandoned and the first session creates the client instead.
+STARTUP_WARMUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_WARMUP_TIMEOUT_SECONDS", "10"))
+
+# --- Replay ---
+# Maximum number of conversations replayed at once (also the cap for /replay/run requests).
+REPLAY_CONCURRENCY = int(os.getenv("REPLAY_CONCURRENCY", "4"))
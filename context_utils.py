@@ -0,0 +1,219 @@
+import asyncio
+import json
+
+from google.genai import types
+
+from config import logger, CONTEXT_TOKEN_BUDGET, CONTEXT_RECENT_TURNS, CONTEXT_MODEL_TURNS
+from insight_index import InsightIndex
+
+# Rough size of a token in characters; good enough for budgeting, not billing.
+CHARS_PER_TOKEN = 4
+# Cap on each digest section so the digest itself stays bounded on very long calls.
+DIGEST_MAX_ITEMS = 40
+DIGEST_MAX_TRANSCRIPT_CHARS = 2000
+# After compacting, aim below the budget so we do not compact again on the next turn.
+COMPACT_TARGET_RATIO = 0.75
+
+
+def estimate_tokens(content):
+    """Approximates the token count of a history entry (dict or types.Content)."""
+    parts = content.get('parts', []) if isinstance(content, dict) else (content.parts or [])
+    chars = 0
+    for part in parts:
+        if isinstance(part, dict):
+            chars += len(part.get('text') or '')
+        elif getattr(part, 'function_call', None):
+            chars += len(part.function_call.name or '') + len(json.dumps(part.function_call.args or {}))
+        elif getattr(part, 'text', None):
+            chars += len(part.text)
+    return chars // CHARS_PER_TOKEN + 1
+
+
+def _content_to_dict(content):
+    if content is None or isinstance(content, dict):
+        return content
+    return content.model_dump(mode="json", exclude_none=True)
+
+
+class ConversationContext:
+    """Bounded Gemini history for one session.
+
+    Keeps the system prompt, the most recent exchanges verbatim, and a running
+    digest of older exchanges: what the customer said plus the facts, tips and
+    answers already emitted. Compaction runs as a background task so it never
+    delays the request that triggered it.
+
+    `insights` indexes every FACT/TIP/ANSWER sent, to drop repeats before they
+    are sent. With `model_turns="summary"`, its "already covered" list is sent
+    in place of the recent model turns.
+    """
+
+    def __init__(self, system_prompt: str, token_budget: int = CONTEXT_TOKEN_BUDGET, recent_turns: int = CONTEXT_RECENT_TURNS,
+                 model_turns: str = CONTEXT_MODEL_TURNS):
+        if model_turns not in ("raw", "summary"):
+            raise ValueError(f"Unknown model turns mode: {model_turns}")
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.model_turns = model_turns
+        self.insights = InsightIndex()
+        self._covered_tokens = 0
+        self._preamble = [
+            {'role': 'user', 'parts': [{'text': system_prompt}]},
+            {'role': 'model', 'parts': [{'text': "Understood. I am ready to assist."}]},
+        ]
+        self._preamble_tokens = sum(estimate_tokens(c) for c in self._preamble)
+        self._exchanges = []
+        self._digest = {"transcript": "", "facts": [], "tips": [], "answers": []}
+        self._digest_tokens = 0
+        self._compact_task = None
+        self.compacted_turns = 0
+        # Bumped on every change, so callers can tell whether the state needs saving.
+        self.revision = 0
+
+    def add_user_turn(self, transcript: str):
+        content = {'role': 'user', 'parts': [{'text': transcript}]}
+        self._exchanges.append({
+            "transcript": transcript,
+            "user": content,
+            "model": None,
+            "messages": [],
+            "tokens": estimate_tokens(content),
+        })
+        self.revision += 1
+        self.maybe_compact()
+
+    def add_model_turn(self, content):
+        exchange = self._exchanges[-1]
+        exchange["model"] = content
+        if self.model_turns == "raw":
+            exchange["tokens"] += estimate_tokens(content)
+        self.revision += 1
+        self.maybe_compact()
+
+    def record(self, message):
+        """Remembers a FACT/TIP/ANSWER sent for the current exchange, for the digest."""
+        if self._exchanges:
+            self._exchanges[-1]["messages"].append(message)
+            self.revision += 1
+        if self.model_turns == "summary":
+            self._covered_tokens = len(self.insights.summary(DIGEST_MAX_ITEMS)) // CHARS_PER_TOKEN + 1
+
+    def contents(self):
+        """Returns the history to send to Gemini."""
+        contents = list(self._preamble)
+        if self._digest_tokens:
+            contents.append({'role': 'user', 'parts': [{'text': self._render_digest()}]})
+            contents.append({'role': 'model', 'parts': [{'text': "Understood. I will not repeat these."}]})
+        if self.model_turns == "raw":
+            for exchange in self._exchanges:
+                contents.append(exchange["user"])
+                if exchange["model"] is not None:
+                    contents.append(exchange["model"])
+            return contents
+
+        # Earlier transcripts only; what the model did with them is in the summary.
+        for exchange in self._exchanges[:-1]:
+            contents.append(exchange["user"])
+        covered = self.insights.summary(DIGEST_MAX_ITEMS)
+        if covered:
+            contents.append({'role': 'user', 'parts': [{'text': covered}]})
+            contents.append({'role': 'model', 'parts': [{'text': "Understood. I will not repeat these."}]})
+        if self._exchanges:
+            contents.append(self._exchanges[-1]["user"])
+        return contents
+
+    def total_tokens(self):
+        return (self._preamble_tokens + self._digest_tokens + self._covered_tokens
+                + sum(e["tokens"] for e in self._exchanges))
+
+    def maybe_compact(self):
+        """Schedules background compaction if the history is over budget."""
+        if self.total_tokens() <= self.token_budget or len(self._exchanges) <= max(self.recent_turns, 1):
+            return
+        if self._compact_task and not self._compact_task.done():
+            return
+        self._compact_task = asyncio.create_task(self._compact())
+
+    async def _compact(self):
+        target = self.token_budget * COMPACT_TARGET_RATIO
+        folded = 0
+        # Fold oldest first; the newest exchange (possibly still in flight) is never folded.
+        while self.total_tokens() > target and len(self._exchanges) > max(self.recent_turns, 1):
+            self._fold(self._exchanges.pop(0))
+            folded += 1
+            # Yield between exchanges so compaction never holds the loop for long.
+            await asyncio.sleep(0)
+        self.compacted_turns += folded
+        self.revision += 1
+        logger.info(f"Compacted {folded} turns into the context digest ({self.total_tokens()} tokens).")
+
+    def to_state(self):
+        """A JSON-serializable copy of the history (without the system prompt), for `restore`."""
+        return {
+            "exchanges": [
+                {
+                    **exchange,
+                    "model": _content_to_dict(exchange["model"]),
+                    "messages": list(exchange["messages"]),
+                }
+                for exchange in self._exchanges
+            ],
+            "digest": {key: list(value) if isinstance(value, list) else value for key, value in self._digest.items()},
+            "compacted_turns": self.compacted_turns,
+            "insights": self.insights.to_state(),
+        }
+
+    def restore(self, state):
+        """Replaces the history with one saved by `to_state`, e.g. by another worker."""
+        self._exchanges = [
+            {**exchange, "model": types.Content.model_validate(exchange["model"]) if exchange["model"] else None}
+            for exchange in state["exchanges"]
+        ]
+        self._digest = state["digest"]
+        self._digest_tokens = len(self._render_digest()) // CHARS_PER_TOKEN + 1 if state["compacted_turns"] else 0
+        self.compacted_turns = state["compacted_turns"]
+        if state.get("insights"):
+            self.insights.restore(state["insights"])
+            if self.model_turns == "summary":
+                self._covered_tokens = len(self.insights.summary(DIGEST_MAX_ITEMS)) // CHARS_PER_TOKEN + 1
+        self.revision += 1
+        self.maybe_compact()
+
+    def _fold(self, exchange):
+        digest = self._digest
+        transcript = f"{digest['transcript']} {exchange['transcript']}".strip()
+        digest["transcript"] = transcript[-DIGEST_MAX_TRANSCRIPT_CHARS:]
+        for message in exchange["messages"]:
+            payload = message["payload"]
+            if message["response_type"] == "FACT":
+                fact = payload["fact"]
+                if payload.get("gcp_service"):
+                    fact = f"{fact} (-> {payload['gcp_service']})"
+                item = f"[{payload.get('category', 'other')}] {fact}"
+                section = digest["facts"]
+            elif message["response_type"] == "TIP":
+                item, section = payload["short"], digest["tips"]
+            elif message["response_type"] == "ANSWER":
+                item, section = f"{payload['question']}: {payload['short']}", digest["answers"]
+            else:
+                continue
+            if item not in section:
+                section.append(item)
+                del section[:-DIGEST_MAX_ITEMS]
+        self._digest_tokens = len(self._render_digest()) // CHARS_PER_TOKEN + 1
+
+    def _render_digest(self):
+        digest = self._digest
+        lines = ["Summary of the earlier part of this call (older turns were compacted)."]
+        if digest["transcript"]:
+            lines.append(f"Customer said earlier: {digest['transcript']}")
+        if self.model_turns == "summary":
+            # The "already covered" summary lists these for the whole call.
+            return "\n".join(lines)
+        for title, key in (("Facts already extracted", "facts"),
+                           ("Tips already provided", "tips"),
+                           ("Questions already answered", "answers")):
+            if digest[key]:
+                lines.append(f"{title}:")
+                lines.extend(f"- {item}" for item in digest[key])
+        return "\n".join(lines)
@@ -0,0 +1,296 @@
+"""Offline evaluation and regression harness for prompt and model changes.
+
+Replays every conversation in a corpus directory through `send_to_gemini` and
+records, per customer utterance (the CE's lines go along with the next one, as
+in a live session), the end-to-end latency, the time to the first tool call,
+the tool calls made by type and the token usage. The results are written as a
+JSON report, and two reports can be diffed to compare configurations.
+
+Usage:
+    python evaluate.py run corpus/ --name baseline --out reports/baseline.json
+    python evaluate.py run corpus/ --name new-prompt --prompt-file prompt.txt --out reports/new.json
+    python evaluate.py run corpus/ --name offline --fake --out reports/offline.json
+    python evaluate.py diff reports/baseline.json reports/new.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import time
+from collections import Counter
+from datetime import datetime
+from types import SimpleNamespace
+
+import google.genai as genai
+
+from config import GEMINI_STREAMING
+from context_utils import ConversationContext
+from fake_backends import FakeGenaiClient
+from gemini_utils import GEMINI_MODEL, SYSTEM_PROMPT, send_to_gemini
+from replay import load_conversation, TriggerBuffer
+
+TOOL_RESPONSE_TYPES = ("FACT", "TIP", "ANSWER")
+TOKEN_FIELDS = ("prompt_token_count", "candidates_token_count", "total_token_count")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of `values` (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def distribution(values):
+    return {
+        "count": len(values),
+        "mean": statistics.fmean(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+class RateLimiter:
+    """Token bucket shared by all workers: at most `rate` requests per second, bursting to `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class MeteredClient:
+    """Wraps a genai client (real or fake) and adds up the token usage of its responses."""
+
+    def __init__(self, client):
+        self._client = client
+        self.usage = Counter()
+        self.models = SimpleNamespace(generate_content=self._generate_content)
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content_stream=self._generate_content_stream))
+
+    def _record(self, usage_metadata):
+        if usage_metadata is None:
+            return
+        for field in TOKEN_FIELDS:
+            self.usage[field] += getattr(usage_metadata, field, None) or 0
+
+    def _generate_content(self, **kwargs):
+        response = self._client.models.generate_content(**kwargs)
+        self._record(response.usage_metadata)
+        return response
+
+    async def _generate_content_stream(self, **kwargs):
+        stream = await self._client.aio.models.generate_content_stream(**kwargs)
+
+        async def metered():
+            usage_metadata = None
+            async for chunk in stream:
+                # Usage is cumulative; the last chunk that carries it has the totals.
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                yield chunk
+            self._record(usage_metadata)
+
+        return metered()
+
+
+class EventCollector:
+    """Stands in for the WebSocket and records the messages of one utterance."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_event_latency = None
+        self.response_types = Counter()
+
+    async def send_text(self, text: str):
+        message = json.loads(text)
+        if message["response_type"] in TOOL_RESPONSE_TYPES:
+            if self.first_event_latency is None:
+                self.first_event_latency = time.perf_counter() - self.started
+            self.response_types[message["response_type"]] += 1
+
+
+async def evaluate_conversation(path, client, limiter: RateLimiter, system_prompt: str, model: str, stream: bool):
+    conversation = await load_conversation(path)
+    if not conversation:
+        return {"conversation": path, "error": "Conversation not found", "utterances": []}
+
+    context = ConversationContext(system_prompt)
+    metered = MeteredClient(client)
+    triggers = TriggerBuffer()
+    utterances = []
+    for index, text in enumerate(conversation.get("transcript", [])):
+        trigger = triggers.add(text)
+        if trigger is None:
+            continue
+        await limiter.acquire()
+        metered.usage.clear()
+        sink = EventCollector()
+        await send_to_gemini(sink, metered, context, trigger, stream, model, cache=None)
+        utterances.append({
+            "index": index,
+            "latency": time.perf_counter() - sink.started,
+            "first_event_latency": sink.first_event_latency,
+            "tool_calls": dict(sink.response_types),
+            "tokens": dict(metered.usage),
+        })
+    return {"conversation": path, "utterances": utterances}
+
+def summarize(conversations):
+    utterances = [u for c in conversations for u in c["utterances"]]
+    tool_calls = Counter()
+    calls_per_utterance = Counter()
+    tokens = Counter()
+    for utterance in utterances:
+        tool_calls.update(utterance["tool_calls"])
+        calls_per_utterance[sum(utterance["tool_calls"].values())] += 1
+        tokens.update(utterance["tokens"])
+    return {
+        "conversations": len(conversations),
+        "utterances": len(utterances),
+        "errors": sum(1 for c in conversations if c.get("error")),
+        "latency": distribution([u["latency"] for u in utterances]),
+        "first_event_latency": distribution([u["first_event_latency"] for u in utterances
+                                             if u["first_event_latency"] is not None]),
+        "tool_calls": {t: tool_calls[t] for t in TOOL_RESPONSE_TYPES},
+        "tool_calls_per_utterance": {str(k): v for k, v in sorted(calls_per_utterance.items())},
+        "tokens": {field: tokens[field] for field in TOKEN_FIELDS},
+    }
+
+async def run_corpus(corpus_dir, client, name: str, model: str = GEMINI_MODEL, system_prompt: str = SYSTEM_PROMPT,
+                     stream: bool = GEMINI_STREAMING, concurrency: int = 4, rps: float = 0.0):
+    """Evaluates every .json/.jsonl conversation in `corpus_dir` and returns the report."""
+    paths = sorted(
+        os.path.join(corpus_dir, f) for f in os.listdir(corpus_dir) if f.endswith((".json", ".jsonl"))
+    )
+    limiter = RateLimiter(rps, burst=max(1, concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(path):
+        async with semaphore:
+            return await evaluate_conversation(path, client, limiter, system_prompt, model, stream)
+
+    started = time.perf_counter()
+    conversations = await asyncio.gather(*(worker(path) for path in paths))
+    return {
+        "config": {
+            "name": name,
+            "model": model,
+            "stream": stream,
+            "backend": type(client).__name__,
+            "system_prompt_chars": len(system_prompt),
+            "concurrency": concurrency,
+            "rps": rps,
+            "corpus": corpus_dir,
+            "created_at": datetime.now().isoformat(),
+            "wall_seconds": time.perf_counter() - started,
+        },
+        "summary": summarize(conversations),
+        "conversations": conversations,
+    }
+
+def _delta(a, b):
+    return {"a": a, "b": b, "delta": b - a, "ratio": (b / a) if a else None}
+
+def diff_reports(a, b):
+    """Compares two reports: latency and token distributions, tool-call mix and per-utterance agreement."""
+    sa, sb = a["summary"], b["summary"]
+    diff = {
+        "a": a["config"]["name"],
+        "b": b["config"]["name"],
+        "latency": {k: _delta(sa["latency"][k], sb["latency"][k]) for k in ("mean", "p50", "p90", "p99")},
+        "first_event_latency": {k: _delta(sa["first_event_latency"][k], sb["first_event_latency"][k])
+                                for k in ("mean", "p50", "p90", "p99")},
+        "tool_calls": {t: _delta(sa["tool_calls"].get(t, 0), sb["tool_calls"].get(t, 0)) for t in TOOL_RESPONSE_TYPES},
+        "tokens": {f: _delta(sa["tokens"].get(f, 0), sb["tokens"].get(f, 0)) for f in TOKEN_FIELDS},
+        "tool_calls_per_utterance": {
+            k: _delta(sa["tool_calls_per_utterance"].get(k, 0), sb["tool_calls_per_utterance"].get(k, 0))
+            for k in sorted(set(sa["tool_calls_per_utterance"]) | set(sb["tool_calls_per_utterance"]), key=int)
+        },
+    }
+
+    # Share of utterances, present in both runs, whose tool-call mix is identical.
+    calls_a = {(c["conversation"], u["index"]): u["tool_calls"] for c in a["conversations"] for u in c["utterances"]}
+    calls_b = {(c["conversation"], u["index"]): u["tool_calls"] for c in b["conversations"] for u in c["utterances"]}
+    shared = calls_a.keys() & calls_b.keys()
+    same = sum(1 for key in shared if calls_a[key] == calls_b[key])
+    diff["agreement"] = {"utterances": len(shared), "identical_tool_calls": same,
+                         "ratio": same / len(shared) if shared else None}
+    return diff
+
+def format_diff(diff):
+    lines = [f"{'metric':<40}{diff['a']:>14}{diff['b']:>14}{'delta':>12}"]
+    for section in ("latency", "first_event_latency", "tool_calls", "tokens", "tool_calls_per_utterance"):
+        for key, d in diff[section].items():
+            lines.append(f"{section + '.' + key:<40}{d['a']:>14.3f}{d['b']:>14.3f}{d['delta']:>+12.3f}")
+    agreement = diff["agreement"]
+    if agreement["ratio"] is not None:
+        lines.append(f"identical tool calls: {agreement['identical_tool_calls']}/{agreement['utterances']} "
+                     f"({agreement['ratio']:.1%})")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate prompts and models over a conversation corpus.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="evaluate a corpus and write a report")
+    run.add_argument("corpus", help="directory of conversation .json/.jsonl files")
+    run.add_argument("--name", required=True, help="label for this configuration")
+    run.add_argument("--out", required=True, help="path of the JSON report to write")
+    run.add_argument("--model", default=GEMINI_MODEL)
+    run.add_argument("--prompt-file", help="system prompt to use instead of gemini_utils.SYSTEM_PROMPT")
+    run.add_argument("--stream", action=argparse.BooleanOptionalAction, default=GEMINI_STREAMING)
+    run.add_argument("--concurrency", type=int, default=4)
+    run.add_argument("--rps", type=float, default=0.0, help="max Gemini requests per second (0 = unlimited)")
+    run.add_argument("--fake", action="store_true", help="use the deterministic local model; no network")
+    run.add_argument("--fake-latency", type=float, default=0.0, help="seconds added to each fake request")
+
+    diff = subparsers.add_parser("diff", help="compare two reports")
+    diff.add_argument("a")
+    diff.add_argument("b")
+    diff.add_argument("--json", action="store_true", help="print the diff as JSON")
+
+    args = parser.parse_args()
+    if args.command == "diff":
+        with open(args.a) as fa, open(args.b) as fb:
+            result = diff_reports(json.load(fa), json.load(fb))
+        print(json.dumps(result, indent=2) if args.json else format_diff(result))
+        return
+
+    system_prompt = SYSTEM_PROMPT
+    if args.prompt_file:
+        with open(args.prompt_file) as f:
+            system_prompt = f.read()
+    if args.fake:
+        client = FakeGenaiClient(latency=args.fake_latency)
+    else:
+        client = genai.Client()
+
+    report = asyncio.run(run_corpus(args.corpus, client, args.name, args.model, system_prompt,
+                                    args.stream, args.concurrency, args.rps))
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["summary"], indent=2))
+
+if __name__ == "__main__":
+    main()
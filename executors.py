@@ -0,0 +1,131 @@
+"""Bounded thread pools for the blocking SDK calls, and a debug-mode loop-blocking detector.
+
+Blocking work (Firebase token verification, Cloud Storage requests, the
+non-streaming Gemini call) must never run on the event loop, where one slow call
+stalls every live session on the worker. Each kind of work gets its own sized
+pool, so a burst of slow GCS uploads cannot starve token verification, and each
+pool has a queue limit: once `workers + max_queue` calls are in flight, new calls
+fail fast with `ExecutorSaturatedError` instead of piling up without bound.
+"""
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    logger,
+    AUTH_EXECUTOR_WORKERS,
+    AUTH_EXECUTOR_QUEUE,
+    STORAGE_EXECUTOR_WORKERS,
+    STORAGE_EXECUTOR_QUEUE,
+    LLM_EXECUTOR_WORKERS,
+    LLM_EXECUTOR_QUEUE,
+)
+from metrics import EXECUTOR_INFLIGHT, EXECUTOR_REJECTED, EXECUTOR_RUN_SECONDS, EXECUTOR_WAIT_SECONDS
+
+
+class ExecutorSaturatedError(RuntimeError):
+    """Raised when a pool already has its maximum number of calls running and queued."""
+
+
+class BoundedExecutor:
+    """A named thread pool with a cap on queued calls and saturation metrics."""
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = None
+        self._inflight = 0
+        # Counters
+        self.completed = 0
+        self.rejected = 0
+        self.peak_inflight = 0
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.name}-executor")
+        return self._pool
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` in the pool, like `asyncio.to_thread`.
+
+        Metrics are recorded on the event loop thread only; the worker thread just
+        notes when it picked the call up.
+        """
+        if self._inflight >= self.workers + self.max_queue:
+            self.rejected += 1
+            EXECUTOR_REJECTED.labels(self.name).inc()
+            raise ExecutorSaturatedError(
+                f"{self.name} executor saturated: {self._inflight} calls in flight ({self.workers} workers)"
+            )
+
+        self._inflight += 1
+        self.peak_inflight = max(self.peak_inflight, self._inflight)
+        EXECUTOR_INFLIGHT.labels(self.name).inc()
+        submitted = time.perf_counter()
+        started = []
+
+        def call():
+            started.append(time.perf_counter())
+            return fn(*args, **kwargs)
+
+        context = contextvars.copy_context()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._get_pool(), functools.partial(context.run, call)
+            )
+        finally:
+            self._inflight -= 1
+            self.completed += 1
+            EXECUTOR_INFLIGHT.labels(self.name).dec()
+            if started:
+                EXECUTOR_WAIT_SECONDS.labels(self.name).observe(started[0] - submitted)
+                EXECUTOR_RUN_SECONDS.labels(self.name).observe(time.perf_counter() - started[0])
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "inflight": self._inflight,
+            "queued": max(0, self._inflight - self.workers),
+            "peak_inflight": self.peak_inflight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+# Firebase ID token verification (fetches and caches Google's public keys).
+auth_executor = BoundedExecutor("auth", AUTH_EXECUTOR_WORKERS, AUTH_EXECUTOR_QUEUE)
+# Cloud Storage reads and writes, and other file I/O.
+storage_executor = BoundedExecutor("storage", STORAGE_EXECUTOR_WORKERS, STORAGE_EXECUTOR_QUEUE)
+# Non-streaming Gemini requests.
+llm_executor = BoundedExecutor("llm", LLM_EXECUTOR_WORKERS, LLM_EXECUTOR_QUEUE)
+
+EXECUTORS = (auth_executor, storage_executor, llm_executor)
+
+def executor_stats():
+    return {executor.name: executor.stats() for executor in EXECUTORS}
+
+def shutdown_executors():
+    for executor in EXECUTORS:
+        executor.shutdown()
+
+
+def enable_loop_block_detector(threshold: float):
+    """Logs every callback or task step that holds the running loop for more than `threshold` seconds.
+
+    Uses asyncio debug mode, which reports such callbacks through the "asyncio"
+    logger. Debug mode adds overhead to every task, so only turn it on to hunt
+    down blocking calls.
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold
+    logger.warning(f"Loop-blocking detector enabled: logging callbacks that run longer than {threshold:.3f}s.")
@@ -0,0 +1,366 @@
+"""Deterministic local stand-ins for external services, for offline evaluation and benchmarks.
+
+`FakeGenaiClient` mimics the parts of `google.genai.Client` used by
+`gemini_utils`: `models.generate_content` and `aio.models.generate_content_stream`,
+plus `aio.models.get` for the startup warm-up.
+It answers with keyword-driven tool calls, so the same transcript always produces
+the same FACT/TIP/ANSWER calls and token counts, and it needs no network access.
+
+`FakeSpeechAsyncClient`, `FakeFirebaseAuth` and `FakeStorageClient` stand in for
+Speech-to-Text, Firebase token verification and Cloud Storage in the same way.
+Every fake takes a `latency` in seconds to model the remote call.
+"""
+import asyncio
+import datetime
+import random
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from google.cloud import speech
+from google.genai import types
+
+from config import SPEECH_API_SAMPLE_RATE
+
+# Keyword -> (fact, GCP equivalent). Matched case-insensitively on word boundaries.
+INFRASTRUCTURE_KEYWORDS = {
+    "aws": ("AWS", None),
+    "azure": ("Azure", None),
+    "ec2": ("EC2", "Compute Engine"),
+    "s3": ("S3", "Cloud Storage"),
+    "rds": ("RDS", "Cloud SQL"),
+    "aurora": ("Aurora", "AlloyDB"),
+    "postgres": ("PostgreSQL", "Cloud SQL for PostgreSQL"),
+    "postgresql": ("PostgreSQL", "Cloud SQL for PostgreSQL"),
+    "mysql": ("MySQL", "Cloud SQL for MySQL"),
+    "redshift": ("Redshift", "BigQuery"),
+    "dynamodb": ("DynamoDB", "Firestore"),
+    "lambda": ("Lambda", "Cloud Run functions"),
+    "eks": ("EKS", "GKE"),
+    "kubernetes": ("Kubernetes", "GKE"),
+    "kafka": ("Kafka", "Pub/Sub"),
+    "outposts": ("AWS Outposts", "Google Distributed Cloud"),
+}
+GOAL_PATTERN = re.compile(r"\b(goal|reduce|improve|want to|looking to)\b", re.IGNORECASE)
+CONCERN_PATTERN = re.compile(r"\b(expensive|concern|concerned|problem|limit|limits|lock-in|slow)\b", re.IGNORECASE)
+QUESTION_PATTERN = re.compile(r"\?\s*$|^(what|how|why|can|does|do|is|are|which)\b", re.IGNORECASE)
+CHARS_PER_TOKEN = 4
+# What the fake recognizer "hears", in order. Every line triggers at least one tool call.
+SCRIPTED_TRANSCRIPTS = [
+    "We're currently running our entire infrastructure on AWS, and it's becoming very expensive.",
+    "Our main goal is to reduce our cloud spending by at least 30% over the next year.",
+    "We're also concerned about vendor lock-in with DynamoDB and Lambda.",
+    "How does Google's approach compare to AWS Outposts?",
+    "Our analytics run on Redshift and we want to improve query performance.",
+    "The Postgres databases on RDS are hitting storage limits.",
+    "Can we move our Kafka pipelines without rewriting the consumers?",
+    "We run about two hundred services on EKS today.",
+]
+BYTES_PER_SECOND = SPEECH_API_SAMPLE_RATE * 2
+
+
+def _text_of(content):
+    parts = content.get("parts", []) if isinstance(content, dict) else (content.parts or [])
+    texts = []
+    for part in parts:
+        text = part.get("text") if isinstance(part, dict) else getattr(part, "text", None)
+        if text:
+            texts.append(text)
+    return " ".join(texts)
+
+def _role_of(content):
+    return content.get("role") if isinstance(content, dict) else content.role
+
+def _call(name, **args):
+    return types.Part(function_call=types.FunctionCall(name=name, args=args))
+
+_SPEAKER_LABEL = re.compile(r"^(Customer|CE|Speaker)( \d+)?: ")
+
+def _customer_text(transcript: str):
+    """Drops the CE's lines from a speaker-labelled transcript, and the labels, as the prompt asks the model to."""
+    lines = transcript.split("\n")
+    if not any(_SPEAKER_LABEL.match(line) for line in lines):
+        return transcript
+    return " ".join(_SPEAKER_LABEL.sub("", line) for line in lines if not line.startswith("CE: "))
+
+def fake_tool_calls(transcript: str):
+    """The tool calls the stand-in model makes for `transcript`, in a fixed order."""
+    transcript = _customer_text(transcript)
+    parts = []
+    lowered = transcript.lower()
+    seen = set()
+    for keyword, (fact, gcp_service) in INFRASTRUCTURE_KEYWORDS.items():
+        if fact in seen or not re.search(rf"\b{re.escape(keyword)}\b", lowered):
+            continue
+        seen.add(fact)
+        args = {"fact": fact, "category": "infrastructure"}
+        if gcp_service:
+            args["gcp_service"] = gcp_service
+        parts.append(_call("extract_fact", **args))
+        if gcp_service:
+            parts.append(_call("provide_tip", short_tip=f"Position {gcp_service}",
+                               long_tip=f"### Key Talking Points\n- {gcp_service} is the managed GCP equivalent of {fact}.\n"
+                                        f"### Follow-up Questions\n- What limits are you hitting with {fact} today?"))
+    if GOAL_PATTERN.search(transcript):
+        parts.append(_call("extract_fact", fact=transcript[:40], category="goals"))
+    if CONCERN_PATTERN.search(transcript):
+        parts.append(_call("extract_fact", fact=transcript[:40], category="concerns"))
+    if QUESTION_PATTERN.search(transcript.strip()):
+        parts.append(_call("answer_question", question=transcript[:60], short_answer="See details",
+                           long_answer=f"A detailed answer to: {transcript}"))
+    return parts
+
+
+class _FakeModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, *, model, contents, config=None):
+        time.sleep(self._owner.next_latency())
+        return self._owner.respond(contents)
+
+
+class _FakeAsyncModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def get(self, *, model):
+        await asyncio.sleep(self._owner.next_latency())
+        return types.Model(name=f"models/{model}")
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        response = self._owner.respond(contents)
+        latency = self._owner.next_latency()
+
+        async def chunks():
+            parts = response.candidates[0].content.parts
+            # Spread the latency over the chunks, one tool call per chunk.
+            for i, part in enumerate(parts):
+                await asyncio.sleep(latency / len(parts))
+                chunk = types.GenerateContentResponse(
+                    candidates=[types.Candidate(content=types.Content(role="model", parts=[part]))]
+                )
+                if i == len(parts) - 1:
+                    chunk.usage_metadata = response.usage_metadata
+                yield chunk
+
+        return chunks()
+
+
+class FakeGenaiClient:
+    """Deterministic stand-in for `google.genai.Client`.
+
+    `latency` seconds (plus up to `jitter` seconds from a seeded RNG) are added to
+    every request, to model the remote call in benchmarks.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.models = _FakeModels(self)
+        self.aio = SimpleNamespace(models=_FakeAsyncModels(self))
+
+    def next_latency(self):
+        return self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def respond(self, contents):
+        self.requests += 1
+        user_turns = [c for c in contents if _role_of(c) == "user"]
+        transcript = _text_of(user_turns[-1]) if user_turns else ""
+        parts = fake_tool_calls(transcript) or [types.Part(text="")]
+        prompt_chars = sum(len(_text_of(c)) for c in contents)
+        output_chars = sum(len(str(p.function_call.args)) for p in parts if p.function_call)
+        prompt_tokens = prompt_chars // CHARS_PER_TOKEN + 1
+        output_tokens = output_chars // CHARS_PER_TOKEN + 1
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts))],
+            usage_metadata=types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=output_tokens,
+                total_token_count=prompt_tokens + output_tokens,
+            ),
+        )
+
+
+class FakeSpeechAsyncClient:
+    """Stand-in for `speech.SpeechAsyncClient` that "recognizes" SCRIPTED_TRANSCRIPTS.
+
+    Results are driven by the amount of audio received, not its content: an
+    interim result every `interim_seconds` of audio and a final every
+    `utterance_seconds`, each delayed by `latency`. Half-closing the request
+    stream flushes the utterance in progress as a final, like the real API.
+    """
+
+    def __init__(self, latency: float = 0.0, utterance_seconds: float = 3.0, interim_seconds: float = 0.5,
+                 transcripts=SCRIPTED_TRANSCRIPTS, credentials=None):
+        self.latency = latency
+        self.utterance_bytes = int(utterance_seconds * BYTES_PER_SECOND)
+        self.interim_bytes = int(interim_seconds * BYTES_PER_SECOND)
+        self.transcripts = transcripts
+        self.finals = 0
+        # Warmed up at startup like the real client's gRPC channel.
+        self.transport = SimpleNamespace(grpc_channel=SimpleNamespace(channel_ready=self._channel_ready))
+
+    async def _channel_ready(self):
+        await asyncio.sleep(self.latency)
+
+    def _response(self, text: str, is_final: bool, total_bytes: int):
+        return speech.StreamingRecognizeResponse(results=[speech.StreamingRecognitionResult(
+            alternatives=[speech.SpeechRecognitionAlternative(transcript=text)], is_final=is_final,
+            result_end_time=datetime.timedelta(seconds=total_bytes / BYTES_PER_SECOND),
+        )])
+
+    async def streaming_recognize(self, requests, **kwargs):
+        async def responses():
+            received = total = 0
+            next_interim = self.interim_bytes
+            async for request in requests:
+                if not request.audio_content:
+                    continue
+                received += len(request.audio_content)
+                total += len(request.audio_content)
+                text = self.transcripts[self.finals % len(self.transcripts)]
+                if received >= self.utterance_bytes:
+                    await asyncio.sleep(self.latency)
+                    self.finals += 1
+                    received, next_interim = 0, self.interim_bytes
+                    yield self._response(text, True, total)
+                elif received >= next_interim:
+                    next_interim += self.interim_bytes
+                    words = text.split()
+                    heard = max(1, len(words) * received // self.utterance_bytes)
+                    await asyncio.sleep(self.latency)
+                    yield self._response(" ".join(words[:heard]), False, total)
+            if received:
+                text = self.transcripts[self.finals % len(self.transcripts)]
+                await asyncio.sleep(self.latency)
+                self.finals += 1
+                yield self._response(text, True, total)
+
+        return responses()
+
+
+class FakeFirebaseAuth:
+    """Stand-in for `firebase_admin.auth`: any non-empty token is valid for an hour.
+
+    The token becomes the local part of the user's @google.com email, so each
+    simulated user can be told apart.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.verifications = 0
+
+    def verify_id_token(self, token: str, *args, **kwargs):
+        time.sleep(self.latency)
+        self.verifications += 1
+        if not token:
+            raise ValueError("Empty ID token")
+        return {"uid": token, "email": f"{token}@google.com", "exp": time.time() + 3600}
+
+
+class _FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.content_encoding = None
+        self.metadata = bucket.metadata.get(name)
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.owner.delay()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.content_type = content_type or self.content_type
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = data
+            self.bucket.metadata[self.name] = self.metadata
+            self.bucket.new_generation(self.name)
+        self.bucket.owner.uploaded_bytes += len(data)
+
+    def download_as_bytes(self, raw_download=False):
+        self.bucket.owner.delay()
+        with self.bucket.lock:
+            if self.name not in self.bucket.objects:
+                raise FileNotFoundError(f"No such object: {self.bucket.name}/{self.name}")
+            return self.bucket.objects[self.name]
+
+    def exists(self):
+        self.bucket.owner.delay()
+        with self.bucket.lock:
+            return self.name in self.bucket.objects
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode("utf-8")
+
+    def compose(self, sources, if_generation_match=None):
+        self.bucket.owner.delay()
+        with self.bucket.lock:
+            if if_generation_match is not None and self.bucket.generations.get(self.name, 0) != if_generation_match:
+                raise RuntimeError(f"Precondition failed: {self.bucket.name}/{self.name} is not at generation {if_generation_match}")
+            self.bucket.objects[self.name] = b"".join(self.bucket.objects[source.name] for source in sources)
+            self.bucket.metadata[self.name] = self.metadata
+            self.bucket.new_generation(self.name)
+
+    def delete(self):
+        self.bucket.owner.delay()
+        with self.bucket.lock:
+            if self.name not in self.bucket.objects:
+                raise FileNotFoundError(f"No such object: {self.bucket.name}/{self.name}")
+            self.bucket.objects.pop(self.name)
+            self.bucket.generations.pop(self.name, None)
+            self.bucket.metadata.pop(self.name, None)
+
+    @property
+    def generation(self):
+        return self.bucket.generations.get(self.name)
+
+
+class _FakeBucket:
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.objects = {}
+        self.generations = {}
+        self.metadata = {}
+        self._next_generation = 1
+        self.lock = threading.Lock()
+
+    def new_generation(self, name):
+        """Gives `name` a new generation number, like GCS does on every write. Call with `lock` held."""
+        self.generations[name] = self._next_generation
+        self._next_generation += 1
+
+    def blob(self, name):
+        return _FakeBlob(self, name)
+
+    def get_blob(self, name):
+        self.owner.delay()
+        with self.lock:
+            return _FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, prefix="", start_offset=""):
+        self.owner.delay()
+        with self.lock:
+            names = sorted(name for name in self.objects if name.startswith(prefix) and name >= start_offset)
+        return [_FakeBlob(self, name) for name in names]
+
+
+class FakeStorageClient:
+    """In-memory stand-in for `storage.Client`, covering the blob operations `gcs_utils` uses."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self.uploaded_bytes = 0
+        self._buckets = {}
+
+    def delay(self):
+        self.requests += 1
+        time.sleep(self.latency)
+
+    def bucket(self, name):
+        return self._buckets.setdefault(name, _FakeBucket(self, name))
@@ -1,53 +1,466 @@
+import asyncio
+import gzip
 import os
 import json
-from datetime import datetime
-from google.cloud import storage
-from config import logger
+import threading
+import time
+from datetime import datetime, timedelta
+from config import (
+    logger,
+    GCS_UPLOAD_FORMAT,
+    GCS_UPLOAD_QUEUE_SIZE,
+    GCS_UPLOAD_WORKERS,
+    GCS_UPLOAD_MAX_ATTEMPTS,
+    GCS_FLUSH_TIMEOUT_SECONDS,
+    CHECKPOINT_INTERVAL_SECONDS,
+    CHECKPOINT_MAX_SEGMENTS,
+    ARCHIVE_INGEST_INTERVAL_SECONDS,
+    ARCHIVE_INGEST_LOOKBACK_SECONDS,
+)
+from archive_index import archive_index
+from executors import storage_executor
+from metrics import GCS_UPLOAD_FAILURES, GCS_UPLOAD_QUEUE_DEPTH, GCS_UPLOAD_REJECTED, GCS_UPLOAD_SECONDS
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Object-name prefix of every archived conversation document.
+CONVERSATION_PREFIX = "conversation-"
+# Cloud Storage compose accepts at most 32 source objects per request.
+COMPOSE_MAX_SOURCES = 32
+
+_client = None
+_client_lock = threading.Lock()
+_buckets = {}
 
 def get_gcs_client():
-    try:
-        client = storage.Client()
-        return client
-    except Exception as e:
-        logger.error(f"Error creating GCS client: {e}")
-        return None
+    """Returns the process-wide storage client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                try:
+                    # Imported here, so starting the server does not wait for the storage SDK.
+                    from google.cloud import storage
+                    _client = storage.Client()
+                except Exception as e:
+                    logger.error(f"Error creating GCS client: {e}")
+                    return None
+    return _client
+
+def get_bucket(bucket_name):
+    """Returns a cached bucket handle. Unlike `client.get_bucket`, this makes no metadata request."""
+    bucket = _buckets.get(bucket_name)
+    if bucket is None:
+        client = get_gcs_client()
+        if not client:
+            return None
+        bucket = _buckets.setdefault(bucket_name, client.bucket(bucket_name))
+    return bucket
+
+def serialize_checkpoint_lines(lines, fmt: str = GCS_UPLOAD_FORMAT):
+    """Returns (body, content_encoding) of a checkpoint chunk for `fmt`: "json" (JSON Lines) or "gzip".
 
-def upload_conversation(conversation_data):
-    bucket_name = os.environ.get("GCS_BUCKET_NAME")
-    if not bucket_name:
-        logger.error("GCS_BUCKET_NAME environment variable not set.")
-        return
+    Gzip chunks are complete gzip members, so composing them yields a valid
+    multi-member gzip document.
+    """
+    body = ("\n".join(lines) + "\n").encode("utf-8")
+    if fmt == "gzip":
+        return gzip.compress(body), "gzip"
+    return body, None
 
-    client = get_gcs_client()
-    if not client:
-        return
+def _decompress(body: bytes):
+    # Handles multi-member bodies too, i.e. composed gzip chunks.
+    return gzip.decompress(body) if body[:2] == GZIP_MAGIC else body
 
+def deserialize_conversation(body: bytes):
+    body = _decompress(body)
     try:
-        bucket = client.get_bucket(bucket_name)
-        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        user_email = conversation_data.get("user", "unknown-user")
-        sanitized_email = user_email.replace("@", "_").replace(".", "_")
-        filename = f"conversation-{timestamp}-{sanitized_email}.json"
-        blob = bucket.blob(filename)
-        blob.upload_from_string(
-            json.dumps(conversation_data, indent=4),
-            content_type="application/json"
-        )
-        logger.warning(f"Conversation uploaded to gs://{bucket_name}/{filename}")
-    except Exception as e:
-        logger.error(f"Error uploading to GCS: {e}")
+        return json.loads(body)
+    except json.JSONDecodeError:
+        # Checkpointed sessions are stored as JSON Lines.
+        return parse_checkpoint_lines(body.decode("utf-8").splitlines())
 
-def download_conversation(file_uri):
-    client = get_gcs_client()
-    if not client:
-        return None
+def parse_checkpoint_lines(lines):
+    """Assembles checkpoint records (see TranscriptCheckpointer) into a conversation document."""
+    conversation = {"transcript": [], "segments": [], "insights": []}
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record["type"] == "header":
+            conversation["user"] = record.get("user")
+            conversation["session_id"] = record.get("session_id")
+            conversation["started_at"] = record.get("started_at")
+        elif record["type"] == "transcript":
+            conversation["transcript"].append(record["text"])
+            conversation["segments"].append({"text": record["text"], "ts": record["ts"]})
+        elif record["type"] == "insight":
+            conversation["insights"].append({**record["message"], "ts": record["ts"]})
+    return conversation
 
+def _download_conversation(file_uri):
     try:
         bucket_name, blob_name = file_uri.replace("gs://", "").split("/", 1)
-        bucket = client.get_bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        conversation_content = blob.download_as_text()
-        return json.loads(conversation_content)
+        bucket = get_bucket(bucket_name)
+        if not bucket:
+            return None
+        if blob_name.endswith("/"):
+            # A session prefix whose checkpoints were never compacted (e.g. after a crash).
+            lines = []
+            for blob in sorted(bucket.list_blobs(prefix=blob_name), key=lambda b: b.name):
+                if not blob.name.rsplit("/", 1)[-1].startswith("chunk-"):
+                    # e.g. what an interrupted compaction left behind.
+                    continue
+                lines.extend(_decompress(blob.download_as_bytes(raw_download=True)).decode("utf-8").splitlines())
+            return parse_checkpoint_lines(lines)
+        # raw_download keeps gzip bodies compressed; deserialize_conversation handles both.
+        return deserialize_conversation(bucket.blob(blob_name).download_as_bytes(raw_download=True))
     except Exception as e:
         logger.error(f"Error downloading from GCS: {e}")
         return None
+
+async def download_conversation(file_uri):
+    return await storage_executor.run(_download_conversation, file_uri)
+
+def write_checkpoint_chunk(bucket_name, object_name, body: bytes, content_encoding=None):
+    """Writes one checkpoint chunk. Blocking: run through `upload_worker`."""
+    blob = get_bucket(bucket_name).blob(object_name)
+    blob.content_encoding = content_encoding
+    blob.upload_from_string(body, content_type="application/x-ndjson")
+
+def compact_session(bucket_name, chunk_names, final_name, content_encoding=None):
+    """Composes a session's checkpoint chunks, in order, into its final conversation object.
+
+    The compose happens server-side, so the cost does not depend on call length. It raises
+    while chunks are still being written so that the upload worker retries it. If it gives
+    up, the chunks are left in place and can still be read through their session prefix.
+    If the final object already exists (a resumed session compacting again), the new
+    chunks are appended to it.
+
+    Retries are safe at any point. The final object records the last chunk merged
+    into it in its `compacted_through` metadata, set by the same compose that
+    merges the chunks, and chunks up to it are only deleted, never merged again.
+    That compose is conditional on the final object's generation, and more chunks
+    than one compose takes are first composed into a temporary object.
+    """
+    bucket = get_bucket(bucket_name)
+    prefix = chunk_names[0].rsplit("/", 1)[0] + "/"
+    existing = {blob.name for blob in bucket.list_blobs(prefix=prefix)}
+    final = bucket.get_blob(final_name)
+    # Chunk names sort in write order.
+    merged_through = (final.metadata or {}).get("compacted_through", "") if final else ""
+    pending = [name for name in chunk_names if name > merged_through]
+    missing = [name for name in pending if name not in existing]
+    if missing:
+        raise RuntimeError(f"{len(missing)} checkpoint chunks not written yet for {prefix}")
+
+    temporary_name = f"{prefix}compose.tmp"
+    if pending:
+        sources = [bucket.blob(name) for name in pending]
+        if len(sources) + (final is not None) > COMPOSE_MAX_SOURCES:
+            existing.add(temporary_name)
+            temporary = bucket.blob(temporary_name)
+            temporary.compose(sources[:COMPOSE_MAX_SOURCES])
+            for i in range(COMPOSE_MAX_SOURCES, len(sources), COMPOSE_MAX_SOURCES - 1):
+                temporary.compose([temporary] + sources[i:i + COMPOSE_MAX_SOURCES - 1])
+            sources = [temporary]
+        generation = final.generation if final else 0
+        final = bucket.blob(final_name)
+        final.content_type = "application/x-ndjson"
+        final.content_encoding = content_encoding
+        final.metadata = {"compacted_through": pending[-1]}
+        # Fails if another attempt got there first; the retry then finds the chunks merged.
+        final.compose(([final] if generation else []) + sources, if_generation_match=generation)
+        logger.warning(f"Conversation compacted to gs://{bucket_name}/{final_name} from {len(pending)} checkpoints")
+        index_archived(bucket_name, final_name, generation=final.generation)
+    for name in chunk_names + [temporary_name]:
+        # Anything not there was deleted by an earlier attempt.
+        if name in existing:
+            bucket.blob(name).delete()
+
+def index_archived(bucket_name, object_name, generation=None):
+    """Downloads a conversation document just composed and adds it to the archive index.
+
+    Blocking. Errors are only logged: the document is safely stored, and the next
+    ingestion run indexes it. Raising would make the upload worker redo the write.
+    """
+    uri = f"gs://{bucket_name}/{object_name}"
+    try:
+        conversation = deserialize_conversation(get_bucket(bucket_name).blob(object_name).download_as_bytes(raw_download=True))
+        archive_index.add_blocking(uri, conversation, generation)
+    except Exception as e:
+        logger.error(f"Error indexing {uri}; it will be picked up by the next ingestion: {e}")
+
+def ingest_archive_blocking(bucket_name, index=archive_index, full: bool = False,
+                            lookback: float = ARCHIVE_INGEST_LOOKBACK_SECONDS):
+    """Indexes every conversation document in the bucket that is new or changed since it was indexed.
+
+    Object names start with the session's start time, so after a complete run
+    only names from `lookback` seconds before it onward are listed; the whole
+    bucket is listed only on the first run, or with `full`. Of the listed
+    documents, only those whose generation the index has not seen are
+    downloaded, so a run over an up-to-date index reads no conversations.
+    """
+    run_started = time.time()
+    last = None if full else index.last_ingestion_blocking(bucket_name)
+    options = {}
+    if last is not None:
+        since = datetime.fromtimestamp(last) - timedelta(seconds=lookback)
+        options["start_offset"] = CONVERSATION_PREFIX + since.strftime("%Y%m%d-%H%M%S")
+    bucket = get_bucket(bucket_name)
+    blobs = {f"gs://{bucket_name}/{blob.name}": blob for blob in bucket.list_blobs(prefix=CONVERSATION_PREFIX, **options)}
+    indexed = index.generations_blocking(blobs)
+    stats = {"listed": len(blobs), "since": options.get("start_offset"), "indexed": 0, "failed": 0}
+    for uri, blob in blobs.items():
+        if uri in indexed and indexed[uri] == blob.generation and blob.generation is not None:
+            continue
+        try:
+            conversation = deserialize_conversation(blob.download_as_bytes(raw_download=True))
+            index.add_blocking(uri, conversation, blob.generation)
+            stats["indexed"] += 1
+        except Exception as e:
+            stats["failed"] += 1
+            logger.error(f"Error indexing {uri}: {e}")
+    if not stats["failed"]:
+        # Failed documents are listed again by the next run.
+        index.record_ingestion_blocking(bucket_name, run_started)
+    return stats
+
+async def run_archive_ingestion(bucket_name, interval: float = ARCHIVE_INGEST_INTERVAL_SECONDS):
+    """Ingests new conversations at startup and then every `interval` seconds, until cancelled.
+
+    Only the worker holding the index's ingestion claim ingests; the others
+    check every `interval` whether they should take over.
+    """
+    while True:
+        try:
+            if await storage_executor.run(archive_index.claim_ingestion):
+                stats = await storage_executor.run(ingest_archive_blocking, bucket_name)
+                logger.info(f"Archive ingestion: {stats}")
+        except Exception as e:
+            logger.error(f"Error ingesting conversation archive: {e}")
+        await asyncio.sleep(interval)
+
+
+class UploadWorker:
+    """Runs blocking GCS uploads in the background, off the event loop.
+
+    Jobs go into a bounded queue and are retried with exponential backoff.
+    `stop` flushes whatever is still queued before the process exits.
+    """
+
+    def __init__(self, max_queue: int = GCS_UPLOAD_QUEUE_SIZE, workers: int = GCS_UPLOAD_WORKERS,
+                 max_attempts: int = GCS_UPLOAD_MAX_ATTEMPTS):
+        self.max_queue = max_queue
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._queue = None
+        self._tasks = []
+        # Counters
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    def submit(self, fn, *args):
+        """Queues `fn(*args)` for upload. Returns False if the queue is full or the worker is not running."""
+        if self._queue is None:
+            logger.error(f"Upload worker not running; dropping {fn.__name__}.")
+            self.rejected += 1
+            GCS_UPLOAD_REJECTED.inc()
+            return False
+        try:
+            self._queue.put_nowait((fn, args))
+            return True
+        except asyncio.QueueFull:
+            logger.error(f"Upload queue full; dropping {fn.__name__}.")
+            self.rejected += 1
+            GCS_UPLOAD_REJECTED.inc()
+            return False
+
+    async def _run(self):
+        while True:
+            fn, args = await self._queue.get()
+            latency = GCS_UPLOAD_SECONDS.labels(fn.__name__)
+            try:
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        with latency.time():
+                            await storage_executor.run(fn, *args)
+                        self.completed += 1
+                        break
+                    except Exception as e:
+                        final = attempt == self.max_attempts
+                        GCS_UPLOAD_FAILURES.labels(fn.__name__, str(final).lower()).inc()
+                        if final:
+                            logger.error(f"Error uploading to GCS ({fn.__name__}), giving up: {e}")
+                            self.failed += 1
+                        else:
+                            logger.warning(f"Error uploading to GCS ({fn.__name__}), attempt {attempt}: {e}")
+                            await asyncio.sleep(2 ** (attempt - 1))
+            finally:
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = GCS_FLUSH_TIMEOUT_SECONDS):
+        """Waits up to `timeout` seconds for queued uploads, then stops the workers."""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Upload flush timed out with {self._queue.qsize()} uploads still queued.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._queue = None
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+upload_worker = UploadWorker()
+GCS_UPLOAD_QUEUE_DEPTH.function = lambda: upload_worker.stats()["queued"]
+
+
+class TranscriptCheckpointer:
+    """Keeps a session's transcript and insights and checkpoints them to GCS during the call.
+
+    Segments are buffered and written as append-only JSON Lines chunks under
+    `sessions/<session_id>/` every `interval` seconds or `max_segments` segments,
+    so each write stays small no matter how long the call runs. `close` writes
+    the last chunk and queues `compact_session`, which assembles the final
+    `conversation-*.jsonl` document. `to_state` and `restore` carry a session over
+    to another connection or worker, which keeps appending to the same document.
+    Chunks are encoded in `fmt` (see `serialize_checkpoint_lines`); a restored
+    session keeps the format it started with, so its document never mixes them.
+    """
+
+    def __init__(self, session_id: str, user_email: str, interval: float = CHECKPOINT_INTERVAL_SECONDS,
+                 max_segments: int = CHECKPOINT_MAX_SEGMENTS, worker: UploadWorker = upload_worker,
+                 fmt: str = GCS_UPLOAD_FORMAT):
+        self.session_id = session_id
+        self.format = fmt
+        self.user_email = user_email
+        self.interval = interval
+        self.max_segments = max_segments
+        self.worker = worker
+        self.bucket_name = os.environ.get("GCS_BUCKET_NAME")
+        self.transcript = []
+        self.started_at = None
+        self._lines = []
+        self._segments = 0
+        self._chunk_index = 0
+        self._chunk_names = []
+        self._task = None
+        # Bumped on every record, so callers can tell whether the state needs saving.
+        self.revision = 0
+
+    def start(self):
+        if not self.bucket_name:
+            logger.error("GCS_BUCKET_NAME environment variable not set; checkpointing disabled.")
+        if self.started_at is None:
+            self.started_at = datetime.now()
+            self._record({"type": "header", "user": self.user_email, "session_id": self.session_id,
+                          "started_at": self.started_at.isoformat()})
+        self._task = asyncio.create_task(self._run())
+
+    def add_transcript(self, text: str):
+        self.transcript.append(text)
+        self._record({"type": "transcript", "text": text, "ts": time.time()})
+        self._segments += 1
+        if self._segments >= self.max_segments:
+            self.flush()
+
+    def add_insights(self, messages):
+        now = time.time()
+        for message in messages:
+            self._record({"type": "insight", "message": message, "ts": now})
+
+    def _record(self, record):
+        self._lines.append(json.dumps(record, separators=(",", ":")))
+        self.revision += 1
+
+    def flush(self):
+        """Queues the buffered segments as the next chunk."""
+        if not self._lines or not self.bucket_name or not self.transcript:
+            return
+        object_name = f"sessions/{self.session_id}/chunk-{self._chunk_index:06d}.jsonl"
+        body, content_encoding = serialize_checkpoint_lines(self._lines, self.format)
+        self._segments = 0
+        if not self.worker.submit(write_checkpoint_chunk, self.bucket_name, object_name, body, content_encoding):
+            # Kept, so the next flush retries them together with whatever arrives meanwhile.
+            return
+        self._chunk_index += 1
+        self._chunk_names.append(object_name)
+        self._lines = []
+        self.revision += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def stop(self):
+        """Stops periodic checkpointing without writing; `start` resumes it."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def close(self):
+        """Writes the last chunk and queues compaction into the final conversation document."""
+        if self._task:
+            self._task.cancel()
+        if not self.transcript:
+            return
+        self.flush()
+        if self._lines:
+            logger.error(f"Dropping the last {len(self._lines)} checkpoint records of session {self.session_id}: "
+                         f"the upload queue is full.")
+            self._lines = []
+        if not self._chunk_names:
+            return
+        content_encoding = "gzip" if self.format == "gzip" else None
+        self.worker.submit(compact_session, self.bucket_name, list(self._chunk_names), self.final_name(), content_encoding)
+        self._chunk_names = []
+        self.revision += 1
+
+    def final_name(self):
+        """The session's conversation document.
+
+        Named after the session start and ID, so every resume appends to it and
+        two sessions of one user never share a document.
+        """
+        timestamp = (self.started_at or datetime.now()).strftime("%Y%m%d-%H%M%S")
+        sanitized_email = (self.user_email or "unknown-user").replace("@", "_").replace(".", "_")
+        return f"{CONVERSATION_PREFIX}{timestamp}-{sanitized_email}-{self.session_id}.jsonl"
+
+    def to_state(self):
+        """A JSON-serializable copy of the checkpoint, for `restore`."""
+        return {
+            "transcript": list(self.transcript),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "format": self.format,
+            "lines": list(self._lines),
+            "segments": self._segments,
+            "chunk_index": self._chunk_index,
+            "chunk_names": list(self._chunk_names),
+        }
+
+    def restore(self, state):
+        """Continues a checkpoint saved by `to_state`. Call before `start`."""
+        self.transcript = state["transcript"]
+        self.started_at = datetime.fromisoformat(state["started_at"]) if state["started_at"] else None
+        self.format = state.get("format", self.format)
+        self._lines = state["lines"]
+        self._segments = state["segments"]
+        self._chunk_index = state["chunk_index"]
+        self._chunk_names = state["chunk_names"]
+        self.revision += 1
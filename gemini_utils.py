@@ -1,104 +1,27 @@
 import asyncio
 import json
+import time
 import uuid
 from fastapi import WebSocket
 import google.genai as genai
 from google.genai import types
 
-from config import logger
-
-# --- Gemini Tool Definitions ---
-extract_fact_function = {
-    "name": "extract_fact",
-    "description": "Extract a key fact from the transcript.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "fact": {
-                "type": "string",
-                "description": "The key fact, such as a number, technology, person, or goal. Should be keywords only."
-            },
-            "category": {
-                "type": "string",
-                "description": "The category of the fact. Must be 'infrastructure' for infrastructure components (e.g., 'EC2', 'S3', 'VPC'), 'goals' for business or technical goals, 'concerns' for any stated problems or challenges, or 'other' for all other facts."
-            },
-            "gcp_service": {
-                "type": "string",
-                "description": "The equivalent GCP service for an infrastructure fact. Only provide if the category is 'infrastructure' and a clear equivalent exists."
-            }
-        },
-        "required": ["fact", "category"]
-    }
-}
-
-provide_tip_function = {
-    "name": "provide_tip",
-    "description": "Provide a proactive tip for the Customer Engineer.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "short_tip": {
-                "type": "string",
-                "description": "A short, keyword-based version of the tip."
-            },
-            "long_tip": {
-                "type": "string",
-                "description": "A longer, more detailed version of the tip."
-            }
-        },
-        "required": ["short_tip", "long_tip"]
-    }
-}
-
-answer_question_function = {
-    "name": "answer_question",
-    "description": "Answer a direct question from the customer.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "question": {
-                "type": "string",
-                "description": "A short, keyword-based summary of the customer's question."
-            },
-            "short_answer": {
-                "type": "string",
-                "description": "A short, keyword-based answer to the customer's question."
-            },
-            "long_answer": {
-                "type": "string",
-                "description": "A longer, more detailed answer to the customer's question."
-            }
-        },
-        "required": ["question", "short_answer", "long_answer"]
-    }
-}
-
-google_search_function = {
-    "name": "google_search",
-    "description": "Search Google for information.",
-    "parameters": {
-        "type": "object",
-        "properties": {
-            "query": {
-                "type": "string",
-                "description": "The search query."
-            }
-        },
-        "required": ["query"]
-    }
-}
-
-tools = types.Tool(function_declarations=[
-    extract_fact_function,
-    provide_tip_function,
-    answer_question_function,
-    google_search_function
-])
-grounding_tool = types.Tool(
-    google_search=types.GoogleSearch()
+from answer_cache import answer_cache, extract_questions
+from config import (
+    logger,
+    GEMINI_STREAMING,
+    GEMINI_BATCH_WINDOW_SECONDS,
+    GEMINI_BATCH_MAX_UTTERANCES,
+    GEMINI_CONTEXT_ONLY_MAX_UTTERANCES,
 )
+from executors import llm_executor
+from metrics import ANSWER_CACHE_SECONDS_SAVED, GEMINI_REQUESTS, GEMINI_REQUEST_SECONDS, GEMINI_TOOL_CALL_SECONDS, TOOL_CALLS
+from tool_registry import tool_registry
 
-config = types.GenerateContentConfig(tools=[tools])
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# Built once from the shared tool declarations; see tool_registry.
+config = tool_registry.generate_config
 
 
 # --- Gemini System Prompt ---
@@ -110,68 +33,338 @@ For each user transcript you receive, you must use the provided tools to respond
 Your primary goal is to help the CE. Therefore, you should always look for opportunities to `provide_tip`.
 - `answer_question`: If the customer asks a direct question, provide a short, keyword-based summary of the question, a short, keyword-based answer, and a longer but *concise* answer (3-4 sentences maximum).
 - `provide_tip`: Your main goal is to provide specific, actionable tips. A good tip helps the CE uncover more information or suggest a specific GCP service. A bad tip is generic and unhelpful. For example, do not provide tips like "clarify x" or "dive deeper into x", "examine y". If you cannot provide a specific, valuable tip, do not call this tool. For the longer version, structure your response using Markdown with two distinct sections: `### Key Talking Points` and `### Follow-up Questions`. Under `Key Talking Points`, provide a *concise* explanation (3-4 sentences or a short bulleted list). Under `Follow-up Questions`, provide a bulleted list of 1-3 specific questions the CE can ask verbatim.
-- `extract_fact`: If a key fact is mentioned (a number, technology, pethrson, or goal), categorize it as either 'infrastructure' or 'other'. If the category is 'infrastructure', provide the equivalent GCP service if one exists. Facts should be concise and to the point. For example, instead of "The entire infrastructure is on AWS", say "100% AWS". Instead of "Their application is built with React", say "React". facts should also usually trigger provide_tip
+- `extract_fact`: If a key fact is mentioned (a number, technology, person, goal, or concern), categorize it as 'infrastructure', 'goals', 'concerns' or 'other'. If the category is 'infrastructure', provide the equivalent GCP service if one exists. Facts should be concise and to the point. For example, instead of "The entire infrastructure is on AWS", say "100% AWS". Instead of "Their application is built with React", say "React". facts should also usually trigger provide_tip
 If you have no valuable information to provide, do not call any tool.
+Transcript lines may be labelled with their speaker: "Customer" lines are the customer's side of the call and "CE" lines are the Customer Engineer's own words. Use CE lines as context only: do not extract facts from them, answer them, or give tips about what the CE already said.
 
 IMPORTANT: Always consider the entire conversation history. Refer to previously extracted facts, questions asked, and tips provided to make your responses more relevant and avoid repetition. Your goal is to build a coherent understanding of the customer's needs over time.
 """
 
-async def send_to_gemini(ws: WebSocket, client, chat_history, transcript: str):
-    logger.info(f"Sending to Gemini: {transcript}")
+class CachedAnswer:
+    """Looks up a cached answer to a transcript's question and sends it while the live call runs.
 
-    try:
-        chat_history.append({'role': 'user', 'parts': [{'text': transcript}]})
+    The lookup runs alongside the Gemini request. If the live ANSWER arrives
+    first, the cached one is not sent; if it arrives after, it carries a
+    `refines` field with the cached message's ID so the browser replaces it.
+    If the call ends without an ANSWER, a RETRACT message removes the cached one.
+    """
 
-        response = await asyncio.to_thread(
-            client.models.generate_content,
-            model="gemini-2.5-flash",
-            contents=chat_history,
-            config=config,
-        )
+    def __init__(self, ws: WebSocket, cache, client, question: str):
+        self.ws = ws
+        self.cache = cache
+        self.client = client
+        self.question = question
+        self.message_id = None
+        self.sent_at = None
+        self.superseded = False
+        self.embedding = None
+        self._task = asyncio.create_task(self._serve(client))
 
-        if not response.candidates or not response.candidates[0].content.parts:
-            logger.info("Gemini returned no response, skipping.")
-            await ws.send_text(json.dumps({"response_type": "STATUS", "payload": "Gemini returned no response."}))
+    async def _serve(self, client):
+        payload, self.embedding = await self.cache.find(client, self.question)
+        if payload is None or self.superseded:
             return
+        self.message_id = str(uuid.uuid4())
+        self.sent_at = time.perf_counter()
+        logger.info(f"Sending cached answer for: {self.question}")
+        await self.ws.send_text(json.dumps({
+            "message_id": self.message_id,
+            "response_type": "ANSWER",
+            "payload": dict(payload, cached=True),
+        }))
+
+    def supersede(self):
+        """Called before a live ANSWER is sent; returns the ID of the cached message it replaces, if any.
+
+        Only the first live ANSWER replaces the cached message.
+        """
+        self.superseded = True
+        message_id, self.message_id = self.message_id, None
+        if message_id is not None:
+            ANSWER_CACHE_SECONDS_SAVED.observe(time.perf_counter() - self.sent_at)
+        return message_id
+
+    async def finish(self, messages):
+        """Stops a lookup still in flight, retracts a cached answer no live one replaced and caches the live answers."""
+        if not self._task.done():
+            self.superseded = True
+            self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error serving cached answer: {e}")
+        try:
+            if self.message_id is not None:
+                logger.info(f"Retracting cached answer for: {self.question}")
+                await self.ws.send_text(json.dumps({"response_type": "RETRACT", "payload": {"message_id": self.message_id}}))
+                self.message_id = None
+            for message in messages:
+                if message["response_type"] == "ANSWER":
+                    await self.cache.store(self.client, message["payload"], self.question, self.embedding)
+        except Exception as e:
+            logger.error(f"Error finishing cached answer: {e}")
+
+async def dispatch_parts(ws: WebSocket, parts, started: float = None, mode: str = "unary", cached: CachedAnswer = None,
+                         insights=None):
+    """Sends a message for every function call in `parts` and returns the messages sent.
 
-        function_called = False
-        for part in response.candidates[0].content.parts:
-            if hasattr(part, 'function_call') and part.function_call:
-                function_called = True
-                fc = part.function_call
-
-                message_id = str(uuid.uuid4())
-                response_type = ""
-                payload = {}
-
-                if fc.name == "extract_fact":
-                    response_type = "FACT"
-                    payload = {"fact": fc.args['fact'], "category": fc.args['category']}
-                    if 'gcp_service' in fc.args:
-                        payload['gcp_service'] = fc.args['gcp_service']
-                elif fc.name == "provide_tip":
-                    response_type = "TIP"
-                    payload = {"short": f"💡 {fc.args['short_tip']}", "long": fc.args['long_tip']}
-                elif fc.name == "answer_question":
-                    response_type = "ANSWER"
-                    payload = {"question": fc.args['question'], "short": fc.args['short_answer'], "long": fc.args['long_answer']}
-                else:
-                    logger.warning(f"Unknown function call: {fc.name}")
+    `started` is the `time.perf_counter()` at which the request was made, for the tool-call latency metric.
+    `cached` is the cached answer served for this request, which a live ANSWER refines.
+    `insights` is the session's `InsightIndex`; facts and tips it has already seen are not sent.
+    """
+    messages = []
+    for part in parts:
+        if hasattr(part, 'function_call') and part.function_call:
+            message = tool_registry.build_message(part.function_call)
+            if message is None:
+                continue
+            if cached is not None and message["response_type"] == "ANSWER":
+                refines = cached.supersede()
+                if refines:
+                    message["refines"] = refines
+            if insights is not None:
+                admitted = insights.admit(message)
+                if admitted is None:
+                    logger.info(f"Dropping repeated {message['response_type']}: {json.dumps(message['payload'])}")
                     continue
+                message = admitted
+            logger.info(f"Gemini response: {json.dumps(message)}")
+            await ws.send_text(json.dumps(message))
+            TOOL_CALLS.labels(message["response_type"]).inc()
+            if started is not None:
+                GEMINI_TOOL_CALL_SECONDS.labels(mode).observe(time.perf_counter() - started)
+            messages.append(message)
+    return messages
+
+async def generate_response(ws: WebSocket, client, contents, model: str = GEMINI_MODEL, started: float = None,
+                            cached: CachedAnswer = None, insights=None):
+    """Non-streaming path: waits for the whole candidate, then dispatches its function calls."""
+    started = started or time.perf_counter()
+    response = await llm_executor.run(
+        client.models.generate_content,
+        model=model,
+        contents=contents,
+        config=config,
+    )
+
+    if not response.candidates or not response.candidates[0].content.parts:
+        return None, []
+
+    messages = await dispatch_parts(ws, response.candidates[0].content.parts, started, "unary", cached, insights)
+    return response.candidates[0].content, messages
+
+async def stream_response(ws: WebSocket, client, contents, model: str = GEMINI_MODEL, started: float = None,
+                          cached: CachedAnswer = None, insights=None):
+    """Streaming path: dispatches each function call as soon as its chunk arrives.
+
+    Falls back to the non-streaming path if the stream fails before anything reached the browser.
+    """
+    started = started or time.perf_counter()
+    parts = []
+    messages = []
+    try:
+        stream = await client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=config,
+        )
+        async for chunk in stream:
+            if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+                continue
+            chunk_parts = chunk.candidates[0].content.parts
+            parts.extend(chunk_parts)
+            messages.extend(await dispatch_parts(ws, chunk_parts, started, "stream", cached, insights))
+    except Exception as e:
+        if messages:
+            raise
+        logger.warning(f"Gemini streaming failed, falling back to non-streaming: {e}")
+        return await generate_response(ws, client, contents, model, started, cached, insights)
+
+    if not parts:
+        return None, []
+    return types.Content(role="model", parts=parts), messages
+
+async def send_to_gemini(ws: WebSocket, client, context, transcript: str, stream: bool = GEMINI_STREAMING,
+                         model: str = GEMINI_MODEL, cache=answer_cache, questions_in: str = None):
+    """Sends a transcript to Gemini and forwards its tool calls to the client. Returns the messages sent.
 
-                message = {
-                    "message_id": message_id,
-                    "response_type": response_type,
-                    "payload": payload,
-                }
-                logger.info(f"Gemini response: {json.dumps(message)}")
-                await ws.send_text(json.dumps(message))
+    If the transcript asks one question and `cache` has an answer to it, that answer is sent while the call runs.
+    `questions_in` is the part of the transcript to look for that question in, if not all of it
+    (the customer's words, not the CE's).
+    """
+    logger.info(f"Sending to Gemini: {transcript}")
+    messages = []
+    mode = "stream" if stream else "unary"
+    outcome = "error"
+    started = time.perf_counter()
+    cached = None
+
+    try:
+        context.add_user_turn(transcript)
+        contents = context.contents()
 
-        chat_history.append(response.candidates[0].content)
+        questions = extract_questions(transcript if questions_in is None else questions_in) if cache is not None else []
+        if len(questions) == 1:
+            cached = CachedAnswer(ws, cache, client, questions[0])
 
-        if not function_called:
+        if stream:
+            content, messages = await stream_response(ws, client, contents, model, started, cached, context.insights)
+        else:
+            content, messages = await generate_response(ws, client, contents, model, started, cached, context.insights)
+        GEMINI_REQUEST_SECONDS.labels(mode).observe(time.perf_counter() - started)
+
+        if content is None:
+            outcome = "empty"
+            logger.info("Gemini returned no response, skipping.")
+            await ws.send_text(json.dumps({"response_type": "STATUS", "payload": "Gemini returned no response."}))
+            return messages
+
+        for message in messages:
+            context.record(message)
+        context.add_model_turn(content)
+
+        if not any(getattr(part, 'function_call', None) for part in content.parts):
+            outcome = "no_tool_call"
             logger.info("Gemini did not call a function.")
             await ws.send_text(json.dumps({"response_type": "STATUS", "payload": "Gemini returned no response."}))
+        else:
+            outcome = "ok"
 
     except Exception as e:
         logger.error(f"Error sending to Gemini: {e}")
+    finally:
+        GEMINI_REQUESTS.labels(mode, outcome).inc()
+        if cached is not None:
+            await cached.finish(messages)
+    return messages
+
+class GeminiScheduler:
+    """Batches a session's final transcripts into as few Gemini requests as possible.
+
+    Finals are queued by `submit` without waiting for the model, so speech
+    consumption is never blocked. A batch is sent once the oldest queued final
+    has waited `window` seconds or `max_batch` finals are queued, and at most
+    one request is in flight per session; finals arriving meanwhile are merged
+    into the next request.
+
+    Finals submitted with `triggers=False` (the CE's own words) never start a
+    request. They are sent as context with the next batch that has a final
+    that does; at most `max_context_only` of them wait, the oldest are dropped.
+    """
+
+    def __init__(self, ws: WebSocket, client, context, stream: bool = GEMINI_STREAMING,
+                 window: float = GEMINI_BATCH_WINDOW_SECONDS, max_batch: int = GEMINI_BATCH_MAX_UTTERANCES,
+                 on_messages=None, max_context_only: int = GEMINI_CONTEXT_ONLY_MAX_UTTERANCES):
+        self.ws = ws
+        self.client = client
+        self.context = context
+        self.stream = stream
+        self.window = window
+        self.max_batch = max_batch
+        self.max_context_only = max_context_only
+        # Called with the FACT/TIP/ANSWER messages produced for each batch.
+        self.on_messages = on_messages
+        # (transcript, label, enqueued_at, triggers)
+        self._pending = []
+        self._triggering = 0
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._task = None
+        # Metrics
+        self.batches = 0
+        self.utterances = 0
+        self.max_batch_size = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+        self.context_only = 0
+        self.context_only_dropped = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, transcript: str, label: str = None, triggers: bool = True):
+        """Queues a final, labelled with its speaker if known."""
+        self._pending.append((transcript, label, asyncio.get_running_loop().time(), triggers))
+        if triggers:
+            self._triggering += 1
+            self._wakeup.set()
+            return
+        self.context_only += 1
+        waiting = [entry for entry in self._pending if not entry[3]]
+        if len(waiting) > self.max_context_only:
+            self._pending.remove(waiting[0])
+            self.context_only_dropped += 1
+
+    async def close(self, drain: bool = False):
+        """Stops the scheduler. With `drain`, queued finals are sent first."""
+        self._closed = True
+        self._wakeup.set()
+        if not self._task:
+            return
+        if not drain:
+            self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._triggering:
+                if self._closed:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            first = next(enqueued_at for _, _, enqueued_at, triggers in self._pending if triggers)
+            delay = first + self.window - loop.time()
+            if delay > 0 and self._triggering < self.max_batch and not self._closed:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Up to the max_batch-th triggering final, with the context-only finals queued before it.
+            end, count = 0, 0
+            while count < self.max_batch and end < len(self._pending):
+                count += self._pending[end][3]
+                end += 1
+            batch = self._pending[:end]
+            del self._pending[:end]
+            self._triggering -= count
+            now = loop.time()
+            delays = [now - enqueued_at for _, _, enqueued_at, triggers in batch if triggers]
+            self.batches += 1
+            self.utterances += len(delays)
+            self.max_batch_size = max(self.max_batch_size, len(delays))
+            self.total_queue_delay += sum(delays)
+            self.max_queue_delay = max(self.max_queue_delay, max(delays))
+
+            if any(label for _, label, _, _ in batch):
+                # One line per final, so Gemini can tell who said what.
+                transcript = "\n".join(f"{label}: {text}" if label else text for text, label, _, _ in batch)
+            else:
+                transcript = " ".join(text for text, _, _, _ in batch)
+            questions_in = " ".join(text for text, _, _, triggers in batch if triggers)
+            messages = await send_to_gemini(self.ws, self.client, self.context, transcript, self.stream,
+                                            questions_in=questions_in)
+            if messages and self.on_messages:
+                self.on_messages(messages)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "utterances": self.utterances,
+            "pending": len(self._pending),
+            "context_only": self.context_only,
+            "context_only_dropped": self.context_only_dropped,
+            "avg_batch_size": self.utterances / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "avg_queue_delay": self.total_queue_delay / self.utterances if self.utterances else 0.0,
+            "max_queue_delay": self.max_queue_delay,
+        }
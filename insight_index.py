@@ -0,0 +1,210 @@
+"""Per-session index of the facts, tips and answers already sent, to keep repeats off the wire.
+
+Gemini is told not to repeat itself but often does: "100% AWS" arrives three
+times, or a tip comes back reworded. Every FACT and TIP is checked against the
+ones the session already sent. The check uses normalized text and the Jaccard
+similarity of character trigrams, but only between messages with the same
+numbers: "500 TB" and "50 TB", or "Postgres 12" and "Postgres 15", are
+different facts however similar they look. A repeat is dropped, unless it adds a GCP
+service the earlier fact lacked. In that case it is sent with `refines` set to
+the earlier message's ID, and the browser replaces that fact.
+
+The index also renders a short "already covered" summary, which
+`ConversationContext` can send instead of the raw model turns.
+"""
+import re
+
+from config import INSIGHT_DEDUP_ENABLED, INSIGHT_DEDUP_FACT_SIMILARITY, INSIGHT_DEDUP_TIP_SIMILARITY, INSIGHT_INDEX_MAX_ITEMS
+from metrics import DUPLICATE_INSIGHTS
+
+DEDUPLICATED_TYPES = ("FACT", "TIP")
+_NON_WORD = re.compile(r"[^a-z0-9%]+")
+_PERCENT = re.compile(r"\s*(%|\bpercent\b)")
+_THOUSANDS = re.compile(r"(?<=\d),(?=\d{3}\b)")
+# A number with an optional "v" (versions), decimals or thousands separators, and the word after it.
+_NUMBER = re.compile(r"(?<![a-z0-9.])v?(\d+(?:[.,]\d+)*)\s*(%|[a-z]+)?")
+# Units kept with their number, by canonical form; any other word after a number is ignored.
+_UNITS = {unit: canonical for canonical, units in {
+    "%": ("%", "percent", "pct"),
+    "x": ("x",),
+    "k": ("k", "thousand"),
+    "m": ("m", "mm", "million", "millions"),
+    "b": ("b", "bn", "billion", "billions"),
+    "hundred": ("hundred", "hundreds"),
+    "kb": ("kb", "kib", "kilobytes"),
+    "mb": ("mb", "mib", "megabytes"),
+    "gb": ("gb", "gib", "gigabytes"),
+    "tb": ("tb", "tib", "terabytes"),
+    "pb": ("pb", "pib", "petabytes"),
+    "ms": ("ms", "millisecond", "milliseconds"),
+    "s": ("s", "sec", "secs", "second", "seconds"),
+    "min": ("min", "mins", "minute", "minutes"),
+    "h": ("h", "hr", "hrs", "hour", "hours"),
+    "day": ("day", "days"),
+    "month": ("month", "months"),
+    "year": ("year", "years", "yr", "yrs"),
+    "gbps": ("gbps",),
+    "mbps": ("mbps",),
+    "qps": ("qps", "rps", "tps"),
+    "iops": ("iops",),
+}.items() for unit in units}
+
+
+def normalize_text(text: str):
+    # Tips are sent with a leading "💡 ", which the non-word pattern drops.
+    text = _THOUSANDS.sub("", _PERCENT.sub("%", text.lower()))
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+def numeric_tokens(text: str):
+    """The numbers in `text` with their units, sorted; messages that differ in them are never repeats.
+
+    >>> numeric_tokens("500 TB data"), numeric_tokens("50 TB data")
+    (('500 tb',), ('50 tb',))
+    >>> numeric_tokens("500 VMs"), numeric_tokens("Postgres v12.1 on 1,000 VMs, 30 percent idle")
+    (('500',), ('1000', '12.1', '30 %'))
+    """
+    tokens = []
+    for number, unit in _NUMBER.findall(text.lower()):
+        number = number.replace(",", "")
+        unit = _UNITS.get(unit)
+        tokens.append(f"{number} {unit}" if unit else number)
+    return tuple(sorted(tokens))
+
+def trigrams(text: str):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def similarity(a: set, b: set):
+    """Jaccard similarity of two trigram sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _text_of(message):
+    payload = message["payload"]
+    if message["response_type"] == "FACT":
+        return payload["fact"]
+    if message["response_type"] == "TIP":
+        return payload["short"]
+    return payload["question"]
+
+
+class InsightIndex:
+    """The FACT, TIP and ANSWER messages a session has sent, most recent last.
+
+    Keeps at most `max_items` of each type; older ones can be repeated again.
+    With `deduplicate` off, every message is admitted and only the summary is kept.
+    """
+
+    def __init__(self, deduplicate: bool = INSIGHT_DEDUP_ENABLED, fact_similarity: float = INSIGHT_DEDUP_FACT_SIMILARITY,
+                 tip_similarity: float = INSIGHT_DEDUP_TIP_SIMILARITY, max_items: int = INSIGHT_INDEX_MAX_ITEMS):
+        self.deduplicate = deduplicate
+        self.thresholds = {"FACT": fact_similarity, "TIP": tip_similarity}
+        self.max_items = max_items
+        self._items = {"FACT": [], "TIP": [], "ANSWER": []}
+        self._keys = {"FACT": {}, "TIP": {}}
+        # Counters
+        self.suppressed = 0
+        self.merged = 0
+
+    def _find(self, response_type: str, key: str, grams: set, numbers: tuple):
+        item = self._keys[response_type].get(key)
+        if item is not None:
+            return item
+        threshold = self.thresholds[response_type]
+        best, best_score = None, threshold
+        for item in self._items[response_type]:
+            if item["numbers"] != numbers:
+                continue
+            score = similarity(grams, item["grams"])
+            if score >= best_score:
+                best, best_score = item, score
+        return best
+
+    def admit(self, message):
+        """Returns `message` if it should be sent, with `refines` set if it updates an earlier fact, or None.
+
+        Admitted messages are added to the index.
+        """
+        response_type = message["response_type"]
+        if response_type not in self._items:
+            return message
+        text = _text_of(message)
+        key = normalize_text(text)
+        grams = trigrams(key)
+        numbers = numeric_tokens(text)
+        if self.deduplicate and response_type in DEDUPLICATED_TYPES:
+            earlier = self._find(response_type, key, grams, numbers)
+            if earlier is not None:
+                gcp_service = message["payload"].get("gcp_service")
+                if response_type == "FACT" and gcp_service and not earlier["message"]["payload"].get("gcp_service"):
+                    message = dict(message, refines=earlier["message"]["message_id"])
+                    self._remove(response_type, earlier)
+                    self.merged += 1
+                    DUPLICATE_INSIGHTS.labels(response_type, "merged").inc()
+                else:
+                    self.suppressed += 1
+                    DUPLICATE_INSIGHTS.labels(response_type, "suppressed").inc()
+                    return None
+        self._add(response_type, {"key": key, "grams": grams, "numbers": numbers, "message": message})
+        return message
+
+    def _add(self, response_type: str, item):
+        items = self._items[response_type]
+        items.append(item)
+        if response_type in self._keys:
+            self._keys[response_type][item["key"]] = item
+        while len(items) > self.max_items:
+            self._remove(response_type, items[0])
+
+    def _remove(self, response_type: str, item):
+        self._items[response_type].remove(item)
+        keys = self._keys.get(response_type)
+        if keys is not None and keys.get(item["key"]) is item:
+            del keys[item["key"]]
+
+    def summary(self, max_items: int):
+        """The "already covered" summary of the last `max_items` of each type, or "" if nothing was sent yet."""
+        sections = []
+        facts = []
+        for item in self._items["FACT"][-max_items:]:
+            payload = item["message"]["payload"]
+            fact = payload["fact"]
+            if payload.get("gcp_service"):
+                fact = f"{fact} (-> {payload['gcp_service']})"
+            facts.append(f"[{payload.get('category', 'other')}] {fact}")
+        tips = [item["message"]["payload"]["short"] for item in self._items["TIP"][-max_items:]]
+        answers = [f"{item['message']['payload']['question']}: {item['message']['payload']['short']}"
+                   for item in self._items["ANSWER"][-max_items:]]
+        for title, lines in (("Facts already extracted", facts),
+                             ("Tips already provided", tips),
+                             ("Questions already answered", answers)):
+            if lines:
+                sections.append(f"{title}:")
+                sections.extend(f"- {line}" for line in lines)
+        if not sections:
+            return ""
+        return "\n".join(["Already covered earlier in this call; do not repeat these:"] + sections)
+
+    def to_state(self):
+        return {response_type: [item["message"] for item in items] for response_type, items in self._items.items()}
+
+    def restore(self, state):
+        self._items = {"FACT": [], "TIP": [], "ANSWER": []}
+        self._keys = {"FACT": {}, "TIP": {}}
+        for response_type, messages in state.items():
+            for message in messages:
+                text = _text_of(message)
+                key = normalize_text(text)
+                self._add(response_type, {"key": key, "grams": trigrams(key), "numbers": numeric_tokens(text),
+                                          "message": message})
+
+    def stats(self):
+        return {
+            "facts": len(self._items["FACT"]),
+            "tips": len(self._items["TIP"]),
+            "answers": len(self._items["ANSWER"]),
+            "suppressed": self.suppressed,
+            "merged": self.merged,
+        }
@@ -1,17 +1,79 @@
+import startup
+# First, so the startup report covers every import below.
+startup.track_imports()
+
+import asyncio
+import json
+import math
 import os
-from fastapi import FastAPI, Depends, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from fastapi import FastAPI, Depends, Request, HTTPException, Query
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse, Response
 from starlette.middleware.base import BaseHTTPMiddleware
 from auth import verify_token
-from websocket_handlers import websocket_transcribe_endpoint, websocket_test_text_endpoint
-from gcs_utils import download_conversation
+from websocket_handlers import websocket_transcribe_endpoint, websocket_test_text_endpoint, session_stats
+from gcs_utils import download_conversation, upload_worker, run_archive_ingestion
+from archive_index import archive_index
+from sessions import finish_detached_sessions, WORKER_ID
+from shared_metrics import create_shared_metrics
+from replay import replay, TIMING_MODES
+from executors import storage_executor, shutdown_executors, enable_loop_block_detector
+from static_assets import static_assets
+from clients import warm_up
+from config import (
+    GEMINI_STREAMING,
+    REPLAY_CONCURRENCY,
+    LOOP_BLOCK_DETECTOR,
+    LOOP_BLOCK_THRESHOLD_SECONDS,
+    ARCHIVE_INGEST_INTERVAL_SECONDS,
+    ARCHIVE_PAGE_SIZE,
+    ARCHIVE_ADMIN_EMAILS,
+    STARTUP_WARMUP,
+)
+import metrics
+
+startup.imports_done()
+
+# None with a single worker, which reports its own numbers.
+shared_metrics = create_shared_metrics(WORKER_ID, session_stats)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if LOOP_BLOCK_DETECTOR:
+        enable_loop_block_detector(LOOP_BLOCK_THRESHOLD_SECONDS)
+    with startup.phase("static assets"):
+        await storage_executor.run(static_assets.load)
+    upload_worker.start()
+    if shared_metrics:
+        shared_metrics.start()
+    ingestion = None
+    if os.environ.get("GCS_BUCKET_NAME") and ARCHIVE_INGEST_INTERVAL_SECONDS > 0:
+        ingestion = asyncio.create_task(run_archive_ingestion(os.environ["GCS_BUCKET_NAME"]))
+    # In the background: the login page is served right away, and the clients are warm by the time a user starts a call.
+    warming = asyncio.create_task(warm_up()) if STARTUP_WARMUP else None
+    startup.ready()
+    if not warming:
+        startup.log_report()
+    yield
+    if warming:
+        warming.cancel()
+    if ingestion:
+        ingestion.cancel()
+    # Sessions waiting for a reconnect will not get one; write their last checkpoints.
+    await finish_detached_sessions()
+    # Flush conversations from sessions that ended just before shutdown.
+    await upload_worker.stop()
+    if shared_metrics:
+        await shared_metrics.stop()
+    shutdown_executors()
+
+app = FastAPI(lifespan=lifespan)
 
 class AuthMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        if request.url.path in ["/login.html", "/logo.png", "/docs", "/openapi.json", "/firebase-config", "/replay"] or request.url.path.startswith("/ws"):
+        if (request.url.path in ["/docs", "/openapi.json", "/firebase-config", "/replay", "/metrics"]
+                or request.url.path.startswith("/ws") or static_assets.is_public(request.url.path)):
             return await call_next(request)
 
         token = request.cookies.get("token")
@@ -45,27 +107,133 @@ async def replay_conversation(request: Request):
     if not file_uri:
         raise HTTPException(status_code=400, detail="file_uri is required")
     
-    conversation_data = download_conversation(file_uri)
+    conversation_data = await download_conversation(file_uri)
     if not conversation_data:
         raise HTTPException(status_code=404, detail="Conversation not found")
         
     return JSONResponse(content=conversation_data)
 
-app.add_api_websocket_route("/ws/transcribe", websocket_transcribe_endpoint)
-app.add_api_websocket_route("/ws/test_text", websocket_test_text_endpoint)
+@app.post("/replay/run")
+async def run_replay(request: Request):
+    """Replays stored conversations server-side and streams the resulting events as JSON Lines."""
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="The request body must be a JSON object")
+    sources = data.get("sources") or ([data["file_uri"]] if data.get("file_uri") else [])
+    if not sources:
+        raise HTTPException(status_code=400, detail="sources is required")
+    if not isinstance(sources, list):
+        raise HTTPException(status_code=400, detail="sources must be a list")
+    if not all(isinstance(source, str) and source.startswith("gs://") for source in sources):
+        raise HTTPException(status_code=400, detail="Only gs:// sources can be replayed through the API")
+    timing = data.get("timing", "fast")
+    if timing not in TIMING_MODES:
+        raise HTTPException(status_code=400, detail=f"timing must be one of {', '.join(TIMING_MODES)}")
+    try:
+        speed = float(data.get("speed", 1.0))
+        concurrency = int(data.get("concurrency", REPLAY_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="speed and concurrency must be numbers")
+    # Checked here: once the response has started streaming, errors can no longer become a 400.
+    if not speed > 0 or not math.isfinite(speed):
+        raise HTTPException(status_code=400, detail="speed must be greater than 0")
+    if concurrency < 1:
+        raise HTTPException(status_code=400, detail="concurrency must be at least 1")
+
+    events = replay(
+        sources,
+        timing=timing,
+        speed=speed,
+        concurrency=min(concurrency, REPLAY_CONCURRENCY),
+        stream=bool(data.get("stream", GEMINI_STREAMING)),
+    )
 
-app.mount("/", StaticFiles(directory=".", html=True), name="static")
+    async def body():
+        async for event in events:
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def _time_bound(value: str, name: str, end: bool = False):
+    """Parses an ISO date or timestamp query parameter; a date-only `end` bound covers that whole day."""
+    if not value:
+        return None
+    try:
+        bound = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO date or timestamp")
+    if end and len(value) == 10:
+        bound += timedelta(days=1)
+    return bound.isoformat(timespec="seconds")
 
+async def current_user(request: Request):
+    """The verified token of the signed-in user."""
+    return await verify_token(request.cookies.get("token"))
 
+def is_admin(caller: dict):
+    """Whether the caller may see other users' conversations and sessions."""
+    return caller["email"].lower() in ARCHIVE_ADMIN_EMAILS
 
-@app.get("/", response_class=HTMLResponse)
+@app.get("/conversations")
+async def search_conversations(user: str = None, q: str = None, gcp_service: str = None,
+                               start: str = Query(None, alias="from"), end: str = Query(None, alias="to"),
+                               page_size: int = ARCHIVE_PAGE_SIZE, page_token: str = None,
+                               caller: dict = Depends(current_user)):
+    """Lists archived conversations from the archive index, newest first.
+
+    Filters combine: `user`, `from`/`to` (ISO dates or timestamps of the call
+    start, `to` inclusive), `q` (keywords in the transcript or insights) and
+    `gcp_service`. Pass `next_page_token` back as `page_token` for the next page.
+    Each result's `uri` can be sent to /replay.
+
+    Only ARCHIVE_ADMIN_EMAILS may search other users' conversations; for
+    everyone else `user` defaults to, and must be, the caller's own email.
+    """
+    email = caller["email"]
+    if not is_admin(caller):
+        if user and user != email:
+            raise HTTPException(status_code=403, detail="You can only search your own conversations")
+        user = email
+    try:
+        return JSONResponse(await archive_index.search(
+            user=user,
+            started_from=_time_bound(start, "from"),
+            started_before=_time_bound(end, "to", end=True),
+            keyword=q,
+            gcp_service=gcp_service,
+            page_size=page_size,
+            page_token=page_token,
+        ))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/sessions/stats")
+async def get_session_stats(caller: dict = Depends(current_user)):
+    """Pipeline stats of the caller's live sessions, or of every live session for ARCHIVE_ADMIN_EMAILS."""
+    stats = await shared_metrics.session_stats() if shared_metrics else session_stats()
+    if not is_admin(caller):
+        stats = {session_id: session for session_id, session in stats.items() if session["user"] == caller["email"]}
+    return JSONResponse(stats)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus scrape endpoint; exempt from the login redirect like the other machine-facing routes."""
+    content = await shared_metrics.render() if shared_metrics else metrics.render()
+    return Response(content=content, media_type=metrics.CONTENT_TYPE)
+
+app.add_api_websocket_route("/ws/transcribe", websocket_transcribe_endpoint)
+app.add_api_websocket_route("/ws/test_text", websocket_test_text_endpoint)
+
+@app.get("/")
 async def read_root(request: Request):
     token = request.cookies.get("token")
     if not token:
         return RedirectResponse(url='/login.html')
     try:
         await verify_token(token)
-        with open("index.html") as f:
-            return HTMLResponse(content=f.read())
+        return static_assets.response(request, "index.html")
     except Exception as e:
-        return RedirectResponse(url='/login.html')
\ No newline at end of file
+        return RedirectResponse(url='/login.html')
+
+# Last, so it only gets paths no route above matched.
+app.mount("/", static_assets, name="static")
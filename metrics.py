@@ -0,0 +1,311 @@
+"""Process-wide counters, gauges and histograms, exposed at /metrics in the Prometheus text format.
+
+The metrics are plain in-memory numbers updated from the event loop thread, so
+recording one is a dict lookup and an addition; no lock or I/O happens on the
+hot path. Gauges for queue depths are computed from callbacks at scrape time
+rather than updated on every chunk.
+
+With several workers, `snapshot` captures this worker's numbers and
+`render(snapshots)` adds up every worker's; see shared_metrics.py.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+NAMESPACE = "ceassist"
+# Request latencies, from a fast token-cache verification up to a slow model call.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+def _escape(value: str):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = f"{NAMESPACE}_{name}"
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            # Export unlabelled metrics as 0 before their first update.
+            self.labels()
+        _registry.append(self)
+
+    def labels(self, *values):
+        """Returns the child for one combination of label values, creating it on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def refresh(self):
+        """Brings derived values up to date before they are read."""
+
+    def dump(self):
+        """This metric's children as JSON-serializable [label values, value] pairs."""
+        return [[list(values), self._dump_child(child)] for values, child in list(self._children.items())]
+
+    def _dump_child(self, child):
+        return child.value
+
+    def _add(self, child, value):
+        child.value += value
+
+    def merge(self, dumps):
+        """Children holding the sum of several `dump`s, e.g. one per worker."""
+        children = {}
+        for dump in dumps:
+            for values, value in dump:
+                values = tuple(values)
+                child = children.get(values)
+                if child is None:
+                    child = children[values] = self._new_child()
+                self._add(child, value)
+        return children
+
+    def render(self, children=None):
+        """This metric in the text format: this worker's children, or the given ones (see `merge`)."""
+        if children is None:
+            self.refresh()
+            children = self._children
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None, aggregate: str = "sum"):
+        super().__init__(name, documentation, labelnames)
+        # Called at scrape time for an unlabelled gauge whose value is derived from other state.
+        self.function = function
+        # How the workers' values are combined: "sum" or "max".
+        self.aggregate = aggregate
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def refresh(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception:
+                # A broken callback must not take the whole scrape down.
+                pass
+
+    def _add(self, child, value):
+        if self.aggregate == "max":
+            child.value = max(child.value, value)
+        else:
+            child.value += value
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _dump_child(self, child):
+        return [child.counts, child.sum, child.count]
+
+    def _add(self, child, value):
+        counts, total, count = value
+        for i, bucket_count in enumerate(counts):
+            child.counts[i] += bucket_count
+        child.sum += total
+        child.count += count
+
+    def _render_child(self, values, child):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, [("le", _format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+def snapshot():
+    """This worker's metrics, JSON-serializable, for `render` in another worker."""
+    result = {}
+    for metric in _registry:
+        metric.refresh()
+        result[metric.name] = metric.dump()
+    return result
+
+def render(snapshots=None):
+    """All metrics in the Prometheus text exposition format.
+
+    By default this worker's. With `snapshots`, a list of (snapshot, alive) pairs,
+    their sum: counters and histograms of every snapshot, so totals never go
+    backwards when a worker exits, and gauges of live workers only.
+    """
+    lines = []
+    for metric in _registry:
+        if snapshots is None:
+            lines.extend(metric.render())
+            continue
+        dumps = [data.get(metric.name, ()) for data, alive in snapshots if alive or metric.kind != "gauge"]
+        lines.extend(metric.render(metric.merge(dumps)))
+    return "\n".join(lines) + "\n"
+
+
+# --- Startup ---
+STARTUP_SECONDS = Gauge("startup_seconds", "Time spent starting the slowest worker, by phase (imports, initialization and client warm-up).",
+                        ["phase"], aggregate="max")
+
+# --- WebSocket sessions ---
+SESSIONS_ACTIVE = Gauge("websocket_sessions_active", "Live /ws/transcribe sessions on this worker.")
+SESSIONS_TOTAL = Counter("websocket_sessions_total", "Accepted /ws/transcribe sessions.")
+SESSIONS_DETACHED = Gauge("websocket_sessions_detached", "Sessions on this worker waiting for their client to reconnect.")
+SESSIONS_RESUMED = Counter("websocket_sessions_resumed_total", "Sessions resumed after a reconnect, by where their state came from.", ["source"])
+WS_SEND_QUEUE_DEPTH = Gauge("websocket_send_queue_depth", "Messages waiting to be written to browsers, summed over sessions.")
+WS_SEND_QUEUE_OVERFLOWS = Counter("websocket_send_queue_overflows_total", "Connections closed because the client fell too far behind.")
+INTERIMS_COALESCED = Counter("interims_coalesced_total", "Interim transcripts replaced by a newer one before they were sent.")
+SESSION_SECONDS = Histogram("websocket_session_seconds", "Duration of /ws/transcribe sessions.",
+                            buckets=(10, 30, 60, 300, 600, 1800, 3600, 7200))
+
+# --- Audio ---
+AUDIO_RECEIVED_BYTES = Counter("audio_received_bytes_total", "PCM bytes received from browsers.")
+AUDIO_FORWARDED_BYTES = Counter("audio_forwarded_bytes_total", "PCM bytes queued for Speech-to-Text after VAD.")
+AUDIO_BUFFER_SECONDS = Gauge("audio_buffer_seconds", "Audio queued ahead of Speech-to-Text, summed over sessions.")
+AUDIO_BUFFER_DROPPED_BYTES = Counter("audio_buffer_dropped_bytes_total", "PCM bytes dropped because a session's audio buffer overflowed.")
+
+# --- Speech-to-Text ---
+SPEECH_RESULTS = Counter("speech_results_total", "Speech-to-Text results received, by type.", ["type"])
+SPEECH_STREAMS = Counter("speech_streams_total", "Speech-to-Text streams opened, by reason.", ["reason"])
+SPEECH_STREAM_ERRORS = Counter("speech_stream_errors_total", "Speech-to-Text streams that failed.")
+FINAL_TRANSCRIPTS = Counter("final_transcripts_total", "Final transcripts, by speaker (customer, ce, or mixed for one-channel sessions).", ["speaker"])
+
+# --- Gemini ---
+GEMINI_PENDING_UTTERANCES = Gauge("gemini_pending_utterances", "Final transcripts waiting for a Gemini request, summed over sessions.")
+GEMINI_REQUESTS = Counter("gemini_requests_total", "Gemini requests, by mode and outcome.", ["mode", "outcome"])
+GEMINI_REQUEST_SECONDS = Histogram("gemini_request_seconds", "Gemini request latency until the response is complete.", ["mode"])
+GEMINI_TOOL_CALL_SECONDS = Histogram("gemini_tool_call_seconds", "Time from the Gemini request to each tool call reaching the browser.", ["mode"])
+TOOL_CALLS = Counter("tool_calls_total", "Tool calls forwarded to browsers, by type.", ["type"])
+INVALID_TOOL_CALLS = Counter("invalid_tool_calls_total", "Tool calls dropped, by tool and reason (unknown tool or invalid arguments).", ["tool", "reason"])
+DUPLICATE_INSIGHTS = Counter("duplicate_insights_total", "Repeated FACT/TIP tool calls, by type and whether they were suppressed or merged.", ["type", "action"])
+
+# --- Answer cache ---
+ANSWER_CACHE_REQUESTS = Counter("answer_cache_requests_total", "Answer cache lookups, by result (hit, similar or miss).", ["result"])
+ANSWER_CACHE_SECONDS_SAVED = Histogram("answer_cache_seconds_saved", "Time a cached answer reached the browser ahead of the live answer that refined it.")
+ANSWER_CACHE_SIZE = Gauge("answer_cache_size", "Answers in the cache.")
+
+# --- Cloud Storage ---
+GCS_UPLOAD_QUEUE_DEPTH = Gauge("gcs_upload_queue_depth", "Uploads waiting for the upload worker.")
+GCS_UPLOAD_SECONDS = Histogram("gcs_upload_seconds", "GCS upload latency per attempt, by operation.", ["operation"])
+GCS_UPLOAD_FAILURES = Counter("gcs_upload_failures_total", "GCS upload attempts that failed, by operation and whether they were retried.", ["operation", "final"])
+GCS_UPLOAD_REJECTED = Counter("gcs_upload_rejected_total", "Uploads dropped because the upload queue was full or stopped.")
+
+# --- Executors ---
+EXECUTOR_INFLIGHT = Gauge("executor_inflight", "Calls running or queued in each blocking-call thread pool.", ["pool"])
+EXECUTOR_REJECTED = Counter("executor_rejected_total", "Calls rejected because the pool's queue was full.", ["pool"])
+EXECUTOR_WAIT_SECONDS = Histogram("executor_wait_seconds", "Time calls waited for a free worker thread.", ["pool"])
+EXECUTOR_RUN_SECONDS = Histogram("executor_run_seconds", "Time calls ran on a worker thread.", ["pool"])
+
+# --- Authentication ---
+TOKEN_CACHE_REQUESTS = Counter("token_cache_requests_total", "Token verifications, by cache result.", ["result"])
+TOKEN_VERIFY_SECONDS = Histogram("token_verify_seconds", "Firebase ID token verification latency on a cache miss.")
+TOKEN_CACHE_SIZE = Gauge("token_cache_size", "Verified tokens in the cache.")
@@ -0,0 +1,170 @@
+"""Server-side replay of stored conversations through the Gemini pipeline.
+
+Each conversation's final transcripts are fed through `send_to_gemini` with a
+fresh `ConversationContext`, and every TRANSCRIPT, FACT, TIP and ANSWER event is
+yielded as it is produced. Several conversations can be replayed concurrently.
+
+Usage:
+    python replay.py gs://bucket/conversation-....json path/to/local.json \
+        --timing scaled --speed 4 --concurrency 4
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from clients import get_genai_client
+from config import logger, GEMINI_STREAMING, REPLAY_CONCURRENCY
+from context_utils import ConversationContext
+from executors import storage_executor
+from gcs_utils import download_conversation, deserialize_conversation
+from gemini_utils import SYSTEM_PROMPT, send_to_gemini
+from speech_utils import SPEAKER_CE, speaker_label
+
+TIMING_MODES = ("fast", "original", "scaled")
+# Spacing between utterances for documents without timestamps (what the browser replay used).
+DEFAULT_INTERVAL_SECONDS = 2.0
+# Transcripts of two-channel sessions are stored with their speaker label.
+CE_PREFIX = f"{speaker_label(SPEAKER_CE)}: "
+
+
+class EventSink:
+    """Stands in for the browser WebSocket and collects what `send_to_gemini` sends."""
+
+    def __init__(self, source: str, queue: asyncio.Queue):
+        self.source = source
+        self.queue = queue
+
+    async def send_text(self, text: str):
+        await self.emit(json.loads(text))
+
+    async def emit(self, message):
+        message["source"] = self.source
+        await self.queue.put(message)
+
+
+class TriggerBuffer:
+    """Turns stored transcript lines into Gemini triggers the way a live session does.
+
+    The CE's own words are not a trigger; they are held and go along with the
+    next customer utterance.
+    """
+
+    def __init__(self):
+        self.held = []
+
+    def add(self, text: str):
+        """Returns the text to send to Gemini for this line, or None if the line is held."""
+        if text.startswith(CE_PREFIX):
+            self.held.append(text)
+            return None
+        trigger = "\n".join(self.held + [text])
+        self.held = []
+        return trigger
+
+
+def _read_local(path):
+    with open(path, "rb") as f:
+        return deserialize_conversation(f.read())
+
+async def load_conversation(source: str):
+    """Loads a conversation from a `gs://` URI or a local file."""
+    if source.startswith("gs://"):
+        return await download_conversation(source)
+    return await storage_executor.run(_read_local, source)
+
+def utterance_offsets(conversation, timing: str = "fast", speed: float = 1.0):
+    """Returns (offset_seconds, text) for each utterance, relative to the start of the replay."""
+    if timing not in TIMING_MODES:
+        raise ValueError(f"Unknown timing mode: {timing}")
+    segments = conversation.get("segments") or [{"text": text} for text in conversation.get("transcript", [])]
+    scale = 1.0 / speed if timing == "scaled" else 1.0
+
+    offsets = []
+    first_ts = segments[0].get("ts") if segments else None
+    for i, segment in enumerate(segments):
+        if timing == "fast":
+            offset = 0.0
+        elif first_ts is not None and segment.get("ts") is not None:
+            offset = (segment["ts"] - first_ts) * scale
+        else:
+            offset = i * DEFAULT_INTERVAL_SECONDS * scale
+        offsets.append((offset, segment["text"]))
+    return offsets
+
+async def replay_conversation(source: str, queue: asyncio.Queue, client, timing: str = "fast",
+                              speed: float = 1.0, stream: bool = GEMINI_STREAMING):
+    """Replays one conversation, putting its events on `queue`."""
+    sink = EventSink(source, queue)
+    conversation = await load_conversation(source)
+    if not conversation:
+        await sink.emit({"response_type": "ERROR", "payload": "Conversation not found"})
+        return
+
+    context = ConversationContext(SYSTEM_PROMPT)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    triggers = TriggerBuffer()
+    for offset, text in utterance_offsets(conversation, timing, speed):
+        # Sleep to an absolute offset so slow model calls do not stretch the original timing.
+        delay = started + offset - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await sink.emit({"response_type": "TRANSCRIPT", "payload": text})
+        trigger = triggers.add(text)
+        if trigger is not None:
+            await send_to_gemini(sink, client, context, trigger, stream, cache=None)
+
+async def replay(sources, client=None, timing: str = "fast", speed: float = 1.0,
+                 concurrency: int = REPLAY_CONCURRENCY, stream: bool = GEMINI_STREAMING):
+    """Replays `sources` with at most `concurrency` running at once, yielding events as they arrive.
+
+    Every conversation ends with a REPLAY_DONE event (after an ERROR event if it failed).
+    """
+    if timing not in TIMING_MODES:
+        raise ValueError(f"Unknown timing mode: {timing}")
+    client = client or get_genai_client()
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(source):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                await replay_conversation(source, queue, client, timing, speed, stream)
+            except Exception as e:
+                logger.error(f"Error replaying {source}: {e}")
+                await queue.put({"source": source, "response_type": "ERROR", "payload": str(e)})
+            finally:
+                await queue.put({"source": source, "response_type": "REPLAY_DONE",
+                                 "payload": {"seconds": time.monotonic() - started}})
+
+    tasks = [asyncio.create_task(run(source)) for source in sources]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            event = await queue.get()
+            if event["response_type"] == "REPLAY_DONE":
+                remaining -= 1
+            yield event
+    finally:
+        # Stop outstanding replays if the consumer goes away early.
+        for task in tasks:
+            task.cancel()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay stored conversations through Gemini.")
+    parser.add_argument("sources", nargs="+", help="gs:// URIs or local conversation files")
+    parser.add_argument("--timing", choices=TIMING_MODES, default="fast")
+    parser.add_argument("--speed", type=float, default=1.0, help="speed-up factor for --timing scaled")
+    parser.add_argument("--concurrency", type=int, default=REPLAY_CONCURRENCY)
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=GEMINI_STREAMING)
+    args = parser.parse_args()
+
+    async for event in replay(args.sources, timing=args.timing, speed=args.speed,
+                              concurrency=args.concurrency, stream=args.stream):
+        print(json.dumps(event), flush=True)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,291 @@
+"""Pluggable storage for live session state, so a session can resume on any worker.
+
+A session's state is a JSON-serializable dict: the user, the Gemini context
+(`ConversationContext.to_state`) and the transcript checkpoint
+(`TranscriptCheckpointer.to_state`). `SessionSaver` writes it periodically while
+the session runs and once more when it ends.
+
+The state names the worker that owns the session. `save` is a compare-and-set
+on that owner: it only replaces state owned by the same worker (or expired
+state) and returns False otherwise, so a worker that lost the session to
+another cannot overwrite it. `save(..., claim=True)` takes a session over
+unconditionally; that is how a worker restoring a session claims it.
+
+Backends, selected with SESSION_STORE:
+
+- "memory": a dict in this process. Only resumable on the same worker.
+- "file": one JSON file per session under SESSION_STORE_PATH; any process that
+  shares the directory can resume the session.
+- "sqlite": one row per session in the database at SESSION_STORE_PATH; safe for
+  several workers on one node.
+
+File and SQLite access runs on the storage executor, never on the event loop.
+State older than SESSION_STATE_TTL_SECONDS is ignored and pruned.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import logger, SESSION_STORE, SESSION_STORE_PATH, SESSION_STATE_TTL_SECONDS, SESSION_SAVE_INTERVAL_SECONDS
+from executors import storage_executor
+
+# Expired state is pruned at most this often.
+PRUNE_INTERVAL_SECONDS = 60
+
+
+class MemorySessionStore:
+    """Keeps session state in this process."""
+
+    def __init__(self, ttl: float = SESSION_STATE_TTL_SECONDS):
+        self.ttl = ttl
+        self._states = {}
+
+    async def load(self, session_id: str):
+        entry = self._states.get(session_id)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            self._states.pop(session_id, None)
+            return None
+        return json.loads(entry[1])
+
+    async def save(self, session_id: str, state: dict, claim: bool = False):
+        now = time.time()
+        entry = self._states.get(session_id)
+        if not claim and entry is not None and now - entry[0] <= self.ttl and entry[2] != state.get("owner"):
+            return False
+        # Stored serialized, like the other backends, so callers cannot mutate saved state.
+        self._states[session_id] = (now, json.dumps(state), state.get("owner"))
+        for expired in [sid for sid, (saved_at, *_) in self._states.items() if now - saved_at > self.ttl]:
+            del self._states[expired]
+        return True
+
+    async def delete(self, session_id: str):
+        self._states.pop(session_id, None)
+
+
+class FileSessionStore:
+    """One JSON file per session in `directory`, replaced atomically on every save.
+
+    Saves hold an exclusive lock on `directory/.lock` from the owner check to the
+    replace, so processes sharing the directory cannot interleave them.
+    """
+
+    def __init__(self, directory: str, ttl: float = SESSION_STATE_TTL_SECONDS):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_prune = 0.0
+        self._lock_path = os.path.join(directory, ".lock")
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str):
+        # Session IDs are server-generated UUIDs; refuse anything that could escape the directory.
+        if not session_id or os.path.basename(session_id) != session_id or session_id.startswith("."):
+            raise ValueError(f"Invalid session ID: {session_id!r}")
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    def _load(self, session_id: str):
+        path = self._path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save(self, session_id: str, state: dict, claim: bool):
+        path = self._path(session_id)
+        with open(self._lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not claim:
+                current = self._load(session_id)
+                if current is not None and current.get("owner") != state.get("owner"):
+                    return False
+            temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "w") as f:
+                json.dump(state, f, separators=(",", ":"))
+            os.replace(temporary, path)
+        self._prune()
+        return True
+
+    def _prune(self):
+        now = time.time()
+        if now - self._last_prune < PRUNE_INTERVAL_SECONDS:
+            return
+        self._last_prune = now
+        for name in os.listdir(self.directory):
+            if name == ".lock":
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _delete(self, session_id: str):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    async def load(self, session_id: str):
+        return await storage_executor.run(self._load, session_id)
+
+    async def save(self, session_id: str, state: dict, claim: bool = False):
+        return await storage_executor.run(self._save, session_id, state, claim)
+
+    async def delete(self, session_id: str):
+        await storage_executor.run(self._delete, session_id)
+
+
+class SQLiteSessionStore:
+    """One row per session in an SQLite database shared by every worker on the node."""
+
+    def __init__(self, path: str, ttl: float = SESSION_STATE_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._last_prune = 0.0
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(session_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL, owner TEXT)"
+            )
+            if "owner" not in {row[1] for row in connection.execute("PRAGMA table_info(sessions)")}:
+                try:
+                    connection.execute("ALTER TABLE sessions ADD COLUMN owner TEXT")
+                except sqlite3.OperationalError:
+                    # Another worker added it first.
+                    pass
+
+    def _connect(self):
+        # One connection per executor thread; sqlite3 connections must stay on their thread.
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=10)
+        return connection
+
+    def _load(self, session_id: str):
+        row = self._connect().execute(
+            "SELECT state FROM sessions WHERE session_id = ? AND updated_at > ?", (session_id, time.time() - self.ttl)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, session_id: str, state: dict, claim: bool):
+        now = time.time()
+        upsert = (
+            "INSERT INTO sessions (session_id, state, updated_at, owner) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(session_id) DO UPDATE SET "
+            "state = excluded.state, updated_at = excluded.updated_at, owner = excluded.owner"
+        )
+        parameters = (session_id, json.dumps(state, separators=(",", ":")), now, state.get("owner"))
+        if not claim:
+            # Compare-and-set: the row is only replaced while the same worker owns it, or once it has expired.
+            # Rows saved before the owner column existed have no owner yet.
+            upsert += " WHERE sessions.owner IS excluded.owner OR sessions.owner IS NULL OR sessions.updated_at <= ?"
+            parameters += (now - self.ttl,)
+        with self._connect() as connection:
+            saved = connection.execute(upsert, parameters).rowcount > 0
+            if now - self._last_prune > PRUNE_INTERVAL_SECONDS:
+                self._last_prune = now
+                connection.execute("DELETE FROM sessions WHERE updated_at <= ?", (now - self.ttl,))
+        return saved
+
+    def _delete(self, session_id: str):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    async def load(self, session_id: str):
+        return await storage_executor.run(self._load, session_id)
+
+    async def save(self, session_id: str, state: dict, claim: bool = False):
+        return await storage_executor.run(self._save, session_id, state, claim)
+
+    async def delete(self, session_id: str):
+        await storage_executor.run(self._delete, session_id)
+
+
+def create_session_store(backend: str = SESSION_STORE, path: str = SESSION_STORE_PATH):
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "file":
+        return FileSessionStore(path)
+    if backend == "sqlite":
+        return SQLiteSessionStore(path)
+    raise ValueError(f"Unknown session store: {backend}")
+
+session_store = create_session_store()
+
+
+class SessionSaver:
+    """Saves a session's state every `interval` seconds while it changes, and once more on close.
+
+    `snapshot` returns the state to save; `revision` returns a cheap value that
+    changes whenever the state does, so idle sessions are not rewritten. Once a
+    save finds that another worker owns the session, `lost` is set and nothing
+    is saved any more.
+    """
+
+    def __init__(self, store, session_id: str, snapshot, revision, interval: float = SESSION_SAVE_INTERVAL_SECONDS):
+        self.store = store
+        self.session_id = session_id
+        self.snapshot = snapshot
+        self.revision = revision
+        self.interval = interval
+        self._saved_revision = None
+        self._task = None
+        self.lost = False
+        # Counters
+        self.saves = 0
+        self.failures = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def save(self, claim: bool = False, force: bool = False):
+        """Saves the state if it changed. Returns False if another worker owns the session.
+
+        `claim` takes the session over from whichever worker owns it. `force` saves
+        even an unchanged state, which confirms that this worker still owns it. A
+        save that fails with an error counts as still owning the session.
+        """
+        if self.lost:
+            return False
+        revision = self.revision()
+        if revision == self._saved_revision and not (claim or force):
+            return True
+        try:
+            saved = await self.store.save(self.session_id, self.snapshot(), claim=claim)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error saving state of session {self.session_id}: {e}")
+            return True
+        if not saved:
+            logger.warning(f"Session {self.session_id} is owned by another worker now; no longer saving it here.")
+            self.lost = True
+            if self._task:
+                self._task.cancel()
+                self._task = None
+            return False
+        self._saved_revision = revision
+        self.saves += 1
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save()
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        return await self.save()
@@ -0,0 +1,345 @@
+"""Transcription sessions that outlive their WebSocket, so a dropped connection can resume.
+
+When the socket drops, the session's Gemini context, transcript checkpoint and
+recent events are kept on this worker for SESSION_RESUME_GRACE_SECONDS, and
+also saved to the session store. A reconnect with the session ID reattaches to
+the live session on this worker or restores it from the store on any other, and
+the client receives the events it missed since its last event ID. Once the grace
+period passes without a reconnect, the session is finished: its last checkpoint is
+written and compacted.
+"""
+import asyncio
+import json
+import os
+import socket
+import uuid
+from collections import deque
+
+from config import logger, SESSION_REPLAY_MAX_EVENTS, INTERIM_MAX_RATE_HZ, WS_SEND_QUEUE_MAX_MESSAGES
+from context_utils import ConversationContext
+from gcs_utils import TranscriptCheckpointer
+from gemini_utils import SYSTEM_PROMPT, GeminiScheduler
+from metrics import INTERIMS_COALESCED, SESSIONS_DETACHED, SESSIONS_RESUMED, WS_SEND_QUEUE_DEPTH, WS_SEND_QUEUE_OVERFLOWS
+from session_store import session_store, SessionSaver
+
+# Recorded in saved state so a worker can tell whether another worker has taken the session over.
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Messages that only matter while they are fresh; they get no event ID and are never replayed.
+TRANSIENT_RESPONSE_TYPES = ("INTERIM", "PAUSE", "RESUME", "SESSION")
+
+# Sessions on this worker, connected or waiting for a reconnect, keyed by session ID.
+local_sessions = {}
+SESSIONS_DETACHED.function = lambda: sum(1 for s in local_sessions.values() if not s.connected)
+WS_SEND_QUEUE_DEPTH.function = lambda: sum(s.channel.queued() for s in local_sessions.values())
+
+
+class SessionChannel:
+    """Stands in for the WebSocket in the session pipeline and keeps the recent events.
+
+    Every non-transient message gets an increasing `event_id` and is kept, up to
+    `max_events`, so it can be replayed after a reconnect. While no socket is
+    attached, messages are only kept.
+
+    Sending never waits for the client: messages go into a per-connection queue
+    that a writer task drains, so a slow browser cannot stall speech recognition
+    or the Gemini calls. If the queue reaches `max_queue`, the connection is
+    closed; the client reconnects and catches up from the kept events. Interim
+    transcripts are coalesced per speaker: only the latest is sent, at most
+    `interim_rate` times a second, and a final discards its speaker's pending interim.
+    """
+
+    def __init__(self, max_events: int = SESSION_REPLAY_MAX_EVENTS, interim_rate: float = INTERIM_MAX_RATE_HZ,
+                 max_queue: int = WS_SEND_QUEUE_MAX_MESSAGES):
+        self.ws = None
+        self.last_event_id = 0
+        self.interim_interval = 1.0 / interim_rate if interim_rate > 0 else 0.0
+        self.max_queue = max_queue
+        self._events = deque(maxlen=max_events)
+        self._outbox = None
+        self._writer = None
+        # Speaker (None for a one-channel session) -> latest interim not sent yet.
+        self._interims = {}
+        self._interim_handle = None
+        self._interim_sent_at = float("-inf")
+        # Bumped on every kept event, so callers can tell whether the state needs saving.
+        self.revision = 0
+
+    def attach(self, ws):
+        self.ws = ws
+        self._outbox = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write(ws, self._outbox))
+
+    def detach(self):
+        self.ws = None
+        self._interims.clear()
+        if self._interim_handle:
+            self._interim_handle.cancel()
+            self._interim_handle = None
+        if self._writer:
+            # Anything still queued is either kept for replay or transient.
+            self._writer.cancel()
+            self._writer = None
+        self._outbox = None
+
+    def queued(self):
+        return self._outbox.qsize() if self._outbox else 0
+
+    async def _write(self, ws, outbox: asyncio.Queue):
+        while True:
+            text = await outbox.get()
+            try:
+                await ws.send_text(text)
+            except Exception as e:
+                # Kept events reach the client on reconnect.
+                logger.info(f"Dropping sends to a closed WebSocket: {e}")
+                if self.ws is ws:
+                    self.ws = None
+                return
+
+    def _enqueue(self, text: str):
+        ws = self.ws
+        if ws is None:
+            return
+        if self._outbox.qsize() >= self.max_queue:
+            logger.warning(f"Client fell {self._outbox.qsize()} messages behind; closing its connection.")
+            WS_SEND_QUEUE_OVERFLOWS.inc()
+            self.ws = None
+            asyncio.create_task(self._close(ws))
+            return
+        self._outbox.put_nowait(text)
+
+    async def _close(self, ws):
+        try:
+            # 1013 "try again later": the client reconnects and replays what it missed.
+            await ws.close(code=1013)
+        except Exception:
+            pass
+
+    async def send_text(self, text: str):
+        message = json.loads(text)
+        response_type = message.get("response_type")
+        if response_type == "TRANSCRIPT":
+            # The final replaces whatever interim of its speaker is still waiting.
+            self._interims.pop(message.get("speaker"), None)
+        if response_type not in TRANSIENT_RESPONSE_TYPES:
+            self.last_event_id += 1
+            message["event_id"] = self.last_event_id
+            text = json.dumps(message)
+            self._events.append((self.last_event_id, text))
+            self.revision += 1
+        self._enqueue(text)
+
+    def send_interim(self, transcript: str, speaker: str = None):
+        """Queues an interim transcript, coalescing it with any interim of the same speaker not sent yet."""
+        if self.ws is None:
+            return
+        if speaker in self._interims:
+            INTERIMS_COALESCED.inc()
+        self._interims[speaker] = transcript
+        if self._interim_handle is not None:
+            return
+        loop = asyncio.get_running_loop()
+        delay = self._interim_sent_at + self.interim_interval - loop.time()
+        if delay <= 0:
+            self._flush_interim()
+        else:
+            self._interim_handle = loop.call_later(delay, self._flush_interim)
+
+    def _flush_interim(self):
+        self._interim_handle = None
+        if not self._interims:
+            return
+        for speaker, transcript in self._interims.items():
+            message = {"response_type": "INTERIM", "payload": transcript}
+            if speaker:
+                message["speaker"] = speaker
+            self._enqueue(json.dumps(message))
+        self._interims.clear()
+        self._interim_sent_at = asyncio.get_running_loop().time()
+
+    def replay(self, after_event_id: int):
+        """Queues every kept event newer than `after_event_id` for the attached socket. Returns how many.
+
+        Call right after `attach`, before anything else is sent, so the client gets events in order.
+        """
+        missed = [text for event_id, text in self._events if event_id > after_event_id]
+        if self.ws is not None:
+            # Bounded by `max_events`, so a long replay does not count as falling behind.
+            for text in missed:
+                self._outbox.put_nowait(text)
+        return len(missed)
+
+    def to_state(self):
+        return {"last_event_id": self.last_event_id, "events": [list(event) for event in self._events]}
+
+    def restore(self, state):
+        self.last_event_id = state["last_event_id"]
+        self._events.extend((event_id, text) for event_id, text in state["events"])
+        self.revision += 1
+
+
+class TranscriptionSession:
+    """A transcription session's Gemini context, transcript checkpoint and event log."""
+
+    def __init__(self, session_id: str, user_email: str, client, stream: bool):
+        self.session_id = session_id
+        self.user_email = user_email
+        self.client = client
+        self.stream = stream
+        self.context = ConversationContext(SYSTEM_PROMPT)
+        self.checkpointer = TranscriptCheckpointer(session_id, user_email)
+        self.channel = SessionChannel()
+        self.saver = SessionSaver(session_store, session_id, self.snapshot, self.revision)
+        self.scheduler = None
+        self.connected = False
+        # Set when a new connection replaces the current one on this worker.
+        self.replaced = False
+        # The task handling the current connection, so a new connection can take over.
+        self.handler = None
+        self.detached = asyncio.Event()
+        # Set once a detached session's queued work is drained and its state saved.
+        self.settled = asyncio.Event()
+        self.settled.set()
+        self._linger_task = None
+
+    def snapshot(self):
+        return {
+            "user": self.user_email,
+            "owner": WORKER_ID,
+            "context": self.context.to_state(),
+            "checkpoint": self.checkpointer.to_state(),
+            "events": self.channel.to_state(),
+        }
+
+    def revision(self):
+        return self.context.revision, self.checkpointer.revision, self.channel.revision
+
+    def restore(self, state):
+        self.context.restore(state["context"])
+        self.checkpointer.restore(state["checkpoint"])
+        if state.get("events"):
+            self.channel.restore(state["events"])
+
+    def attach(self, ws):
+        """Attaches the connection handled by the current task.
+
+        Call as soon as `open_session` returns, before awaiting anything, so a
+        connection taking over always finds either the session attached or it
+        lingering, never in between.
+        """
+        self.connected = True
+        self.replaced = False
+        self.handler = asyncio.current_task()
+        self.detached.clear()
+        self.channel.attach(ws)
+        self.checkpointer.start()
+        self.saver.start()
+        self.scheduler = GeminiScheduler(self.channel, self.client, self.context, self.stream,
+                                         on_messages=self.checkpointer.add_insights)
+        self.scheduler.start()
+
+    def detach(self, grace: float):
+        """Called when the connection ends; the session waits `grace` seconds for a reconnect."""
+        self.connected = False
+        self.handler = None
+        self.channel.detach()
+        self.settled.clear()
+        self.detached.set()
+        self._linger_task = asyncio.create_task(self._linger(grace))
+
+    async def _linger(self, grace: float):
+        try:
+            # Finals already queued still get their insights; they are replayed on reconnect.
+            await self.scheduler.close(drain=True)
+            logger.info(f"Gemini scheduler stats: {self.scheduler.stats()}")
+            self.checkpointer.stop()
+            await self.saver.close()
+        finally:
+            self.settled.set()
+        await asyncio.sleep(grace)
+        await self.finish()
+
+    def cancel_linger(self):
+        if self._linger_task:
+            self._linger_task.cancel()
+            self._linger_task = None
+
+    async def take_over(self):
+        """Ends the current connection's handler, wherever it is, so a new connection can attach."""
+        self.replaced = True
+        if self.handler:
+            self.handler.cancel()
+        await self.detached.wait()
+
+    def abandon(self):
+        """Forgets a session that its connection never attached to, e.g. because the connection failed first."""
+        if not self.connected and self._linger_task is None and local_sessions.get(self.session_id) is self:
+            del local_sessions[self.session_id]
+
+    async def finish(self):
+        """Ends the session for good: writes and compacts the last checkpoint, unless another worker took it over."""
+        if local_sessions.get(self.session_id) is self:
+            del local_sessions[self.session_id]
+        # A compare-and-set save confirms this worker still owns the session before compacting it.
+        if not await self.saver.save(force=True):
+            logger.warning(f"Session {self.session_id} was resumed on another worker; not finishing it here.")
+            return
+        logger.info(f"Session {self.session_id} ended. Queueing final checkpoint and compaction.")
+        self.checkpointer.close()
+        # Saved after the final checkpoint, so a later resume continues from the compacted document.
+        await self.saver.save()
+
+
+async def load_session_state(session_id: str, user_email: str):
+    """Saved state of `session_id` if it exists and belongs to `user_email`, else None."""
+    if not session_id:
+        return None
+    try:
+        state = await session_store.load(session_id)
+    except Exception as e:
+        logger.error(f"Error loading state of session {session_id}: {e}")
+        return None
+    if state is None or state.get("user") != user_email:
+        return None
+    return state
+
+async def open_session(resume_id: str, user_email: str, client, stream: bool):
+    """Returns (session, resumed) for a new connection.
+
+    `resume_id` is reattached on this worker if the session is still here (taking
+    over its old connection if that has not noticed the drop yet), restored from
+    the session store if it is not, and otherwise a new session is started.
+    """
+    session = local_sessions.get(resume_id) if resume_id else None
+    if session is not None and session.user_email == user_email:
+        if session.connected:
+            await session.take_over()
+        await session.settled.wait()
+        # Skipped if another worker has claimed the session since; its state is restored from the store instead.
+        if local_sessions.get(resume_id) is session and not session.saver.lost:
+            session.cancel_linger()
+            SESSIONS_RESUMED.labels("worker").inc()
+            return session, True
+
+    state = await load_session_state(resume_id, user_email)
+    session = TranscriptionSession(resume_id if state else str(uuid.uuid4()), user_email, client, stream)
+    if state:
+        session.restore(state)
+        # Claim the session, so the worker it came from stops saving it and does not finish it.
+        await session.saver.save(claim=True)
+        SESSIONS_RESUMED.labels("store").inc()
+        logger.warning(f"Resumed session {session.session_id} from the session store "
+                       f"with {len(session.checkpointer.transcript)} transcripts.")
+    local_sessions[session.session_id] = session
+    return session, bool(state)
+
+async def finish_detached_sessions():
+    """Finishes every session still waiting for a reconnect; called on shutdown."""
+    for session in list(local_sessions.values()):
+        if session.connected:
+            continue
+        await session.settled.wait()
+        if local_sessions.get(session.session_id) is not session:
+            continue
+        session.cancel_linger()
+        await session.finish()
@@ -0,0 +1,117 @@
+"""Metrics and session stats of every worker, whichever worker answers the request.
+
+uvicorn's workers share one listening socket, so a scrape of /metrics or a
+request for /sessions/stats reaches an arbitrary worker, which only knows its
+own numbers. With METRICS_SHARED_DIR set, each worker publishes a snapshot of
+its metrics and session stats to `<directory>/<pid>.json` every `interval`
+seconds and whenever it answers such a request; the answering worker reads the
+others' snapshots and reports the total. Other workers' numbers are therefore
+up to `interval` seconds old.
+
+A worker that exits leaves its last snapshot behind, so counter totals never go
+backwards; its gauges and sessions are no longer reported. The directory should
+be emptied when the server starts (the Dockerfile does).
+
+File access runs on the storage executor, never on the event loop.
+"""
+import asyncio
+import json
+import os
+
+import metrics
+from config import logger, METRICS_SHARED_DIR, METRICS_PUBLISH_INTERVAL_SECONDS
+from executors import storage_executor
+
+
+def _alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedMetrics:
+    """Exchanges metric snapshots with the other workers through a shared directory.
+
+    `sessions` returns this worker's per-session stats, published alongside its metrics.
+    """
+
+    def __init__(self, directory: str, worker_id: str, sessions, interval: float = METRICS_PUBLISH_INTERVAL_SECONDS):
+        self.directory = directory
+        self.worker_id = worker_id
+        self.sessions = sessions
+        self.interval = interval
+        self.pid = os.getpid()
+        self._task = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _local(self):
+        # Taken on the event loop, where the metrics are updated.
+        return {"worker": self.worker_id, "metrics": metrics.snapshot(), "sessions": self.sessions()}
+
+    def _write(self, snapshot):
+        path = os.path.join(self.directory, f"{self.pid}.json")
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(temporary, path)
+
+    def _exchange(self, snapshot):
+        """Writes this worker's snapshot and returns (snapshot, alive) for every worker, this one first."""
+        self._write(snapshot)
+        snapshots = [(snapshot, True)]
+        for name in os.listdir(self.directory):
+            pid, extension = os.path.splitext(name)
+            if extension != ".json" or not pid.isdigit() or int(pid) == self.pid:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append((json.load(f), _alive(int(pid))))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable metrics snapshot {name}: {e}")
+        return snapshots
+
+    async def collect(self):
+        """(snapshot, alive) for every worker, with this worker's taken now."""
+        return await storage_executor.run(self._exchange, self._local())
+
+    async def render(self):
+        """Every worker's metrics added up, in the Prometheus text format."""
+        return metrics.render([(snapshot["metrics"], alive) for snapshot, alive in await self.collect()])
+
+    async def session_stats(self):
+        """Per-session stats of every live worker, each with the worker it runs on."""
+        return {
+            session_id: {**stats, "worker": snapshot["worker"]}
+            for snapshot, alive in await self.collect() if alive
+            for session_id, stats in snapshot["sessions"].items()
+        }
+
+    async def publish(self):
+        try:
+            await storage_executor.run(self._write, self._local())
+        except Exception as e:
+            logger.error(f"Error publishing metrics snapshot: {e}")
+
+    async def _run(self):
+        while True:
+            await self.publish()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops publishing, after a last snapshot so this worker's final counts are kept."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.publish()
+
+
+def create_shared_metrics(worker_id: str, sessions, directory: str = METRICS_SHARED_DIR):
+    """A SharedMetrics for METRICS_SHARED_DIR, or None if this worker reports only its own numbers."""
+    return SharedMetrics(directory, worker_id, sessions) if directory else None
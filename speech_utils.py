@@ -1,60 +1,315 @@
 import asyncio
 import json
-from google.cloud import speech
+import re
+from collections import Counter, deque
 
-from config import logger, SPEECH_API_SAMPLE_RATE, STREAM_LIMIT_SECONDS
-from gemini_utils import send_to_gemini
+from clients import get_speech_client
+from config import (
+    logger,
+    SPEECH_API_SAMPLE_RATE,
+    STREAM_LIMIT_SECONDS,
+    STREAM_OVERLAP_SECONDS,
+    STREAM_RETRY_BASE_SECONDS,
+    STREAM_RETRY_MAX_SECONDS,
+    STREAM_MAX_FAILURES,
+    SPEECH_DIARIZATION,
+    SPEECH_DIARIZATION_MAX_SPEAKERS,
+)
+from audio_utils import AudioPacketizer
+from metrics import FINAL_TRANSCRIPTS, SPEECH_RESULTS, SPEECH_STREAMS, SPEECH_STREAM_ERRORS
 
-def get_speech_config():
-    return speech.RecognitionConfig(
+# LINEAR16 mono: two bytes per sample.
+BYTES_PER_SECOND = SPEECH_API_SAMPLE_RATE * 2
+# How long finals from a previous stream are kept around for boundary de-duplication.
+DEDUP_WINDOW_SECONDS = 15
+
+# Speakers of a two-channel session, in the order of the channel byte that prefixes each audio message:
+# the shared tab carries the other participants, the microphone carries the CE.
+SPEAKER_CUSTOMER = "customer"
+SPEAKER_CE = "ce"
+CHANNEL_SPEAKERS = (SPEAKER_CUSTOMER, SPEAKER_CE)
+SPEAKER_LABELS = {SPEAKER_CUSTOMER: "Customer", SPEAKER_CE: "CE", None: "Speaker"}
+
+def speaker_label(speaker: str = None, tag: int = None):
+    """How a final is labelled for the browser and Gemini, e.g. "CE", "Customer 2" or "Speaker 1"; None if unknown."""
+    if speaker is None and not tag:
+        return None
+    label = SPEAKER_LABELS[speaker]
+    return f"{label} {tag}" if tag else label
+
+def dominant_speaker_tag(alternative, transcript: str):
+    """The diarization tag of most of the words in a final, or None.
+
+    With diarization on, every final carries the words of the whole stream so
+    far; the last ones are this final's.
+    """
+    n_words = len(transcript.split())
+    tags = Counter(word.speaker_tag for word in alternative.words[-n_words:] if word.speaker_tag)
+    return tags.most_common(1)[0][0] if tags else None
+
+def get_speech_config(diarization: bool = False):
+    # The speech SDK is imported on first use (or by the warm-up), not while the server starts.
+    from google.cloud import speech
+    config = speech.RecognitionConfig(
         encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
         sample_rate_hertz=SPEECH_API_SAMPLE_RATE,
         language_code="en-US",
+        # Question marks let the answer cache spot questions in final transcripts.
+        enable_automatic_punctuation=True,
     )
+    if diarization:
+        config.diarization_config = speech.SpeakerDiarizationConfig(
+            enable_speaker_diarization=True, min_speaker_count=1, max_speaker_count=SPEECH_DIARIZATION_MAX_SPEAKERS,
+        )
+    return config
+
+class RecognitionStream:
+    """A single `streaming_recognize` call, fed through its own request queue."""
 
-async def transcription_manager(ws, queue, genai_client, chat_history, full_transcript):
-    speech_client = speech.SpeechAsyncClient()
+    def __init__(self, index: int, diarization: bool = False):
+        self.index = index
+        self.diarization = diarization
+        self.started_at = asyncio.get_running_loop().time()
+        self.failed = False
+        self.responded = False
+        # Stream time, in seconds of audio: how much of the start replays the previous stream's
+        # last audio, how much has been sent, where the last final ended, and where the stream
+        # was half-closed (None while it is open).
+        self.primed = 0.0
+        self.sent = 0.0
+        self.last_final_end = 0.0
+        self.closed_at = None
+        self._requests = asyncio.Queue()
 
-    async def google_request_generator():
+    async def requests(self):
+        from google.cloud import speech
         yield speech.StreamingRecognizeRequest(
             streaming_config=speech.StreamingRecognitionConfig(
-                config=get_speech_config(), interim_results=True
+                config=get_speech_config(self.diarization), interim_results=True
             )
         )
         while True:
-            data = await queue.get()
+            data = await self._requests.get()
             if data is None:
                 break
             yield speech.StreamingRecognizeRequest(audio_content=data)
-            queue.task_done()
 
-    stream_start_time = asyncio.get_event_loop().time()
+    def send(self, data: bytes):
+        self.sent += len(data) / BYTES_PER_SECOND
+        self._requests.put_nowait(data)
+
+    def close(self):
+        """Half-closes the stream; Speech-to-Text then flushes its remaining finals."""
+        self.closed_at = self.sent
+        self._requests.put_nowait(None)
+
+    def final_span(self, result):
+        """(start, end) of a final result in stream time; it starts where the previous final ended."""
+        start = self.last_final_end
+        end = result.result_end_time.total_seconds() if result.result_end_time else self.sent
+        self.last_final_end = max(start, end)
+        return start, self.last_final_end
+
+def _words(text: str):
+    return re.sub(r"[^\w\s']", "", text.lower()).split()
+
+def _overlap(head, tail):
+    """Length of the longest suffix of `head` that is also a prefix of `tail`."""
+    for k in range(min(len(head), len(tail)), 0, -1):
+        if head[-k:] == tail[:k]:
+            return k
+    return 0
+
+def _contains(haystack, needle):
+    return f" {' '.join(needle)} " in f" {' '.join(haystack)} "
+
+class BoundaryDeduplicator:
+    """Removes words transcribed twice because overlap audio was replayed into a new stream.
+
+    After a rotation, the first `primed` seconds of the new stream are the last
+    seconds of the old one. Only finals whose audio falls in that window are
+    compared, and only with the other stream's finals from the same window: the
+    words they share at the boundary are trimmed, and a final lying entirely in
+    the window whose words the other stream already emitted there is dropped.
+    Finals outside the window are never touched, so a real repeat ("yes", "ok")
+    after a rotation is kept.
+    """
+
+    def __init__(self, window: float = DEDUP_WINDOW_SECONDS):
+        self.window = window
+        # (stream, normalized words, start, end, received at)
+        self._recent = deque()
+
+    def _stream(self, index: int):
+        for stream, *_ in self._recent:
+            if stream.index == index:
+                return stream
+        return None
+
+    def _words_of(self, stream, in_window):
+        words = []
+        for other, other_words, start, end, _ in self._recent:
+            if other is stream and in_window(start, end):
+                words.extend(other_words)
+        return words
+
+    def filter(self, stream, transcript: str, start: float, end: float, now: float):
+        """`transcript` without the words already emitted by the neighbouring stream, or None if nothing is left.
+
+        `start` and `end` are the final's span in `stream`'s time (see `RecognitionStream.final_span`).
+        """
+        while self._recent and now - self._recent[0][4] > self.window:
+            self._recent.popleft()
+
+        words = transcript.split()
+        normalized = _words(transcript)
+        older = self._stream(stream.index - 1)
+        if normalized and older is not None and older.closed_at is not None and start < stream.primed:
+            # The older stream already emitted the start of this final.
+            cut = older.closed_at - stream.primed
+            tail = self._words_of(older, lambda s, e: e > cut)
+            if end <= stream.primed and _contains(tail, normalized):
+                return None
+            k = _overlap(tail, normalized)
+            if k >= 2 or k == len(normalized):
+                words, normalized = words[k:], normalized[k:]
+
+        newer = self._stream(stream.index + 1)
+        if normalized and newer is not None and stream.closed_at is not None and end > stream.closed_at - newer.primed:
+            # A late final from the older stream; drop its tail already emitted by the newer one.
+            cut = stream.closed_at - newer.primed
+            head = self._words_of(newer, lambda s, e: s < newer.primed)
+            if start >= cut and _contains(head, normalized):
+                return None
+            k = _overlap(normalized, head)
+            if k >= 2 or k == len(normalized):
+                words, normalized = words[:len(words) - k], normalized[:len(normalized) - k]
+
+        if not words:
+            return None
+        self._recent.append((stream, normalized, start, end, now))
+        return " ".join(words)
+
+async def transcription_manager(ws, queue, scheduler, checkpointer, speaker: str = None,
+                                diarization: bool = SPEECH_DIARIZATION):
+    """Streams one audio channel to Speech-to-Text, rotating streams before the API limit.
+
+    Shortly before STREAM_LIMIT_SECONDS the next stream is opened and primed with
+    the last STREAM_OVERLAP_SECONDS of audio, then the old one is half-closed so
+    it can flush its finals. The client never sees the rotation.
+
+    A stream that fails is replaced after a backoff that grows with every
+    consecutive failure (a stream that returned results resets the count); audio
+    meanwhile only goes to the overlap. After STREAM_MAX_FAILURES in a row, the
+    client gets an ERROR and the channel stops transcribing.
+
+    `speaker` is the channel's speaker in a two-channel session, None for a
+    single mixed channel. Finals are labelled with it, and with the diarization
+    tag if `diarization` is on; the CE's own finals do not trigger Gemini requests.
+    """
+    diarization = diarization and speaker != SPEAKER_CE
+    speech_client = await get_speech_client()
+    loop = asyncio.get_running_loop()
+    dedup = BoundaryDeduplicator()
+    overlap = deque()
+    overlap_bytes = 0
+    max_overlap_bytes = int(STREAM_OVERLAP_SECONDS * BYTES_PER_SECOND)
+    consumers = set()
+    packetizer = AudioPacketizer()
+
+    async def handle_response(stream, response):
+        if not response.results or not response.results[0].alternatives:
+            return
+
+        result = response.results[0]
+        transcript_text = result.alternatives[0].transcript
+
+        if result.is_final:
+            SPEECH_RESULTS.labels("final").inc()
+            start, end = stream.final_span(result)
+            transcript = dedup.filter(stream, transcript_text.strip(), start, end, loop.time())
+            if transcript:
+                FINAL_TRANSCRIPTS.labels(speaker or "mixed").inc()
+                label = speaker_label(speaker, dominant_speaker_tag(result.alternatives[0], transcript) if diarization else None)
+                message = {"response_type": "TRANSCRIPT", "payload": transcript}
+                if label:
+                    message.update(speaker=speaker, label=label)
+                checkpointer.add_transcript(f"{label}: {transcript}" if label else transcript)
+                await ws.send_text(json.dumps(message))
+                scheduler.submit(transcript, label, triggers=speaker != SPEAKER_CE)
+        else:
+            SPEECH_RESULTS.labels("interim").inc()
+            if transcript_text:
+                # Coalesced and rate-limited by the channel; only the latest interim per speaker matters.
+                ws.send_interim(transcript_text, speaker)
+
+    async def consume(stream):
+        try:
+            responses = await speech_client.streaming_recognize(requests=stream.requests())
+            async for response in responses:
+                stream.responded = True
+                await handle_response(stream, response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in speech stream {stream.index}: {e}")
+            SPEECH_STREAM_ERRORS.inc()
+            stream.failed = True
+        finally:
+            logger.info(f"Speech stream {stream.index} finished.")
+
+    def open_stream(index, reason):
+        SPEECH_STREAMS.labels(reason).inc()
+        stream = RecognitionStream(index, diarization)
+        for chunk in overlap:
+            stream.send(chunk)
+        stream.primed = stream.sent
+        task = asyncio.create_task(consume(stream))
+        consumers.add(task)
+        task.add_done_callback(consumers.discard)
+        return stream
+
+    failures = 0
+    retry_at = None
     try:
-        responses = await speech_client.streaming_recognize(requests=google_request_generator())
-        async for response in responses:
-            if asyncio.get_event_loop().time() - stream_start_time > STREAM_LIMIT_SECONDS:
-                logger.info("Stream limit reached. Sending restart message.")
-                await ws.send_text(json.dumps({"response_type": "RESTART"}))
+        stream = open_stream(0, "start")
+        while True:
+            data = await packetizer.next_packet(queue)
+            if data is None:
                 break
 
-            if not response.results or not response.results[0].alternatives:
-                continue
-
-            result = response.results[0]
-            transcript_text = result.alternatives[0].transcript
-
-            if result.is_final:
-                transcript = result.alternatives[0].transcript.strip()
-                if transcript:
-                    full_transcript.append(transcript)
-                    await ws.send_text(json.dumps({"response_type": "TRANSCRIPT", "payload": transcript}))
-                    await send_to_gemini(ws, genai_client, chat_history, transcript)
-            else:
-                if transcript_text:
-                    await ws.send_text(json.dumps({"response_type": "INTERIM", "payload": transcript_text}))
+            if stream.failed and retry_at is None:
+                failures = 1 if stream.responded else failures + 1
+                if failures >= STREAM_MAX_FAILURES:
+                    logger.error(f"Speech stream failed {failures} times in a row; stopping transcription.")
+                    await ws.send_text(json.dumps({
+                        "response_type": "ERROR",
+                        "payload": "Speech recognition keeps failing; transcription stopped.",
+                    }))
+                    break
+                retry_at = loop.time() + min(STREAM_RETRY_BASE_SECONDS * 2 ** (failures - 1), STREAM_RETRY_MAX_SECONDS)
+            if (loop.time() >= retry_at) if stream.failed else (loop.time() - stream.started_at > STREAM_LIMIT_SECONDS):
+                logger.info(f"Rotating speech stream {stream.index} (failed={stream.failed}).")
+                previous = stream
+                stream = open_stream(previous.index + 1, "failure" if previous.failed else "rotation")
+                previous.close()
+                retry_at = None
+
+            if not stream.failed:
+                stream.send(data)
+            overlap.append(data)
+            overlap_bytes += len(data)
+            while overlap_bytes - len(overlap[0]) >= max_overlap_bytes:
+                overlap_bytes -= len(overlap.popleft())
+
+        stream.close()
+        # Let every open stream flush its last finals before finishing.
+        await asyncio.gather(*consumers)
     except asyncio.CancelledError:
         logger.info("Transcription manager cancelled.")
     except Exception as e:
         logger.error(f"Error during transcription processing: {e}")
     finally:
-        logger.info("Transcription manager finished.")
\ No newline at end of file
+        for task in list(consumers):
+            task.cancel()
+        logger.info(f"Transcription manager finished. Packetizer stats: {packetizer.stats()}")
@@ -0,0 +1,97 @@
+"""Where a cold start spends its time.
+
+main.py calls `track_imports` before anything else. From then until
+`imports_done`, every module import is timed and its own time is charged to
+its package: `google.genai`, `google.cloud.speech`, `fastapi`, `auth`, and so
+on. Time spent in a nested import goes to that import's package, so the totals
+add up to the whole import phase. The lifespan then times each initialization
+and warm-up step with `phase`. `log_report` logs the breakdown and exports it
+as the `startup_seconds` gauge.
+
+Only the standard library is imported here, so nothing escapes the tracking.
+"""
+import builtins
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_started = time.perf_counter()
+_import_seconds = defaultdict(float)
+_phases = {}
+_original_import = None
+# Time spent in nested imports, one entry per import in progress.
+_nested = []
+
+
+def _package(name: str):
+    parts = name.split(".")
+    if parts[:2] == ["google", "cloud"]:
+        return ".".join(parts[:3])
+    if parts[0] == "google":
+        return ".".join(parts[:2])
+    return parts[0]
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if level:
+        package = _package((globals or {}).get("__package__") or name)
+    else:
+        package = _package(name)
+    started = time.perf_counter()
+    _nested.append(0.0)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - started
+        _import_seconds[package] += elapsed - _nested.pop()
+        if _nested:
+            _nested[-1] += elapsed
+
+def track_imports():
+    """Starts timing imports. Only call from the main thread, before the server starts."""
+    global _original_import
+    if _original_import is None:
+        _original_import = builtins.__import__
+        builtins.__import__ = _timed_import
+
+def imports_done():
+    """Stops timing imports and records the import phase."""
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+    _phases["imports"] = time.perf_counter() - _started
+
+@contextmanager
+def phase(name: str):
+    """Records how long the body takes as the startup phase `name`; works around `await`s too."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = time.perf_counter() - started
+
+def ready():
+    """Marks the server ready to accept requests."""
+    _phases["ready"] = time.perf_counter() - _started
+
+def report(top: int = 10):
+    """The startup breakdown: phases in the order they ran, and the `top` packages by import time."""
+    imports = sorted(_import_seconds.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "phases": dict(_phases),
+        "imports": dict(imports[:top]),
+        "other_imports": sum(seconds for _, seconds in imports[top:]),
+    }
+
+def log_report(top: int = 10):
+    from config import logger
+    from metrics import STARTUP_SECONDS
+
+    result = report(top)
+    for name, seconds in result["phases"].items():
+        STARTUP_SECONDS.labels(name).set(round(seconds, 4))
+    lines = [f"  {name:<28} {seconds * 1000:8.1f} ms" for name, seconds in result["phases"].items()]
+    lines.append("  imports by package:")
+    lines.extend(f"    {name:<26} {seconds * 1000:8.1f} ms" for name, seconds in result["imports"].items())
+    lines.append(f"    {'(other)':<26} {result['other_imports'] * 1000:8.1f} ms")
+    logger.warning("Startup timing:\n" + "\n".join(lines))
@@ -0,0 +1,28 @@
+class AudioProcessor extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        // Accumulate 128-sample render quanta into larger frames so we post far fewer messages.
+        const frameMs = (options.processorOptions && options.processorOptions.frameMs) || 100;
+        this.frame = new Int16Array(Math.round(sampleRate * frameMs / 1000));
+        this.offset = 0;
+    }
+
+    process(inputs, outputs, parameters) {
+        const input = inputs[0];
+        if (input.length > 0) {
+            const channel = input[0];
+            for (let i = 0; i < channel.length; i++) {
+                const sample = Math.max(-1, Math.min(1, channel[i]));
+                this.frame[this.offset++] = sample * 32767;
+                if (this.offset === this.frame.length) {
+                    this.port.postMessage(this.frame.buffer, [this.frame.buffer]);
+                    this.frame = new Int16Array(this.frame.length);
+                    this.offset = 0;
+                }
+            }
+        }
+        return true;
+    }
+}
+
+registerProcessor('audio-processor', AudioProcessor);
@@ -0,0 +1,176 @@
+"""The browser UI's files, served from memory with precompression and cache validation.
+
+Only the files in STATIC_DIR are served. They are read once at startup and
+compressed there, with gzip and, if the `brotli` package is installed, brotli.
+Requests then cost a dict lookup, and a client that already has a file gets an
+empty 304.
+
+Caching:
+
+- Every representation has a strong ETag: the content hash, plus the encoding.
+- HTML is sent with `no-cache`, so browsers revalidate it on every load.
+- References to the other assets inside the HTML are rewritten to
+  `name?v=<hash>`. Those versioned URLs are cached for STATIC_MAX_AGE_SECONDS
+  as immutable, and a deploy that changes an asset changes its URL.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+from config import logger, STATIC_DIR, STATIC_MAX_AGE_SECONDS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies gain nothing from compression once headers are counted.
+MIN_COMPRESS_BYTES = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class Asset:
+    """One file's bytes, encodings and validators."""
+
+    def __init__(self, name: str, body: bytes):
+        self.name = name
+        self.media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if self.media_type == "application/javascript":
+            self.media_type = "text/javascript"
+        self.set_body(body)
+
+    def set_body(self, body: bytes):
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.bodies = {"identity": body}
+        if self.media_type.startswith(COMPRESSIBLE_TYPES) and len(body) >= MIN_COMPRESS_BYTES:
+            compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(body, quality=11)
+            for encoding, data in compressed.items():
+                if len(data) < len(body):
+                    self.bodies[encoding] = data
+        # Strong ETags must differ between encodings of the same content.
+        self.etags = {encoding: f'"{self.version}"' if encoding == "identity" else f'"{self.version}-{encoding}"'
+                      for encoding in self.bodies}
+
+    @property
+    def is_html(self):
+        return self.media_type == "text/html"
+
+
+def _accepted_encodings(header: str):
+    """The content codings the client accepts (q > 0), from an Accept-Encoding header."""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+def _etag_matches(header: str, etag: str):
+    """If-None-Match uses weak comparison: `W/` prefixes are ignored, `*` matches anything."""
+    if header.strip() == "*":
+        return True
+    return etag in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+class StaticAssets:
+    """An ASGI app serving the files of `directory` from memory.
+
+    `load` must run before the first request; the lifespan calls it on the
+    storage executor. `protected` names the files only served behind login,
+    which the auth middleware checks with `is_public`.
+    """
+
+    def __init__(self, directory: str = STATIC_DIR, max_age: int = STATIC_MAX_AGE_SECONDS, protected=("index.html",)):
+        self.directory = directory
+        self.max_age = max_age
+        self.protected = set(protected)
+        self.assets = {}
+
+    def load(self):
+        """Reads, fingerprints and compresses every file in the directory. Blocking."""
+        assets = {}
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    assets[name] = Asset(name, f.read())
+
+        # Point HTML at versioned asset URLs, so those can be cached for good.
+        versioned = [asset for asset in assets.values() if not asset.is_html]
+        if versioned:
+            pattern = re.compile(r"""(?<=["'])(/?)(%s)(?=["'])""" % "|".join(re.escape(asset.name) for asset in versioned))
+            for asset in assets.values():
+                if asset.is_html:
+                    html = asset.bodies["identity"].decode("utf-8")
+                    html = pattern.sub(lambda m: f"{m.group(1)}{m.group(2)}?v={assets[m.group(2)].version}", html)
+                    asset.set_body(html.encode("utf-8"))
+
+        self.assets = assets
+        sizes = {encoding: sum(len(a.bodies.get(encoding, a.bodies["identity"])) for a in assets.values())
+                 for encoding in ("identity", "gzip", "br")}
+        logger.warning(f"Loaded {len(assets)} static assets from {self.directory}: "
+                       f"{sizes['identity']} bytes, {sizes['gzip']} gzip, "
+                       f"{sizes['br'] if brotli else 'no'} brotli.")
+
+    def is_public(self, path: str):
+        """Whether `path` is an asset that may be served without login (e.g. to the login page)."""
+        name = path.lstrip("/")
+        return name in self.assets and name not in self.protected
+
+    def response(self, request: Request, name: str):
+        asset = self.assets.get(name)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+
+        if asset.is_html:
+            cache_control = "no-cache"
+        elif request.query_params.get("v") == asset.version:
+            cache_control = f"public, max-age={self.max_age}, immutable"
+        else:
+            cache_control = "no-cache"
+        headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next((e for e in ("br", "gzip") if e in asset.bodies and e in accepted), "identity")
+        headers["ETag"] = asset.etags[encoding]
+
+        if_none_match = request.headers.get("if-none-match")
+        # Only the chosen variant's ETag validates the client's copy; another encoding's body differs.
+        if if_none_match and _etag_matches(if_none_match, asset.etags[encoding]):
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        body = asset.bodies[encoding]
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, headers=headers, media_type=asset.media_type)
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if request.method not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405)
+        else:
+            name = request.url.path.lstrip("/") or "index.html"
+            response = self.response(request, name)
+        await response(scope, receive, send)
+
+
+static_assets = StaticAssets()
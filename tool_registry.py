@@ -0,0 +1,169 @@
+"""The tools Gemini can call, declared once for the server and the ADK agent.
+
+Each tool is a `ToolSpec`: its name, description and JSON-schema parameters,
+the WebSocket response type it produces, and a function building that
+message's payload from the call's arguments. `ToolRegistry` compiles the specs
+at import into the `types.Tool` and `GenerateContentConfig` sent with every
+request, and into a name -> spec table that turns each function call into a
+message with one dict lookup.
+
+Arguments are checked before the payload is built. A call to an unknown tool,
+or one missing a required argument, produces no message; it is logged and
+counted instead of raising in the middle of a response.
+"""
+import uuid
+
+from google.genai import types
+
+from config import logger
+from metrics import INVALID_TOOL_CALLS
+
+FACT_CATEGORIES = ("infrastructure", "goals", "concerns", "other")
+
+
+class ToolSpec:
+    """One tool: its declaration and how its calls become WebSocket messages.
+
+    `build(args)` gets the validated arguments: every required one is a
+    non-empty string, and optional ones are present only if the model set them.
+    """
+
+    def __init__(self, name: str, description: str, properties: dict, required, response_type: str, build):
+        self.name = name
+        self.description = description
+        self.properties = properties
+        self.required = tuple(required)
+        self.response_type = response_type
+        self.build = build
+        self.declaration = types.FunctionDeclaration.model_validate({
+            "name": name,
+            "description": description,
+            "parameters": {"type": "object", "properties": properties, "required": list(self.required)},
+        })
+
+    def validate(self, args):
+        """Returns (arguments, None), or (None, problem) if a required argument is missing."""
+        validated = {}
+        for name, value in (args or {}).items():
+            if name not in self.properties or value is None:
+                continue
+            value = value.strip() if isinstance(value, str) else str(value)
+            if value:
+                validated[name] = value
+        missing = [name for name in self.required if name not in validated]
+        if missing:
+            return None, f"missing {', '.join(missing)}"
+        return validated, None
+
+
+def _fact_payload(args):
+    category = args["category"].lower()
+    payload = {"fact": args["fact"], "category": category if category in FACT_CATEGORIES else "other"}
+    if "gcp_service" in args:
+        payload["gcp_service"] = args["gcp_service"]
+    return payload
+
+def _tip_payload(args):
+    return {"short": f"💡 {args['short_tip']}", "long": args["long_tip"]}
+
+def _answer_payload(args):
+    return {"question": args["question"], "short": args["short_answer"], "long": args["long_answer"]}
+
+
+TOOLS = (
+    ToolSpec(
+        "extract_fact",
+        "Extract a key fact from the transcript.",
+        {
+            "fact": {
+                "type": "string",
+                "description": "The key fact, such as a number, technology, person, or goal. Should be keywords only."
+            },
+            "category": {
+                "type": "string",
+                "enum": list(FACT_CATEGORIES),
+                "description": "The category of the fact. Must be 'infrastructure' for infrastructure components (e.g., 'EC2', 'S3', 'VPC'), 'goals' for business or technical goals, 'concerns' for any stated problems or challenges, or 'other' for all other facts."
+            },
+            "gcp_service": {
+                "type": "string",
+                "description": "The equivalent GCP service for an infrastructure fact. Only provide if the category is 'infrastructure' and a clear equivalent exists."
+            },
+        },
+        required=("fact", "category"),
+        response_type="FACT",
+        build=_fact_payload,
+    ),
+    ToolSpec(
+        "provide_tip",
+        "Provide a proactive tip for the Customer Engineer.",
+        {
+            "short_tip": {
+                "type": "string",
+                "description": "A short, keyword-based version of the tip."
+            },
+            "long_tip": {
+                "type": "string",
+                "description": "A longer, more detailed version of the tip."
+            },
+        },
+        required=("short_tip", "long_tip"),
+        response_type="TIP",
+        build=_tip_payload,
+    ),
+    ToolSpec(
+        "answer_question",
+        "Answer a direct question from the customer.",
+        {
+            "question": {
+                "type": "string",
+                "description": "A short, keyword-based summary of the customer's question."
+            },
+            "short_answer": {
+                "type": "string",
+                "description": "A short, keyword-based answer to the customer's question."
+            },
+            "long_answer": {
+                "type": "string",
+                "description": "A longer, more detailed answer to the customer's question."
+            },
+        },
+        required=("question", "short_answer", "long_answer"),
+        response_type="ANSWER",
+        build=_answer_payload,
+    ),
+)
+
+
+class ToolRegistry:
+    """The declared tools, compiled once, and the dispatch table for their calls."""
+
+    def __init__(self, specs):
+        self.specs = {spec.name: spec for spec in specs}
+        self.tool = types.Tool(function_declarations=[spec.declaration for spec in specs])
+        self.generate_config = types.GenerateContentConfig(tools=[self.tool])
+
+    def call(self, name: str, args):
+        """Turns a function call into a WebSocket message. Returns (message, None), or (None, problem)."""
+        spec = self.specs.get(name)
+        if spec is None:
+            INVALID_TOOL_CALLS.labels("unknown", "unknown_tool").inc()
+            return None, f"unknown tool {name!r}"
+        validated, problem = spec.validate(args)
+        if problem:
+            INVALID_TOOL_CALLS.labels(name, "invalid_arguments").inc()
+            return None, problem
+        return {
+            "message_id": str(uuid.uuid4()),
+            "response_type": spec.response_type,
+            "payload": spec.build(validated),
+        }, None
+
+    def build_message(self, fc):
+        """Converts a Gemini function call into a WebSocket message, or None if it cannot be used."""
+        message, problem = self.call(fc.name, fc.args)
+        if message is None:
+            logger.warning(f"Dropping function call {fc.name}({fc.args}): {problem}")
+        return message
+
+
+tool_registry = ToolRegistry(TOOLS)
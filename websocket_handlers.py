@@ -1,30 +1,130 @@
 import asyncio
+import json
+import time
 from fastapi import WebSocket, WebSocketDisconnect, Query
-import google.genai as genai
 
-from config import logger
+from clients import get_genai_client
+from config import logger, GEMINI_STREAMING, VAD_ENABLED, AUDIO_LAG_WARNING_SECONDS, SESSION_RESUME_GRACE_SECONDS
 from gemini_utils import SYSTEM_PROMPT, send_to_gemini
-from speech_utils import transcription_manager
+from speech_utils import CHANNEL_SPEAKERS, transcription_manager
+from context_utils import ConversationContext
+from audio_utils import AudioBuffer, VoiceActivityDetector
 from auth import verify_token
-from gcs_utils import upload_conversation
+from sessions import open_session
+from metrics import (
+    AUDIO_BUFFER_SECONDS,
+    AUDIO_FORWARDED_BYTES,
+    AUDIO_RECEIVED_BYTES,
+    GEMINI_PENDING_UTTERANCES,
+    SESSION_SECONDS,
+    SESSIONS_ACTIVE,
+    SESSIONS_TOTAL,
+)
 
-async def audio_receiver(ws: WebSocket, queue: asyncio.Queue):
-    """Receives audio chunks from the client and puts them into a queue."""
+# Live transcription sessions on this worker, keyed by session ID, for per-session stats.
+active_sessions = {}
+SESSIONS_ACTIVE.function = lambda: len(active_sessions)
+AUDIO_BUFFER_SECONDS.function = lambda: sum(c.buffer.lag_seconds() for s in active_sessions.values() for c in s["channels"])
+GEMINI_PENDING_UTTERANCES.function = lambda: sum(s["scheduler"].stats()["pending"] for s in active_sessions.values())
+
+def pause_notifier(ws: WebSocket):
+    """Builds an AudioBuffer `on_pause` callback that tells the client to pause or resume sending.
+
+    Shared by the buffers of a two-channel session: the client pauses while any of them is full.
+    """
+    pending = set()
+    paused_buffers = 0
+
+    def on_pause(paused: bool):
+        nonlocal paused_buffers
+        paused_buffers += 1 if paused else -1
+        if paused_buffers != (1 if paused else 0):
+            return
+        logger.warning(f"Audio buffer {'full, pausing' if paused else 'drained, resuming'} client.")
+        task = asyncio.create_task(ws.send_text(json.dumps({"response_type": "PAUSE" if paused else "RESUME"})))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    return on_pause
+
+class AudioChannel:
+    """One audio channel of a session: its speaker, VAD and buffer ahead of Speech-to-Text."""
+
+    def __init__(self, speaker: str, buffer: AudioBuffer, vad: VoiceActivityDetector = None):
+        self.speaker = speaker
+        self.buffer = buffer
+        self.vad = vad
+        self.lagging = False
+
+    def put(self, data: bytes):
+        """Queues a chunk for Speech-to-Text, skipping silence if the channel has a VAD."""
+        if self.vad is None:
+            self.buffer.put_nowait(data)
+            AUDIO_FORWARDED_BYTES.inc(len(data))
+        else:
+            for chunk in self.vad.process(data):
+                self.buffer.put_nowait(chunk, silent=not self.vad.speaking)
+                AUDIO_FORWARDED_BYTES.inc(len(chunk))
+
+        if self.lagging != (self.buffer.lag_seconds() > AUDIO_LAG_WARNING_SECONDS):
+            self.lagging = not self.lagging
+            if self.lagging:
+                logger.warning(f"Speech recognition is falling behind real time: {self.buffer.stats()}")
+
+    def stats(self):
+        return {"audio_buffer": self.buffer.stats(), "vad": self.vad.stats() if self.vad else None}
+
+async def audio_receiver(ws: WebSocket, channels):
+    """Receives audio chunks from the client and puts them into their channel.
+
+    With more than one channel, every message starts with one byte: the index
+    of its channel in `channels`, followed by that channel's PCM.
+    """
     try:
         while True:
             data = await ws.receive_bytes()
-            await queue.put(data)
+            AUDIO_RECEIVED_BYTES.inc(len(data))
+            if len(channels) == 1:
+                channels[0].put(data)
+            elif data and data[0] < len(channels):
+                channels[data[0]].put(data[1:])
+            else:
+                logger.warning(f"Dropping audio message for unknown channel {data[:1]!r}.")
     except WebSocketDisconnect:
         logger.info("Client disconnected. Signaling transcription manager to stop.")
-        await queue.put(None)
     except Exception as e:
         logger.error(f"Error in audio_receiver: {e}")
-        await queue.put(None)
+    finally:
+        for channel in channels:
+            channel.buffer.close()
+
+def session_stats():
+    """Per-session pipeline stats for every live session on this worker."""
+    return {
+        session_id: {
+            "user": session["user"],
+            "channels": {channel.speaker or "mixed": channel.stats() for channel in session["channels"]},
+            "scheduler": session["scheduler"].stats(),
+        }
+        for session_id, session in active_sessions.items()
+    }
+
+async def websocket_transcribe_endpoint(websocket: WebSocket, token: str = Query(None), stream: bool = Query(GEMINI_STREAMING),
+                                        session_id: str = Query(None), last_event_id: int = Query(0), channels: int = Query(1)):
+    """Handles the main WebSocket connection for audio transcription.
 
-async def websocket_transcribe_endpoint(websocket: WebSocket, token: str = Query(None)):
-    """Handles the main WebSocket connection for audio transcription."""
+    With `session_id` from an earlier connection, the session is resumed with its
+    transcript and Gemini context, and the events after `last_event_id` are sent again.
+
+    With `channels=2`, the client sends the shared tab's audio and the CE's
+    microphone as two channels (see `audio_receiver`). Each is transcribed by
+    its own Speech-to-Text stream, finals are labelled Customer or CE, and only
+    the customer's trigger Gemini requests.
+    """
     user = None
-    full_transcript = []
+    session = None
+    audio_channels = []
+    started_at = None
     
     try:
         if not token:
@@ -41,33 +141,64 @@ async def websocket_transcribe_endpoint(websocket: WebSocket, token: str = Query
             # Cannot close here as the connection is not accepted yet.
             return
 
-        client = genai.Client()
-        chat_history = [
-            {'role': 'user', 'parts': [{'text': SYSTEM_PROMPT}]},
-            {'role': 'model', 'parts': [{'text': "Understood. I am ready to assist."}]}
+        session, resumed = await open_session(session_id, user.get("email"), get_genai_client(), stream)
+        session.attach(websocket)
+        # Queued through the channel, ahead of the replayed events.
+        await session.channel.send_text(json.dumps({
+            "response_type": "SESSION",
+            "payload": {"session_id": session.session_id, "resumed": resumed, "last_event_id": session.channel.last_event_id},
+        }))
+        if resumed:
+            replayed = session.channel.replay(last_event_id)
+            logger.warning(f"Session {session.session_id} reconnected; replayed {replayed} missed events.")
+        on_pause = pause_notifier(session.channel)
+        speakers = CHANNEL_SPEAKERS if channels == 2 else (None,)
+        audio_channels = [
+            AudioChannel(speaker, AudioBuffer(on_pause=on_pause), VoiceActivityDetector() if VAD_ENABLED else None)
+            for speaker in speakers
         ]
-        audio_queue = asyncio.Queue()
+        active_sessions[session.session_id] = {
+            "user": user.get("email"),
+            "channels": audio_channels,
+            "scheduler": session.scheduler,
+        }
+        started_at = time.monotonic()
+        SESSIONS_TOTAL.inc()
         
-        receiver_task = asyncio.create_task(audio_receiver(websocket, audio_queue))
-        manager_task = asyncio.create_task(transcription_manager(websocket, audio_queue, client, chat_history, full_transcript))
-
-        await asyncio.gather(receiver_task, manager_task)
+        receiver_task = asyncio.create_task(audio_receiver(websocket, audio_channels))
+        manager_tasks = [
+            asyncio.create_task(transcription_manager(
+                session.channel, channel.buffer, session.scheduler, session.checkpointer, channel.speaker
+            ))
+            for channel in audio_channels
+        ]
+        await asyncio.gather(receiver_task, *manager_tasks)
 
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected by client during transcription.")
+    except asyncio.CancelledError:
+        if not (session and session.replaced):
+            raise
+        logger.warning(f"Session {session.session_id} taken over by a new connection.")
     except Exception as e:
         logger.error(f"An unexpected error occurred in the websocket endpoint: {e}")
     finally:
-        logger.info("Session ended. Uploading conversation to GCS.")
-        if full_transcript and user:
-            conversation_data = {
-                "user": user.get("email"),
-                "transcript": full_transcript
-            }
-            upload_conversation(conversation_data)
+        if session:
+            # After a takeover on this worker the entry may already be the new connection's.
+            if active_sessions.get(session.session_id, {}).get("channels") is audio_channels:
+                del active_sessions[session.session_id]
+            if session.connected:
+                session.detach(SESSION_RESUME_GRACE_SECONDS)
+            else:
+                session.abandon()
+        if started_at is not None:
+            SESSION_SECONDS.observe(time.monotonic() - started_at)
+        for channel in audio_channels:
+            if channel.vad:
+                logger.info(f"VAD stats ({channel.speaker or 'mixed'}): {channel.vad.stats()}")
         # The ASGI server handles the final closing of the connection.
 
-async def websocket_test_text_endpoint(websocket: WebSocket, token: str = Query(None)):
+async def websocket_test_text_endpoint(websocket: WebSocket, token: str = Query(None), stream: bool = Query(GEMINI_STREAMING)):
     if not token:
         logger.warning("Auth token missing for test endpoint.")
         return
@@ -80,17 +211,14 @@ async def websocket_test_text_endpoint(websocket: WebSocket, token: str = Query(
         return
 
     try:
-        client = genai.Client()
-        chat_history = [
-            {'role': 'user', 'parts': [{'text': SYSTEM_PROMPT}]},
-            {'role': 'model', 'parts': [{'text': "Understood. I am ready to assist."}]}
-        ]
-        logger.info("Gemini client created and history initialized for test endpoint.")
+        client = get_genai_client()
+        context = ConversationContext(SYSTEM_PROMPT)
+        logger.info("History initialized for test endpoint.")
 
         while True:
             transcript = await websocket.receive_text()
             logger.info(f"Received transcript for testing: {transcript}")
-            await send_to_gemini(websocket, client, chat_history, transcript)
+            await send_to_gemini(websocket, client, context, transcript, stream)
 
     except WebSocketDisconnect:
         logger.info("Test WebSocket connection closing.")